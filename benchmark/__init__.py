@@ -0,0 +1,11 @@
+"""Reproducible benchmarks of the routing engines on synthetic GTFS cities.
+
+    python -m benchmark generate /tmp/city --stops 800 --routes 30 --headway 600
+    python -m benchmark run --sizes 200,800,3200 --engines csa,raptor --out results
+    python -m benchmark run --gtfs GTFS_DIR --engines gds,csa --out results
+    python -m benchmark run --sizes 800,3200 --engines expanded,expanded_astar --out results
+
+Run from the repository root, the engines are imported as top-level modules.
+"""
+from benchmark.runner import StageRunner, compare_astar, percentiles, run_benchmark, summarize, write_results
+from benchmark.synthetic import generate_city, od_pairs
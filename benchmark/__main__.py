@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+
+from benchmark import compare_astar, generate_city, run_benchmark, write_results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Routing engine benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='write a synthetic GTFS city')
+    generate.add_argument('path')
+    run = commands.add_parser('run', help='time the engines and write samples.csv, summary.json, scaling.csv')
+    run.add_argument('--out', default='benchmark_results')
+    run.add_argument('--sizes', default='200,800,3200', help='number of stops of the synthetic cities')
+    run.add_argument('--gtfs', help='benchmark this feed instead of synthetic cities')
+    run.add_argument('--engines', default='csa,raptor',
+                     help="comma separated, among 'gds', 'gds_astar', 'csa', 'raptor', 'expanded', 'expanded_astar', "
+                          "'tdgraph'")
+    run.add_argument('--pairs', type=int, default=50)
+    run.add_argument('--time', default='08:00:00')
+    run.add_argument('--speed', type=float, default=1)
+    run.add_argument('--radius', type=float, default=300)
+    run.add_argument('--uri', default='neo4j://localhost:7687')
+    run.add_argument('--user', default='neo4j')
+    run.add_argument('--password', default='12345678')
+    for command in (generate, run):
+        command.add_argument('--date', default='2024-01-18')
+        command.add_argument('--seed', type=int, default=0)
+        command.add_argument('--routes', type=int, help='routes of a city, by default one every 20 stops')
+        command.add_argument('--route-length', type=int, default=20)
+        command.add_argument('--headway', type=int, default=600, help='seconds between two trips of a route')
+        command.add_argument('--trips', type=int, help='trips per route and direction, instead of --headway')
+    generate.add_argument('--stops', type=int, default=400)
+    args = parser.parse_args(argv)
+
+    def city(path, stops):
+        return generate_city(path, stops=stops, routes=args.routes or max(2, stops // 20),
+                             route_length=args.route_length, headway=args.headway, trips=args.trips,
+                             date=args.date, seed=args.seed)
+
+    if args.command == 'generate':
+        print(city(args.path, args.stops))
+        return
+
+    if args.gtfs:
+        cities = {os.path.basename(os.path.normpath(args.gtfs)): (args.gtfs, args.date, {})}
+    else:
+        cities = {}
+        for stops in map(int, args.sizes.split(',')):
+            path = os.path.join(args.out, 'city_%d' % stops)
+            cities['city_%d' % stops] = (path, args.date, city(path, stops))
+    engines = args.engines.split(',')
+    driver = None
+    if any(engine.startswith('gds') for engine in engines):
+        from neo4j import GraphDatabase
+        driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    try:
+        samples = run_benchmark(cities, engines, args.pairs, args.time, speed, args.radius, args.seed, driver)
+    finally:
+        if driver is not None:
+            driver.close()
+    summary = write_results(samples, args.out)
+    for entry in summary:
+        print('%-12s %-14s %-11s p50 %8.2f ms  p99 %8.2f ms' % (entry['city'], entry['engine'], entry['stage'],
+                                                               entry['p50'] * 1000, entry['p99'] * 1000))
+    for entry in compare_astar(summary):
+        settled = ('  settled %.0f -> %.0f' % (entry['settled_dijkstra'], entry['settled_astar'])
+                   if 'settled_astar' in entry else '')
+        print('%-12s %-14s A* p50 %.2f -> %.2f ms (x%.2f)%s' % (entry['city'], entry['engine'],
+                                                               entry['p50_dijkstra'] * 1000,
+                                                               entry['p50_astar'] * 1000, entry['speedup'], settled))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
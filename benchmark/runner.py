@@ -0,0 +1,266 @@
+"""Stage-by-stage timing of the routing engines.
+
+Every origin-destination pair is timed in three stages, the fourth one,
+projection, being timed once per city and engine:
+
+- projection: building what the engine routes on. For 'gds' the GDS
+  projection of the day, for 'csa' the Timetable, for 'raptor' the Timetable
+  and its route patterns, for 'expanded' the Timetable and the time-expanded
+  graph of the projection (expanded.py), for 'tdgraph' the Timetable and the
+  time-dependent stop/route graph (tdgraph.py).
+- near_stops: stops around the origin and around the destination.
+- routing: the earliest-arrival search itself. 'raptor' answers a range
+  query over the window seconds after the departure time and keeps the
+  earliest arrival, which is how App.profile_routing uses it. 'expanded' runs
+  the single Dijkstra of App.routing_between_two_points_in_space and records
+  how many Stoptimes it settled.
+- path: turning the result into App._routing rows. The GDS query expands the
+  path inside Cypher, so for 'gds' this stage is only fetching the records
+  into a DataFrame and the expansion is part of routing.
+
+'csa', 'raptor', 'expanded' and 'tdgraph' read the GTFS files directly. 'gds' needs a
+driver and the same feed loaded in Neo4j with new_dbSetup.py.
+
+'gds_astar' and 'expanded_astar' are 'gds' and 'expanded' with A* instead of
+Dijkstra; compare_astar reports their settled Stoptimes and latency against
+Dijkstra (GDS does not report settled nodes, only latency is compared).
+"""
+import csv
+import json
+import os
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import queries
+from benchmark.synthetic import od_pairs
+from csa import ConnectionScan
+from expanded import ExpandedGraph
+from projections import ProjectionManager, graph_name
+from raptor import Raptor, RoutePatterns
+from spatial import haversine
+from tdgraph import TimeDependentGraph
+from timetable import Feed, Timetable, time_to_seconds
+
+STAGES = ['projection', 'near_stops', 'routing', 'path']
+ENGINES = ['gds', 'gds_astar', 'csa', 'raptor', 'expanded', 'expanded_astar', 'tdgraph']
+PERCENTILES = [50, 90, 99]
+COLUMNS = ['trip', 'departure', 'line', 'starting_stop_name', 'starting_stop_id', 'starting_stop_coordinates',
+           'next_trip', 'next_stop', 'next_stop_id', 'next_stop_coordinates', 'next_line', 'arrival']
+
+
+def timed(function, *args, **kwargs):
+    """(result, elapsed seconds) of function(*args, **kwargs)."""
+    start = timeit.default_timer()
+    result = function(*args, **kwargs)
+    return result, timeit.default_timer() - start
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    summary = {'count': int(len(values))}
+    if len(values):
+        summary.update({'p%d' % p: float(np.percentile(values, p)) for p in PERCENTILES})
+        summary.update({'mean': float(values.mean()), 'max': float(values.max())})
+    return summary
+
+
+class StageRunner:
+    """Times the stages of one engine on one feed and service day."""
+
+    def __init__(self, engine, gtfs_path, date, speed=1, radius=300, max_duration=4, window=3600, driver=None):
+        if engine not in ENGINES:
+            raise ValueError('unknown engine %r' % engine)
+        if engine.startswith('gds') and driver is None:
+            raise ValueError("engine %r needs a Neo4j driver" % engine)
+        self.engine = engine
+        self.astar = engine.endswith('_astar')
+        self.gtfs_path = gtfs_path
+        self.date = date
+        self.speed = speed
+        self.radius = radius
+        self.max_duration = max_duration
+        self.window = window
+        self.driver = driver
+        self.tt = None
+        self.patterns = None
+        self.graph = None
+        self.nm_per_second = None
+        # Stoptimes settled by the last routing, for the engines that count them
+        self.settled = None
+
+    def projection(self):
+        if self.engine.startswith('gds'):
+            manager = ProjectionManager(self.driver, prefetch_next_day=False)
+            name = graph_name(self.date, self.speed, self.astar)
+            if manager.exists(name):
+                manager.drop(name)
+            _, elapsed = timed(manager.project, self.date, self.speed, self.astar)
+            if self.astar:
+                self.nm_per_second = manager.nm_per_second(self.date, self.speed)
+            return elapsed
+        self.tt, elapsed = timed(Timetable.from_gtfs, self.gtfs_path, self.date)
+        if self.engine == 'raptor':
+            self.patterns, more = timed(RoutePatterns, self.tt)
+            elapsed += more
+        if self.engine.startswith('expanded'):
+            self.graph, more = timed(ExpandedGraph.from_timetable, self.tt, self.speed)
+            elapsed += more
+        if self.engine == 'tdgraph':
+            self.graph, more = timed(TimeDependentGraph, self.tt)
+            elapsed += more
+        return elapsed
+
+    def near_stops(self, lat, lon):
+        if self.engine.startswith('gds'):
+            with self.driver.session() as session:
+                result = session.run(queries.FIND_NEAR_STOPS, date=self.date, lat=lat, lon=lon, radius=self.radius)
+                return [record[0] for record in result]
+        stops, distances = self.tt.near_stops(lat, lon, self.radius)
+        if self.engine.startswith('expanded'):
+            return sorted({str(self.tt.stop_names[stop]) for stop in stops})
+        return {int(stop): int(distance / self.speed) for stop, distance in zip(stops, distances)}
+
+    def routing(self, time, origin, destination, sources, targets):
+        departure = time_to_seconds(time)
+        endtime = departure + self.max_duration * 3600
+        if self.engine.startswith('gds'):
+            query = queries.ROUTING_BETWEEN_POINTS_ASTAR if self.astar else queries.ROUTING_BETWEEN_POINTS
+            with self.driver.session() as session:
+                result = session.run(query, date=self.date, departure=departure, endtime=endtime,
+                                     speed=self.speed, start_lat=origin[0], start_lon=origin[1],
+                                     end_lat=destination[0], end_lon=destination[1], start_names=sources,
+                                     end_names=targets, graph_name=graph_name(self.date, self.speed, self.astar),
+                                     nm_per_second=self.nm_per_second)
+                return list(result)
+        if self.engine.startswith('expanded'):
+            found = self.graph.search(origin[0], origin[1], destination[0], destination[1], sources, targets,
+                                      self.speed, departure, endtime, heuristic=self.astar)
+            self.settled = self.graph.settled
+            return found[0] if found else []
+        if self.engine == 'csa':
+            return ConnectionScan.scan(self.tt, self.speed, departure, sources, targets, endtime)
+        if self.engine == 'tdgraph':
+            return self.graph.search(self.speed, departure, sources, targets, endtime)[1]
+        journeys = Raptor(None).range_scan(self.tt, self.patterns, self.speed, departure,
+                                           departure + self.window, sources, targets, endtime)
+        return min(journeys, key=lambda journey: journey[1])[2] if journeys else []
+
+    def path(self, result):
+        if self.engine.startswith('gds'):
+            return pd.DataFrame([record.values() for record in result], columns=COLUMNS)
+        if self.engine.startswith('expanded'):
+            return pd.DataFrame([self.tt.itinerary_row(a, b) for a, b in zip(result, result[1:])], columns=COLUMNS)
+        return pd.DataFrame(self.tt.itinerary(result), columns=COLUMNS)
+
+    def run(self, pairs, time='08:00:00'):
+        """Samples {stage, seconds, ...} for the projection and every pair of pairs."""
+        samples = [{'engine': self.engine, 'pair': None, 'distance': None, 'stage': 'projection',
+                    'seconds': self.projection(), 'found': None, 'settled': None}]
+        for i, (origin, destination) in enumerate(pairs):
+            distance = float(haversine(*origin, *destination))
+            sources, start_lookup = timed(self.near_stops, *origin)
+            targets, end_lookup = timed(self.near_stops, *destination)
+            found = bool(sources) and bool(targets)
+            self.settled = None
+            result, routing = timed(self.routing, time, origin, destination, sources, targets) if found else ([], 0.0)
+            rows, path = timed(self.path, result)
+            for stage, seconds in [('near_stops', start_lookup + end_lookup), ('routing', routing), ('path', path)]:
+                samples.append({'engine': self.engine, 'pair': i, 'distance': distance, 'stage': stage,
+                                'seconds': seconds, 'found': found and len(rows) > 0,
+                                'settled': self.settled if stage == 'routing' else None})
+        return samples
+
+
+def summarize(samples, keys=('city', 'engine', 'stage')):
+    """Percentiles of the stage times grouped by keys, one dict per group."""
+    groups = {}
+    for sample in samples:
+        groups.setdefault(tuple(sample.get(key) for key in keys), []).append(sample)
+    summary = []
+    for group, rows in groups.items():
+        entry = dict(zip(keys, group))
+        entry.update({key: rows[0][key] for key in ('stops', 'routes', 'trips', 'stop_times') if key in rows[0]})
+        entry.update(percentiles([row['seconds'] for row in rows]))
+        found = [row['found'] for row in rows if row['found'] is not None]
+        if found:
+            entry['found'] = float(np.mean(found))
+        settled = [row['settled'] for row in rows if row.get('settled') is not None]
+        if settled:
+            entry['settled'] = float(np.mean(settled))
+        summary.append(entry)
+    return summary
+
+
+def compare_astar(summary):
+    """Routing of every '<engine>_astar' against '<engine>' in a summary: settled Stoptimes and p50 latency ratios."""
+    routing = {(entry['city'], entry['engine']): entry for entry in summary if entry['stage'] == 'routing'}
+    comparison = []
+    for (city, engine), astar in routing.items():
+        dijkstra = routing.get((city, engine[:-len('_astar')])) if engine.endswith('_astar') else None
+        if dijkstra is None or not dijkstra.get('p50'):
+            continue
+        entry = {'city': city, 'engine': engine[:-len('_astar')], 'p50_dijkstra': dijkstra['p50'],
+                 'p50_astar': astar['p50'], 'speedup': dijkstra['p50'] / astar['p50'] if astar['p50'] else None}
+        if 'settled' in dijkstra and 'settled' in astar:
+            entry.update(settled_dijkstra=dijkstra['settled'], settled_astar=astar['settled'],
+                         settled_ratio=astar['settled'] / dijkstra['settled'] if dijkstra['settled'] else None)
+        comparison.append(entry)
+    return comparison
+
+
+def write_results(samples, out_dir):
+    """samples.csv with every measure, summary.json and scaling.csv with the percentiles per city.
+
+    astar.json holds compare_astar(summary) when A* engines were run next to their Dijkstra counterpart.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    pd.DataFrame(samples).to_csv(os.path.join(out_dir, 'samples.csv'), index=False)
+    summary = summarize(samples)
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as file:
+        json.dump(summary, file, indent=2)
+    # Scaling curves: one row per network size and engine, one column per stage percentile
+    curves = {}
+    for entry in summary:
+        row = curves.setdefault((entry['city'], entry['engine']), {
+            key: entry.get(key) for key in ('city', 'engine', 'stops', 'routes', 'trips', 'stop_times')})
+        for p in PERCENTILES:
+            row['%s_p%d' % (entry['stage'], p)] = entry.get('p%d' % p)
+    rows = sorted(curves.values(), key=lambda row: (row['engine'], row['stop_times'] or 0))
+    fields = list(rows[0]) if rows else []
+    for row in rows:
+        fields += [key for key in row if key not in fields]
+    with open(os.path.join(out_dir, 'scaling.csv'), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    comparison = compare_astar(summary)
+    if comparison:
+        with open(os.path.join(out_dir, 'astar.json'), 'w') as file:
+            json.dump(comparison, file, indent=2)
+    return summary
+
+
+def run_benchmark(cities, engines, pairs=50, time='08:00:00', speed=1, radius=300, seed=0, driver=None):
+    """Time every engine of engines on every city of cities.
+
+    cities maps a name to (gtfs_path, date, parameters), parameters being
+    the dict returned by synthetic.generate_city or {} for a real feed.
+    Returns the list of samples, tagged with the city name and the size of
+    its service day.
+    """
+    samples = []
+    for name, (gtfs_path, date, size) in cities.items():
+        tt = Feed(gtfs_path).timetable(date)
+        active = tt.active_stops
+        # Size of the service day actually routed on
+        size = dict(size, stops=len(active), routes=len(tt.route_ids), trips=len(tt.trip_ids),
+                    stop_times=len(tt.st_stop))
+        city_pairs = od_pairs(tt.stop_lat[active], tt.stop_lon[active], pairs, seed=seed)
+        for engine in engines:
+            runner = StageRunner(engine, gtfs_path, date, speed, radius, driver=driver)
+            for sample in runner.run(city_pairs, time):
+                sample.update(size, city=name)
+                samples.append(sample)
+    return samples
@@ -0,0 +1,147 @@
+"""Synthetic GTFS cities for benchmarking.
+
+A city is a square grid of stop locations around the centre of Modena with a
+pair of stops per location, one per direction, sharing the same name as real
+stops do. Every route is a random walk across the grid, served in both
+directions from first_departure to last_departure every headway seconds.
+The files written are the ones read by new_dbSetup.py and timetable.py,
+including new_calendar_dates.txt.
+"""
+import csv
+import json
+import math
+import os
+import random
+
+import numpy as np
+
+from spatial import EARTH_RADIUS, haversine
+from timetable import time_to_seconds
+
+CENTRE = (44.6471, 10.9252)
+BUS_SPEED = 8.0
+DWELL = 20
+HEADINGS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+
+def _gtfs_time(seconds):
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def generate_city(path, stops=400, routes=20, route_length=20, headway=600, trips=None,
+                  first_departure='05:30:00', last_departure='22:30:00', stop_spacing=400,
+                  date='2024-01-18', seed=0):
+    """Write a synthetic GTFS feed into path and return its size.
+
+    stops is the number of stops (two per grid location, rounded up to even), route_length the
+    number of locations served by every route, headway the seconds between two
+    trips of a route in the same direction. trips, when given, overrides the
+    number of trips per route and direction otherwise derived from headway and
+    the first and last departures. All trips run on date and the following day.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+
+    side = max(2, math.ceil(math.sqrt(math.ceil(stops / 2))))
+    dlat = math.degrees(stop_spacing / EARTH_RADIUS)
+    dlon = dlat / math.cos(math.radians(CENTRE[0]))
+    locations = []
+    for i in range(math.ceil(stops / 2)):
+        x, y = i % side, i // side
+        locations.append((CENTRE[0] + (y - side / 2 + rng.uniform(-0.3, 0.3)) * dlat,
+                          CENTRE[1] + (x - side / 2 + rng.uniform(-0.3, 0.3)) * dlon))
+
+    # Stop 2 * location + direction, the opposite platform about 15 m away
+    platform = math.degrees(15 / EARTH_RADIUS)
+    with open(os.path.join(path, 'stops.txt'), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon'])
+        for i in range(2 * len(locations)):
+            lat, lon = locations[i // 2]
+            writer.writerow(['S%d' % i, i, 'STOP %d' % (i // 2), '%.7f' % (lat + platform * (i % 2)), '%.7f' % lon])
+
+    with open(os.path.join(path, 'agency.txt'), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['agency_id', 'agency_name', 'agency_url', 'agency_timezone'])
+        writer.writerow(['1', 'aMo Modena', 'https://www.amo.mo.it', 'Europe/Rome'])
+
+    start, end = time_to_seconds(first_departure), time_to_seconds(last_departure)
+    n_trips = trips if trips is not None else (end - start) // headway + 1
+    n_locations = len(locations)
+    n_stop_times = 0
+    with open(os.path.join(path, 'routes.txt'), 'w', newline='') as routes_file, \
+            open(os.path.join(path, 'trips.txt'), 'w', newline='') as trips_file, \
+            open(os.path.join(path, 'stop_times.txt'), 'w', newline='') as stop_times_file:
+        routes_writer, trips_writer = csv.writer(routes_file), csv.writer(trips_file)
+        stop_times_writer = csv.writer(stop_times_file)
+        routes_writer.writerow(['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'])
+        trips_writer.writerow(['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'])
+        stop_times_writer.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+
+        for route in range(routes):
+            # Random walk over the grid without revisiting a location, turning now and then
+            location = rng.randrange(n_locations)
+            walk, visited = [location], {location}
+            heading = None
+            while len(walk) < route_length:
+                moves = [(dx, dy) for dx, dy in HEADINGS
+                         if 0 <= location % side + dx < side and 0 <= location // side + dy < side
+                         and location + dy * side + dx < n_locations and location + dy * side + dx not in visited]
+                if not moves:
+                    break
+                if heading not in moves or rng.random() < 0.25:
+                    heading = rng.choice(moves)
+                location += heading[1] * side + heading[0]
+                walk.append(location)
+                visited.add(location)
+            hops = [int(stop_spacing / BUS_SPEED * rng.uniform(0.8, 1.4)) for _ in walk[1:]]
+            routes_writer.writerow(['R%d' % route, '1', str(route + 1), 'Line %d' % (route + 1), '3'])
+
+            for direction, sequence in enumerate([walk, walk[::-1]]):
+                durations = hops if direction == 0 else hops[::-1]
+                for k in range(n_trips):
+                    trip_id = 'R%d_%d_%d' % (route, direction, k)
+                    trips_writer.writerow(['R%d' % route, 'FERIALE', trip_id, 'STOP %d' % sequence[-1],
+                                           direction, 'SH%d_%d' % (route, direction)])
+                    t = start + k * headway + rng.randrange(0, max(headway // 4, 1))
+                    for position, location in enumerate(sequence):
+                        if position > 0:
+                            t += durations[position - 1]
+                        stop_times_writer.writerow([trip_id, _gtfs_time(t), _gtfs_time(t + DWELL),
+                                                    'S%d' % (2 * location + direction), position + 1])
+                        t += DWELL
+                    n_stop_times += len(sequence)
+
+    following_day = str(np.datetime64(date) + np.timedelta64(1, 'D'))
+    with open(os.path.join(path, 'new_calendar_dates.txt'), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['service_id', 'day', 'exception_type'])
+        writer.writerow(['FERIALE', date, 1])
+        writer.writerow(['FERIALE', following_day, 1])
+
+    size = {'stops': 2 * len(locations), 'routes': routes, 'trips': routes * 2 * n_trips, 'stop_times': n_stop_times,
+            'headway': headway, 'stop_spacing': stop_spacing, 'date': date, 'seed': seed}
+    with open(os.path.join(path, 'city.json'), 'w') as file:
+        json.dump(size, file, indent=2)
+    return size
+
+
+def od_pairs(stop_lat, stop_lon, n, min_distance=1000, jitter=100, seed=0):
+    """n random origin-destination pairs near the given stops.
+
+    Points are drawn within jitter meters of random stops, so that a near-stop
+    lookup finds something, and pairs closer than min_distance are rejected.
+    """
+    rng = np.random.default_rng(seed)
+    stop_lat, stop_lon = np.asarray(stop_lat), np.asarray(stop_lon)
+    deg = math.degrees(jitter / EARTH_RADIUS)
+    pairs = []
+    for _ in range(n * 100):
+        if len(pairs) == n:
+            break
+        i, j = rng.integers(len(stop_lat), size=2)
+        origin = (float(stop_lat[i] + rng.uniform(-deg, deg)), float(stop_lon[i] + rng.uniform(-deg, deg)))
+        destination = (float(stop_lat[j] + rng.uniform(-deg, deg)), float(stop_lon[j] + rng.uniform(-deg, deg)))
+        if haversine(*origin, *destination) >= min_distance:
+            pairs.append((origin, destination))
+    return pairs
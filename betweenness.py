@@ -0,0 +1,143 @@
+"""Stop importance maps from sampled betweenness on the routing projection.
+
+Exact betweenness runs one shortest-path search from every Stoptime of the
+day, which is impractical past small networks. Here gds.betweenness.stream
+runs from samplingSize sources only (the accuracy knob: a share of the
+nodes or an absolute count) and the scores are summed per stop and hour of
+departure inside the same statement, so one row per (stop, hour) crosses
+the wire instead of one per Stoptime. Sampled scores are multiplied by
+nodes / samplingSize to stay on the scale of the exact ones.
+
+The rows are either written back in batches as
+(:Stop)-[:BETWEENNESS_IN {hour, speed, score, stoptimes, sampling_size}]->(:Day)
+or saved to a compact file (.csv.gz, or .npz).
+
+    python betweenness.py 2024-01-18 --speed 1 --sampling-ratio 0.01 --out betweenness.csv.gz
+    python betweenness.py 2024-01-18 --sampling-size 2000 --seed 42 --write
+"""
+import argparse
+import math
+import timeit
+
+import numpy as np
+import pandas as pd
+from neo4j import GraphDatabase
+
+import queries
+from projections import ProjectionManager
+
+BATCH_SIZE = 1000
+COLUMNS = ['stop_id', 'stop_name', 'lat', 'lon', 'hour', 'score', 'stoptimes']
+
+
+def sampling_config(node_count, sampling_size=None, sampling_ratio=None, seed=None, concurrency=None):
+    """(gds.betweenness config, scale of the scores, sampling size); exact when neither size nor ratio is given."""
+    config = {}
+    if concurrency:
+        config['concurrency'] = concurrency
+    if sampling_ratio is not None:
+        sampling_size = max(1, math.ceil(node_count * sampling_ratio))
+    if sampling_size is None or sampling_size >= node_count:
+        return config, 1.0, node_count
+    config['samplingSize'] = int(sampling_size)
+    if seed is not None:
+        config['samplingSeed'] = int(seed)
+    return config, node_count / sampling_size, int(sampling_size)
+
+
+def stop_hour_scores(driver, graph_name, sampling_size=None, sampling_ratio=None, seed=None, concurrency=None):
+    """DataFrame of the betweenness summed per stop and hour, and the sampling size used."""
+    with driver.session() as session:
+        node_count = session.run(queries.METRICS, graph_name=graph_name).single()[0]
+        config, scale, size = sampling_config(node_count, sampling_size, sampling_ratio, seed, concurrency)
+        rows = session.run(queries.BETWEENNESS_BY_STOP_HOUR, graph_name=graph_name, config=config,
+                           scale=scale).values()
+    return pd.DataFrame(rows, columns=COLUMNS), size
+
+
+def _write_batch(tx, rows, date, speed, sampling_size):
+    tx.run(queries.BETWEENNESS_WRITE, rows=rows, date=date, speed=speed, sampling_size=sampling_size).consume()
+
+
+def write_scores(driver, frame, date, speed, sampling_size, batch_size=BATCH_SIZE):
+    """Store the rows of frame as BETWEENNESS_IN relationships of date, batch_size rows per transaction."""
+    rows = frame[['stop_id', 'hour', 'score', 'stoptimes']].to_dict('records')
+    for row in rows:
+        row['hour'], row['stoptimes'], row['score'] = int(row['hour']), int(row['stoptimes']), float(row['score'])
+    with driver.session() as session:
+        for start in range(0, len(rows), batch_size):
+            session.write_transaction(_write_batch, rows[start:start + batch_size], date, speed, sampling_size)
+    return len(rows)
+
+
+def read_scores(driver, date, speed):
+    """Rows written by write_scores for date and speed."""
+    with driver.session() as session:
+        rows = session.run(queries.BETWEENNESS_READ, date=date, speed=speed).values()
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def save_scores(frame, path):
+    """frame to path: .npz keeps the columns as arrays (stops, hours as int8, scores as float32), else CSV."""
+    if path.endswith('.npz'):
+        np.savez_compressed(path, stop_id=frame['stop_id'].to_numpy(dtype=str),
+                            stop_name=frame['stop_name'].to_numpy(dtype=str),
+                            lat=frame['lat'].to_numpy(dtype=np.float64), lon=frame['lon'].to_numpy(dtype=np.float64),
+                            hour=frame['hour'].to_numpy(dtype=np.int8), score=frame['score'].to_numpy(dtype=np.float32),
+                            stoptimes=frame['stoptimes'].to_numpy(dtype=np.int32))
+    else:
+        # Compression from the extension, e.g. .csv.gz
+        frame.to_csv(path, index=False)
+
+
+def load_scores(path):
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return pd.DataFrame({column: data[column] for column in COLUMNS})
+    return pd.read_csv(path, dtype={'stop_id': str})
+
+
+def stop_scores(frame):
+    """Whole-day importance of every stop, the hours summed, highest first."""
+    return (frame.groupby(['stop_id', 'stop_name', 'lat', 'lon'], as_index=False)[['score', 'stoptimes']].sum()
+            .sort_values('score', ascending=False, ignore_index=True))
+
+
+def run(driver, date, speed=1, sampling_size=None, sampling_ratio=None, seed=None, concurrency=None, write=False,
+        out=None, projections=None):
+    """Project (date, speed) if needed, score stops per hour, then write and/or save the rows."""
+    projections = projections or ProjectionManager(driver, prefetch_next_day=False)
+    graph_name = projections.get(date, speed)
+    frame, size = stop_hour_scores(driver, graph_name, sampling_size, sampling_ratio, seed, concurrency)
+    if write:
+        write_scores(driver, frame, date, speed, size)
+    if out:
+        save_scores(frame, out)
+    return frame, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('date')
+    parser.add_argument('--speed', type=float, default=1)
+    accuracy = parser.add_mutually_exclusive_group()
+    accuracy.add_argument('--sampling-size', type=int, help='source nodes of the sampled betweenness')
+    accuracy.add_argument('--sampling-ratio', type=float, help='share of the nodes used as sources, e.g. 0.01')
+    parser.add_argument('--seed', type=int, help='samplingSeed, for repeatable samples')
+    parser.add_argument('--concurrency', type=int)
+    parser.add_argument('--write', action='store_true', help='store the scores as BETWEENNESS_IN relationships')
+    parser.add_argument('--out', help='.csv, .csv.gz or .npz file for the scores')
+    parser.add_argument('--uri', default='neo4j://localhost:7687')
+    parser.add_argument('--user', default='neo4j')
+    parser.add_argument('--password', default='12345678')
+    args = parser.parse_args()
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
+    try:
+        start = timeit.default_timer()
+        frame, size = run(driver, args.date, speed, args.sampling_size, args.sampling_ratio, args.seed,
+                          args.concurrency, args.write, args.out)
+        print('%d (stop, hour) rows from %d sources in %.1f s' % (len(frame), size, timeit.default_timer() - start))
+        print(stop_scores(frame).head(20).to_string())
+    finally:
+        driver.close()
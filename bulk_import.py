@@ -0,0 +1,219 @@
+import csv
+import os
+import sys
+from collections import defaultdict
+
+from spatial import GridIndex
+from timetable import WALK_RADIUS, seconds_to_time, time_to_seconds
+
+# Alternativa offline a new_dbSetup.py per feed di grandi dimensioni.
+# Legge i file GTFS una sola volta, calcola in Python gli archi PRECEDES (con waiting_time),
+# WALK_TO (con una griglia spaziale invece del prodotto cartesiano tra Stop) e ACTIVE_IN,
+# e scrive i CSV di nodi e relazioni nel formato di "neo4j-admin database import":
+#   python bulk_import.py GTFS_DIR OUT_DIR            (scrive i CSV e stampa il comando di import)
+#   python bulk_import.py --schema                    (a database avviato: vincoli e indici)
+
+uri = "bolt://localhost:7687"
+username = "neo4j"
+password = "12345678"
+
+# Gli stessi vincoli e indici creati da new_dbSetup.py
+SCHEMA = [
+    "create constraint agency_unique if not exists for (a:Agency) require a.id is unique",
+    "create constraint route_unique if not exists for (r:Route) require r.id is unique",
+    "create constraint trip_unique if not exists for (t:Trip) require t.id is unique",
+    "create constraint stop_unique if not exists for (s:Stop) require s.id is unique",
+    "create constraint service_unique if not exists for (s:Service) require s.service_id is unique",
+    "create constraint day_unique if not exists for (d:Day) require d.day is unique",
+    "create index trip_service_index if not exists for (t:Trip) on (t.service_id)",
+    "create index stoptime_index if not exists for (s:Stoptime) on (s.stop_sequence)",
+    "create index stop_index if not exists for (s:Stop) on (s.name)",
+    "create point index stop_location_index if not exists for (s:Stop) on (s.location)",
+]
+
+NODES = {
+    'Agency': [':ID(Agency)', 'id', 'name', 'url', 'timezone'],
+    'Route': ['id:ID(Route)', 'short_name', 'long_name', 'type:int'],
+    'Trip': ['id:ID(Trip)', 'service_id', 'direction_id', 'shape_id', 'headsign'],
+    'Stop': ['id:ID(Stop)', 'name', 'lat:double', 'lon:double', 'location:point{crs:WGS-84}'],
+    'Stoptime': [':ID(Stoptime)', 'arrival_time:time', 'departure_time:time', 'arrival_seconds:int',
+                 'departure_seconds:int', 'stop_sequence:int'],
+    'Service': ['service_id:ID(Service)'],
+    'Day': [':ID(Day)', 'day:date', 'exception_type'],
+}
+
+RELATIONSHIPS = {
+    'OPERATES': [':START_ID(Agency)', ':END_ID(Route)'],
+    'USES': [':START_ID(Trip)', ':END_ID(Route)'],
+    'PART_OF_TRIP': [':START_ID(Stoptime)', ':END_ID(Trip)'],
+    'LOCATED_AT': [':START_ID(Stoptime)', ':END_ID(Stop)'],
+    'PRECEDES': [':START_ID(Stoptime)', ':END_ID(Stoptime)', 'waiting_time:int'],
+    'SERVICE_TYPE': [':START_ID(Trip)', ':END_ID(Service)'],
+    'VALID_IN': [':START_ID(Service)', ':END_ID(Day)'],
+    'ACTIVE_IN': [':START_ID(Stop)', ':END_ID(Day)'],
+    'WALK_TO': [':START_ID(Stop)', ':END_ID(Stop)', 'distance:double'],
+}
+
+
+def _read(gtfs_path, name):
+    with open(os.path.join(gtfs_path, name), newline='', encoding='utf-8-sig') as file:
+        yield from csv.DictReader(file)
+
+
+def _gtfs_time(value):
+    """Orario GTFS come time di Neo4j: gli orari oltre le 24 tornano nel giorno."""
+    return seconds_to_time(time_to_seconds(value)).isoformat()
+
+
+class _Writers:
+    """Un csv.writer per ogni file di nodi e relazioni, con l'intestazione di neo4j-admin."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.files, self.writers, self.counts = {}, {}, defaultdict(int)
+        for kind, headers in (('nodes', NODES), ('relationships', RELATIONSHIPS)):
+            os.makedirs(os.path.join(out_dir, kind), exist_ok=True)
+            for name, header in headers.items():
+                self.files[name] = open(os.path.join(out_dir, kind, name + '.csv'), 'w', newline='')
+                self.writers[name] = csv.writer(self.files[name])
+                self.writers[name].writerow(header)
+
+    def write(self, name, *row):
+        self.writers[name].writerow(row)
+        self.counts[name] += 1
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def export_gtfs(gtfs_path, out_dir, walk_radius=WALK_RADIUS):
+    """Scrive in out_dir/nodes e out_dir/relationships i CSV del grafo costruito da new_dbSetup.py.
+
+    stop_times.txt viene letto in streaming: le righe di un trip devono essere
+    contigue, come nei feed GTFS esportati normalmente. Restituisce il numero
+    di righe scritte per ogni file.
+    """
+    out = _Writers(out_dir)
+    try:
+        agencies = list(_read(gtfs_path, 'agency.txt'))
+        for i, row in enumerate(agencies):
+            out.write('Agency', i, row.get('agency_id', ''), row['agency_name'], row['agency_url'],
+                      row['agency_timezone'])
+        agency_index = {row.get('agency_id', ''): i for i, row in enumerate(agencies)}
+
+        routes = set()
+        for row in _read(gtfs_path, 'routes.txt'):
+            routes.add(row['route_id'])
+            out.write('Route', row['route_id'], row.get('route_short_name', ''), row.get('route_long_name', ''),
+                      row['route_type'])
+            # Feed con una sola agenzia: agency_id può mancare
+            out.write('OPERATES', agency_index.get(row.get('agency_id', ''), 0), row['route_id'])
+
+        calendar = defaultdict(dict)
+        for row in _read(gtfs_path, 'new_calendar_dates.txt'):
+            calendar[row['service_id']][row['day']] = row['exception_type']
+        days = {}
+        for service, service_days in calendar.items():
+            out.write('Service', service)
+            for day, exception_type in service_days.items():
+                days[day] = exception_type
+                out.write('VALID_IN', service, day)
+        for day, exception_type in days.items():
+            out.write('Day', day, day, exception_type)
+
+        trip_service = {}
+        for row in _read(gtfs_path, 'trips.txt'):
+            if row['route_id'] not in routes:
+                continue
+            trip_service[row['trip_id']] = row['service_id']
+            out.write('Trip', row['trip_id'], row['service_id'], row.get('direction_id', ''),
+                      row.get('shape_id', ''), row.get('trip_headsign', ''))
+            out.write('USES', row['trip_id'], row['route_id'])
+            if row['service_id'] in calendar:
+                out.write('SERVICE_TYPE', row['trip_id'], row['service_id'])
+
+        stops = list(_read(gtfs_path, 'stops.txt'))
+        stop_ids = set()
+        for row in stops:
+            stop_ids.add(row['stop_id'])
+            out.write('Stop', row['stop_id'], row['stop_name'], row['stop_lat'], row['stop_lon'],
+                      '{latitude:%s, longitude:%s}' % (row['stop_lat'], row['stop_lon']))
+
+        # Stoptime e PRECEDES, un trip alla volta
+        service_stops = defaultdict(set)
+        done, current, pending = set(), None, []
+
+        def flush():
+            pending.sort()
+            for (_, id1, _, departure), (_, id2, arrival, _) in zip(pending, pending[1:]):
+                out.write('PRECEDES', id1, id2, arrival - departure)
+            pending.clear()
+
+        for i, row in enumerate(_read(gtfs_path, 'stop_times.txt')):
+            trip = row['trip_id']
+            if trip not in trip_service or row['stop_id'] not in stop_ids:
+                continue
+            if trip != current:
+                if trip in done:
+                    raise ValueError('stop_times.txt: le righe del trip %s non sono contigue' % trip)
+                flush()
+                if current is not None:
+                    done.add(current)
+                current = trip
+            out.write('Stoptime', i, _gtfs_time(row['arrival_time']), _gtfs_time(row['departure_time']),
+                      time_to_seconds(row['arrival_time']), time_to_seconds(row['departure_time']),
+                      row['stop_sequence'])
+            out.write('PART_OF_TRIP', i, trip)
+            out.write('LOCATED_AT', i, row['stop_id'])
+            pending.append((int(row['stop_sequence']), i, time_to_seconds(row['arrival_time']),
+                            time_to_seconds(row['departure_time'])))
+            service_stops[trip_service[trip]].add(row['stop_id'])
+        flush()
+
+        active = set()
+        for service, served in service_stops.items():
+            for day in calendar.get(service, ()):
+                active.update((stop, day) for stop in served)
+        for stop, day in sorted(active):
+            out.write('ACTIVE_IN', stop, day)
+
+        # WALK_TO: coppie di Stop a meno di walk_radius metri, self-loop compresi come in new_dbSetup.py
+        index = GridIndex([float(row['stop_lat']) for row in stops], [float(row['stop_lon']) for row in stops],
+                          walk_radius)
+        indptr, indices, distances = index.pairs_within(walk_radius)
+        for i, row in enumerate(stops):
+            for j, distance in zip(indices[indptr[i]:indptr[i + 1]], distances[indptr[i]:indptr[i + 1]]):
+                out.write('WALK_TO', row['stop_id'], stops[j]['stop_id'], '%.3f' % distance)
+    finally:
+        out.close()
+    return dict(out.counts)
+
+
+def import_command(out_dir, database='neo4j'):
+    """Comando neo4j-admin che importa i CSV scritti da export_gtfs."""
+    args = ['neo4j-admin database import full', database, '--overwrite-destination']
+    args += ['--nodes=%s=%s' % (name, os.path.join(out_dir, 'nodes', name + '.csv')) for name in NODES]
+    args += ['--relationships=%s=%s' % (name, os.path.join(out_dir, 'relationships', name + '.csv'))
+             for name in RELATIONSHIPS]
+    return ' \\\n    '.join(args)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--schema']:
+        from neo4j import GraphDatabase
+
+        driver = GraphDatabase.driver(uri, auth=(username, password))
+        with driver.session() as session:
+            print('Connessione stabilita')
+            for statement in SCHEMA:
+                session.run(statement).consume()
+        driver.close()
+        print('Constraint e indici creati...')
+    else:
+        gtfs_path, out_dir = sys.argv[1], sys.argv[2]
+        counts = export_gtfs(gtfs_path, out_dir)
+        for name, count in counts.items():
+            print(f'{name}: {count} righe')
+        print('CSV scritti, da importare a database fermo con:')
+        print(import_command(out_dir))
@@ -0,0 +1,181 @@
+"""Result cache in front of the App routing methods.
+
+Repeated corridors within minutes make most routing requests identical once
+departures are rounded up to a time bucket and origin and destination are
+reduced to their candidate stop sets. Results are computed from the rounded
+time, so an itinerary served from the cache never leaves before the time
+asked for. ResultCache keeps them in memory, bounded by entry count and
+pickled size, least recently used first and with a time to live; with path
+set, results are also written to a local sqlite file and survive restarts.
+Writes are committed in batches, every commit_every results or
+commit_interval seconds, and on flush() and close().
+
+Keys carry the day and the version of the projection (or timetable) that
+computed the result, so dropping a projection or applying real-time updates
+is enough to stop serving older results; invalidate(date) removes them.
+"""
+import pickle
+import sqlite3
+import threading
+import time as clock
+from collections import OrderedDict
+
+from timetable import time_to_seconds
+
+
+def _key_part(value):
+    """Hashable, order-independent and repr-stable form of a key component."""
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return tuple(sorted(str(item) for item in value))
+    return value
+
+
+class ResultCache:
+    """LRU and TTL cache of query results, optionally backed by a sqlite file."""
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 2 ** 20, ttl=600, time_bucket=60, coordinate_digits=4,
+                 path=None, commit_every=100, commit_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Seconds an entry is served after it was computed, None for no expiry
+        self.ttl = ttl
+        self.time_bucket = time_bucket
+        # Coordinates are rounded to this many decimals (4: about 10 m) in near-stop keys
+        self.coordinate_digits = coordinate_digits
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # Results written to sqlite since the last commit, and when that was
+        self._uncommitted = 0
+        self._committed = clock.time()
+        # Key -> (date, expires, pickled value), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('create table if not exists results '
+                             '(key text primary key, date text, expires real, value blob)')
+            self._db.execute('create index if not exists results_date on results (date)')
+            self._db.commit()
+            # On disk entries are bounded by their time to live: drop what expired while stopped
+            self.purge()
+
+    def bucket(self, time):
+        """'HH:MM:SS' rounded up to the time bucket; hours past 24 stay, as in GTFS."""
+        seconds = time_to_seconds(time)
+        seconds += -seconds % self.time_bucket
+        return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    def point(self, lat, lon):
+        return round(float(lat), self.coordinate_digits), round(float(lon), self.coordinate_digits)
+
+    def key(self, kind, date, *parts):
+        return repr((kind, date) + tuple(_key_part(part) for part in parts))
+
+    def _expires(self):
+        return clock.time() + self.ttl if self.ttl is not None else None
+
+    def get(self, key):
+        """(True, value) for a live entry, (False, None) otherwise."""
+        now = clock.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, pickle.loads(entry[2])
+                self._remove(key)
+            if self._db is not None:
+                row = self._db.execute('select date, expires, value from results where key = ?', (key,)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    self._store(key, row[0], row[1], row[2])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return True, pickle.loads(row[2])
+            self.misses += 1
+            return False, None
+
+    def put(self, key, date, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._expires()
+        with self._lock:
+            self._store(key, date, expires, data)
+            if self._db is not None:
+                self._db.execute('insert or replace into results values (?, ?, ?, ?)', (key, date, expires, data))
+                self._uncommitted += 1
+                if (self._uncommitted >= self.commit_every
+                        or clock.time() - self._committed >= self.commit_interval):
+                    self.flush()
+
+    def flush(self):
+        """Commit the results written to sqlite since the last commit."""
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+            self._uncommitted = 0
+            self._committed = clock.time()
+
+    def get_or_compute(self, key, date, compute):
+        found, value = self.get(key)
+        if not found:
+            value = compute()
+            self.put(key, date, value)
+        return value
+
+    def _store(self, key, date, expires, data):
+        self._remove(key)
+        self._entries[key] = (date, expires, data)
+        self._bytes += len(data)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+
+    def invalidate(self, date=None):
+        """Forget the results of date (or of an iterable of dates), or every result."""
+        dates = None if date is None else {date} if isinstance(date, str) else set(date)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if dates is None or entry[0] in dates:
+                    self._remove(key)
+            if self._db is not None:
+                if dates is None:
+                    self._db.execute('delete from results')
+                else:
+                    self._db.executemany('delete from results where date = ?', [(day,) for day in dates])
+                self.flush()
+
+    def purge(self):
+        """Drop the expired entries, in memory and on disk."""
+        now = clock.time()
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[1] is not None and entry[1] <= now:
+                    self._remove(key)
+            if self._db is not None:
+                self._db.execute('delete from results where expires is not null and expires <= ?', (now,))
+                self.flush()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                     'hit_ratio': self.hits / lookups if lookups else 0.0, 'evictions': self.evictions,
+                     'entries': len(self._entries), 'bytes': self._bytes}
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute('select count(*) from results').fetchone()[0]
+            return stats
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,59 @@
+from neo4j import GraphDatabase
+import sys
+
+# Materializza gli archi CHANGE che routing_graph_creation calcolava ad ogni proiezione.
+# Va eseguito dopo new_dbSetup.py, una volta per ogni velocità di camminata usata:
+#   python changes_setup.py 1                    (tutti i Day)
+#   python changes_setup.py 1 2024-01-18 ...     (solo i giorni indicati)
+
+uri = "bolt://localhost:7687"
+username = "neo4j"
+password = "12345678"
+
+# Stessa logica della query di proiezione: per ogni Stoptime sorgente e per ogni altra linea
+# raggiungibile a piedi tramite WALK_TO si tiene solo la prima partenza utile.
+CHANGE_QUERY = """CALL apoc.periodic.iterate(
+        "match (d:Day {day: date($day)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime) return d, ser, t, st",
+        "match (st)-[:LOCATED_AT]->(stops:Stop) match (r:Route)<-[:USES]-(t)
+         with d, st as source, ser as service, t.id as trip_source, stops, r.id as line
+         match (service)<-[:SERVICE_TYPE]-(t2:Trip)<-[:PART_OF_TRIP]-(st2:Stoptime)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops)
+         where t2.id <> trip_source and source.arrival_seconds + toInteger(w.distance / $speed) < st2.departure_seconds
+         match (t2)-[:USES]->(r2:Route) where r2.id <> line
+         with d, source, r2.id as other_line, w.distance as walking_distance, apoc.agg.minItems(st2, st2.departure_seconds).items as targets
+         unwind targets as target
+         with d, source, target, toInteger(walking_distance / $speed) as walking_time
+         create (source)-[:CHANGE {day: d.day, speed: $speed,
+                                   waiting_time: target.departure_seconds - source.arrival_seconds + walking_time,
+                                   walking_time: walking_time}]->(target)",
+        {batchSize: 1000, parallel: true, retries: 5, params: {day: $day, speed: $speed}})
+        YIELD batches, total, failedBatches
+        RETURN batches, total, failedBatches"""
+
+DELETE_QUERY = """CALL apoc.periodic.iterate(
+        "match ()-[c:CHANGE]->() where c.day = date($day) and c.speed = $speed return c",
+        "delete c",
+        {batchSize: 10000, params: {day: $day, speed: $speed}})"""
+
+
+def materialize_changes(driver, day, speed):
+    """(Ri)crea gli archi CHANGE di un giorno per una velocità di camminata, in batch paralleli."""
+    with driver.session() as session:
+        session.run(DELETE_QUERY, day=day, speed=speed).consume()
+        return session.run(CHANGE_QUERY, day=day, speed=speed).single()
+
+
+if __name__ == '__main__':
+    speed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    driver = GraphDatabase.driver(uri, auth=(username, password))
+
+    with driver.session() as session:
+        print('Connessione stabilita')
+        session.run("create index change_index if not exists for ()-[c:CHANGE]-() on (c.day, c.speed)")
+        days = sys.argv[2:] or [str(day) for day in session.run("match (d:Day) return d.day order by d.day").value()]
+
+    for day in days:
+        batches, total, failed = materialize_changes(driver, day, speed)
+        print(f"Archi CHANGE del {day} (velocità {speed} m/s): {total} Stoptime sorgenti, {batches} batch, {failed} falliti")
+
+    driver.close()
+    print('Archi CHANGE materializzati correttamente')
@@ -0,0 +1,167 @@
+"""Connection Scan Algorithm over the in-memory Timetable.
+
+Answers the same earliest-arrival question as App._routing without touching
+Neo4j: the PRECEDES edges of the day are scanned once in departure order and
+WALK_TO footpaths play the role of the CHANGE edges of the graph_walk
+projection.
+"""
+import numpy as np
+import pandas as pd
+
+from raptor import count_changes
+from timetable import seconds_to_time, time_to_seconds
+
+INF = np.iinfo(np.int32).max
+
+
+class Labels:
+    """Result of a scan: earliest arrivals and the legs producing them.
+
+    arrival is the earliest time each stop can be reached, walking included;
+    ride_arrival only counts getting off a vehicle there, which is what a
+    destination needs. Legs are (board Stoptime, alight Stoptime) pairs.
+    """
+
+    def __init__(self, n_stops):
+        self.arrival = np.full(n_stops, INF, dtype=np.int64)
+        self.leg_board = np.full(n_stops, -1, dtype=np.int64)
+        self.leg_alight = np.full(n_stops, -1, dtype=np.int64)
+        self.ride_arrival = np.full(n_stops, INF, dtype=np.int64)
+        self.ride_board = np.full(n_stops, -1, dtype=np.int64)
+        self.ride_alight = np.full(n_stops, -1, dtype=np.int64)
+
+    def legs(self, tt, last_leg):
+        """Legs of the journey ending with last_leg, in travel order."""
+        legs = [last_leg]
+        stop = tt.st_stop[last_leg[0]]
+        while self.leg_board[stop] >= 0 and len(legs) < len(tt.trip_ids):
+            legs.append((self.leg_board[stop], self.leg_alight[stop]))
+            stop = tt.st_stop[self.leg_board[stop]]
+        legs.reverse()
+        return legs
+
+    def best_arrival(self, targets):
+        """(arrival plus egress, last leg) at the best target stop, (INF, None) if none is reached."""
+        best, best_leg = INF, None
+        for stop, walk in targets.items():
+            if self.ride_arrival[stop] + walk < best:
+                best = int(self.ride_arrival[stop] + walk)
+                best_leg = (self.ride_board[stop], self.ride_alight[stop])
+        return best, best_leg
+
+
+class ConnectionScan:
+    """Earliest-arrival routing on the Timetables of a Feed."""
+
+    def __init__(self, feed):
+        self.feed = feed
+
+    def routing(self, date, speed, time, source, target, max_duration=4):
+        """Earliest arrival from the stop named source to the stop named target.
+
+        Returns the rows of App._routing: one per PRECEDES step of the ridden
+        trips and one per change between two trips.
+        """
+        tt = self.feed.timetable(date)
+        departure = time_to_seconds(time)
+        sources = {stop: 0 for stop in tt.stops_by_name(source)}
+        targets = {stop: 0 for stop in tt.stops_by_name(target)}
+        journey = self.scan(tt, speed, departure, sources, targets, departure + max_duration * 3600)
+        return tt.itinerary(journey)
+
+    def route_many(self, date, speed, time, od_pairs, radius=300, max_duration=4):
+        """Route every ((start_lat, start_lon), (end_lat, end_lon)) pair of od_pairs.
+
+        Pairs sharing an origin share one scan to all stops: only the egress
+        from the candidate stops around each destination differs. Returns a
+        DataFrame with one row per pair, in the order of od_pairs; cost is the
+        door-to-door time in seconds, walking included.
+        """
+        tt = self.feed.timetable(date)
+        departure = time_to_seconds(time)
+        endtime = departure + max_duration * 3600
+        ends = {}
+
+        def candidates(point):
+            if point not in ends:
+                stops, distances = tt.near_stops(point[0], point[1], radius)
+                ends[point] = {int(stop): int(distance / speed) for stop, distance in zip(stops, distances)}
+            return ends[point]
+
+        origins = {}
+        for i, (origin, destination) in enumerate(od_pairs):
+            origins.setdefault(tuple(origin), []).append((i, tuple(destination)))
+        rows = [None] * len(od_pairs)
+        for origin, pairs in origins.items():
+            access = candidates(origin)
+            labels = self.labels(tt, speed, departure, access, endtime)
+            for i, destination in pairs:
+                arrival, last_leg = labels.best_arrival(candidates(destination))
+                if last_leg is None:
+                    rows[i] = [*origin, *destination, None, None, None, None]
+                    continue
+                legs = labels.legs(tt, last_leg)
+                start = int(tt.st_departure[legs[0][0]]) - access[int(tt.st_stop[legs[0][0]])]
+                lines = [tt.route_ids[tt.trip_route[tt.st_trip[board]]] for board, _ in legs]
+                rows[i] = [*origin, *destination, seconds_to_time(start), seconds_to_time(arrival),
+                           arrival - start, count_changes(lines)]
+        return pd.DataFrame(rows, columns=['start_lat', 'start_lon', 'end_lat', 'end_lon',
+                                           'departure', 'arrival', 'cost', 'changes'])
+
+    @classmethod
+    def scan(cls, tt, speed, departure, sources, targets, endtime):
+        """Run one scan from several source stops to several target stops.
+
+        sources and targets map stop indices to the walking seconds needed to
+        reach them from the origin and to leave them towards the destination.
+        Returns the list of ridden legs as (board Stoptime, alight Stoptime).
+        """
+        labels = cls.labels(tt, speed, departure, sources, endtime, targets)
+        _, best_leg = labels.best_arrival(targets)
+        return labels.legs(tt, best_leg) if best_leg is not None else []
+
+    @staticmethod
+    def labels(tt, speed, departure, sources, endtime, targets=None):
+        """Scan the connections leaving after departure and before endtime.
+
+        Without targets every stop gets its earliest arrival (one-to-all);
+        with targets the scan stops as soon as no later connection can
+        improve the best arrival at one of them.
+        """
+        labels = Labels(len(tt.stop_ids))
+        arrival, leg_board, leg_alight = labels.arrival, labels.leg_board, labels.leg_alight
+        boarded = np.full(len(tt.trip_ids), -1, dtype=np.int64)
+        for stop, walk in sources.items():
+            arrival[stop] = departure + walk
+
+        connections = tt.connections
+        st_departure, st_arrival, st_stop, st_trip = tt.st_departure, tt.st_arrival, tt.st_stop, tt.st_trip
+        targets = targets or {}
+        best = INF
+        start = np.searchsorted(st_departure[connections], departure, side='right')
+        for st in connections[start:]:
+            dep = st_departure[st]
+            if dep >= best or dep >= endtime:
+                break
+            trip = st_trip[st]
+            if boarded[trip] < 0:
+                if arrival[st_stop[st]] >= dep:
+                    continue
+                boarded[trip] = st
+            arr = st_arrival[st + 1]
+            stop = st_stop[st + 1]
+            if arr < labels.ride_arrival[stop]:
+                labels.ride_arrival[stop] = arr
+                labels.ride_board[stop], labels.ride_alight[stop] = boarded[trip], st + 1
+                if stop in targets:
+                    best = min(best, arr + targets[stop])
+            if arr < arrival[stop]:
+                arrival[stop] = arr
+                leg_board[stop], leg_alight[stop] = boarded[trip], st + 1
+                neighbours, distances = tt.footpaths(stop)
+                for neighbour, distance in zip(neighbours, distances):
+                    walked = arr + int(distance / speed)
+                    if neighbour != stop and walked < arrival[neighbour]:
+                        arrival[neighbour] = walked
+                        leg_board[neighbour], leg_alight[neighbour] = boarded[trip], st + 1
+        return labels
@@ -0,0 +1,236 @@
+"""One multi-source, multi-target search per point-to-point query.
+
+ROUTING_BETWEEN_POINTS calls gds.shortestPath.dijkstra once for every pair
+of (departure at a start stop, later Stoptime at an end stop) and keeps one
+result. Here the routing projection of a (date, speed), a time-expanded
+graph of Stoptimes joined by PRECEDES and CHANGE, is copied out of GDS once
+as CSR arrays. A query then runs a single Dijkstra seeded with every
+departure at the start stops, each offset by its walking access, and stops
+as soon as no unsettled Stoptime can beat the best target reached, egress
+walking included.
+
+Labels are the times of the Stoptimes themselves (arrival when reached on
+board, departure when reached by a CHANGE), so they grow along every edge
+and the first settled target is the earliest arrival; cost, the sum of the
+waiting_time weights plus the walks, breaks ties as in the Cypher query.
+
+With heuristic=True the search is an A*: Stoptimes are settled by their
+arrival plus the great-circle distance to the end point over the fastest
+speed of the day (vehicle_speed, or walking when faster), a lower bound of
+any final time through them, so fewer Stoptimes far from the destination
+are settled before the best target. settled counts them after each search.
+"""
+import heapq
+
+import numpy as np
+
+import queries
+from projections import MIN_HOP
+from spatial import haversine
+
+
+class ExpandedGraph:
+    """The routing projection of one (date, speed) as arrays, indexed by position in node_ids."""
+
+    def __init__(self, node_ids, departure, arrival, names, lat, lon, indptr, indices, weight, ride):
+        self.node_ids = node_ids
+        self.departure, self.arrival = departure, arrival
+        self.names, self.lat, self.lon = names, lat, lon
+        self.indptr, self.indices, self.weight, self.ride = indptr, indices, weight, ride
+        self._vehicle_speed = None
+        # Stoptimes settled by the last search
+        self.settled = 0
+
+    @classmethod
+    def from_projection(cls, driver, graph_name, date):
+        with driver.session() as session:
+            nodes = session.run(queries.EXPANDED_NODES, date=date).values()
+            edges = session.run(queries.EXPANDED_EDGES, graph_name=graph_name).values()
+        nodes.sort(key=lambda node: node[0])
+        node_ids = np.array([node[0] for node in nodes], dtype=np.int64)
+        source = np.searchsorted(node_ids, np.array([edge[0] for edge in edges], dtype=np.int64))
+        target = np.searchsorted(node_ids, np.array([edge[1] for edge in edges], dtype=np.int64))
+        order = np.argsort(source, kind='stable')
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids,
+                   np.array([node[1] for node in nodes], dtype=np.int64),
+                   np.array([node[2] for node in nodes], dtype=np.int64),
+                   np.array([node[3] for node in nodes], dtype=str),
+                   np.array([node[4] for node in nodes], dtype=np.float64),
+                   np.array([node[5] for node in nodes], dtype=np.float64),
+                   indptr, target[order],
+                   np.array([edge[3] for edge in edges], dtype=np.float64)[order],
+                   np.array([edge[2] for edge in edges], dtype=bool)[order])
+
+    @classmethod
+    def from_timetable(cls, tt, speed):
+        """The graph PROJECTION builds for (tt.date, speed), from a Timetable; node ids are Stoptime indices.
+
+        PRECEDES joins consecutive Stoptimes of a trip; a Stoptime changes to
+        the first departure of every other route at each WALK_TO neighbour,
+        leaving after its arrival plus the walk.
+        """
+        n_stoptimes = len(tt.st_stop)
+        st_route = tt.trip_route[tt.st_trip]
+        by_stop = np.lexsort((tt.st_departure, tt.st_stop))
+        stop_indptr = np.searchsorted(tt.st_stop[by_stop], np.arange(len(tt.stop_ids) + 1))
+        stop_routes = [set(st_route[by_stop[a:b]].tolist()) for a, b in zip(stop_indptr[:-1], stop_indptr[1:])]
+        rides = np.ones(n_stoptimes, dtype=bool)
+        rides[tt.trip_offsets[1:] - 1] = False
+        rides = np.flatnonzero(rides)
+        changes = []
+        for st in range(n_stoptimes):
+            arrival, trip, line = tt.st_arrival[st], tt.st_trip[st], st_route[st]
+            for stop, distance in zip(*tt.footpaths(tt.st_stop[st])):
+                walk = int(distance / speed)
+                start, end = stop_indptr[stop], stop_indptr[stop + 1]
+                first = start + np.searchsorted(tt.st_departure[by_stop[start:end]], arrival + walk, side='right')
+                lines = stop_routes[stop] - {line}
+                for other in by_stop[first:end]:
+                    if not lines:
+                        break
+                    if st_route[other] in lines and tt.st_trip[other] != trip:
+                        lines.discard(st_route[other])
+                        changes.append((st, other, tt.st_departure[other] - arrival + walk))
+        changes = np.array(changes, dtype=np.int64).reshape(-1, 3)
+        source = np.concatenate([rides, changes[:, 0]])
+        target = np.concatenate([rides + 1, changes[:, 1]])
+        weight = np.concatenate([tt.st_arrival[rides + 1] - tt.st_departure[rides], changes[:, 2]]).astype(np.float64)
+        is_ride = np.arange(len(source)) < len(rides)
+        order = np.argsort(source, kind='stable')
+        indptr = np.zeros(n_stoptimes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=n_stoptimes), out=indptr[1:])
+        stops = tt.st_stop
+        return cls(np.arange(n_stoptimes, dtype=np.int64), tt.st_departure.astype(np.int64),
+                   tt.st_arrival.astype(np.int64), np.asarray(tt.stop_names)[stops], tt.stop_lat[stops],
+                   tt.stop_lon[stops], indptr, target[order], weight[order], is_ride[order])
+
+    @classmethod
+    def concatenate(cls, graphs, offsets, links=()):
+        """graphs as one graph, the times of each shifted by its offset in seconds (window.py).
+
+        links are (i, j, source ids, target ids, waiting_time) CHANGE edges
+        from Stoptimes of graphs[i] to Stoptimes of graphs[j]; the ids missing
+        from either graph are skipped. A Stoptime running in several graphs
+        is a node of each, so node_ids may repeat.
+        """
+        starts = np.cumsum([0] + [len(graph.node_ids) for graph in graphs])
+        sources, targets, weights, rides = [], [], [], []
+        for start, graph in zip(starts, graphs):
+            sources.append(start + np.repeat(np.arange(len(graph.node_ids)), np.diff(graph.indptr)))
+            targets.append(start + graph.indices)
+            weights.append(graph.weight)
+            rides.append(graph.ride)
+        for i, j, source_ids, target_ids, weight in links:
+            source = _positions(graphs[i].node_ids, source_ids)
+            target = _positions(graphs[j].node_ids, target_ids)
+            known = (source >= 0) & (target >= 0)
+            sources.append(starts[i] + source[known])
+            targets.append(starts[j] + target[known])
+            weights.append(np.asarray(weight, dtype=np.float64)[known])
+            rides.append(np.zeros(known.sum(), dtype=bool))
+        source, target = np.concatenate(sources), np.concatenate(targets)
+        order = np.argsort(source, kind='stable')
+        indptr = np.zeros(starts[-1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=starts[-1]), out=indptr[1:])
+        return cls(np.concatenate([graph.node_ids for graph in graphs]),
+                   np.concatenate([graph.departure + offset for graph, offset in zip(graphs, offsets)]),
+                   np.concatenate([graph.arrival + offset for graph, offset in zip(graphs, offsets)]),
+                   np.concatenate([graph.names for graph in graphs]),
+                   np.concatenate([graph.lat for graph in graphs]), np.concatenate([graph.lon for graph in graphs]),
+                   indptr, target[order], np.concatenate(weights)[order], np.concatenate(rides)[order])
+
+    def vehicle_speed(self):
+        """Fastest ride of the graph in m/s, straight-line distance over waiting_time of the PRECEDES edges.
+
+        A waiting_time of 0 counts as MIN_HOP, as in queries.MAX_VEHICLE_SPEED;
+        raises ValueError when there is no ride or a ride between stops
+        without coordinates.
+        """
+        if self._vehicle_speed is None:
+            source = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+            if not self.ride.any():
+                raise ValueError('no ride to take the vehicle speed from')
+            distance = haversine(self.lat[source[self.ride]], self.lon[source[self.ride]],
+                                 self.lat[self.indices[self.ride]], self.lon[self.indices[self.ride]])
+            if np.isnan(distance).any():
+                raise ValueError('%d rides between stops without coordinates' % np.isnan(distance).sum())
+            seconds = self.weight[self.ride]
+            self._vehicle_speed = float((distance / np.where(seconds > 0, seconds, MIN_HOP)).max())
+        return self._vehicle_speed
+
+    @property
+    def nbytes(self):
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def search(self, start_lat, start_lon, end_lat, end_lon, start_names, end_names, speed, time, endtime,
+               heuristic=False):
+        """Best path from the start stops to the end stops, leaving after time and arriving before endtime.
+
+        time and endtime are seconds after midnight (of the first day of a
+        window, so past 86400 for the next one); heuristic=True runs A*
+        instead of Dijkstra. Returns (node positions of the path, final time
+        at the end point, cost) or None.
+        """
+        access = haversine(self.lat, self.lon, start_lat, start_lon) / speed
+        egress = haversine(self.lat, self.lon, end_lat, end_lon) / speed
+        seeds = np.flatnonzero(np.isin(self.names, list(start_names)) & (self.departure - access > time))
+        is_target = np.isin(self.names, list(end_names)) & (self.departure + egress < endtime)
+        if heuristic:
+            # Leaving a Stoptime, by its trip or by a CHANGE, happens after its arrival: with the
+            # fastest way to cover the rest of the distance, a lower bound of every final time through it
+            bound = self.arrival + np.floor(egress * speed / max(self.vehicle_speed(), speed)).astype(np.int64)
+
+        label = np.full(len(self.node_ids), np.iinfo(np.int64).max, dtype=np.int64)
+        cost = np.full(len(self.node_ids), np.inf)
+        previous = np.full(len(self.node_ids), -1, dtype=np.int64)
+        heap = []
+        for seed in seeds:
+            label[seed], cost[seed] = self.departure[seed], access[seed]
+            key = int(bound[seed]) if heuristic else int(label[seed])
+            heap.append((key, int(label[seed]), float(cost[seed]), int(seed)))
+        heapq.heapify(heap)
+
+        best, best_cost, best_node = np.inf, np.inf, -1
+        settled = 0
+        while heap:
+            key, node_label, node_cost, node = heapq.heappop(heap)
+            if key >= best:
+                break
+            if node_label > label[node] or (node_label == label[node] and node_cost > cost[node]):
+                continue
+            settled += 1
+            for edge in range(self.indptr[node], self.indptr[node + 1]):
+                other = self.indices[edge]
+                other_label = int(self.arrival[other] if self.ride[edge] else self.departure[other])
+                other_cost = node_cost + self.weight[edge]
+                if other_label < label[other] or (other_label == label[other] and other_cost < cost[other]):
+                    label[other], cost[other], previous[other] = other_label, other_cost, node
+                    other_key = int(bound[other]) if heuristic else other_label
+                    heapq.heappush(heap, (other_key, other_label, other_cost, int(other)))
+                    # Only reaching an end stop on board counts as arriving there
+                    if self.ride[edge] and is_target[other]:
+                        final = self.arrival[other] + egress[other]
+                        if (final, other_cost + egress[other]) < (best, best_cost):
+                            best, best_cost, best_node = final, other_cost + egress[other], other
+        self.settled = settled
+        if best_node < 0:
+            return None
+        path = [best_node]
+        while previous[path[-1]] >= 0:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return path, float(best), float(best_cost)
+
+    def pair_ids(self, path):
+        """[id(Stoptime), id(Stoptime)] of every step of path, the $pair_ids of EXPANDED_PATH."""
+        return [[int(self.node_ids[a]), int(self.node_ids[b])] for a, b in zip(path, path[1:])]
+
+
+def _positions(node_ids, ids):
+    """Position of each of ids in the sorted node_ids, -1 when missing."""
+    ids = np.asarray(ids, dtype=np.int64)
+    position = np.minimum(np.searchsorted(node_ids, ids), max(len(node_ids) - 1, 0))
+    found = (node_ids[position] == ids) if len(node_ids) else np.zeros(len(ids), dtype=bool)
+    return np.where(found, position, -1)
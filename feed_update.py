@@ -0,0 +1,237 @@
+import csv
+import hashlib
+import os
+import sys
+from collections import defaultdict
+
+from neo4j import GraphDatabase
+
+import queries
+from changes_setup import materialize_changes
+from projections import graph_name
+from spatial import GridIndex
+from timetable import WALK_RADIUS, seconds_to_time, time_to_seconds
+
+# Aggiornamento incrementale del database quando l'agenzia pubblica un nuovo feed GTFS.
+# Confronta il feed già caricato con quello nuovo (per trip_id, stop_id, service_id e route_id)
+# e riscrive solo i sottografi cambiati, con gli archi derivati (PRECEDES, WALK_TO, ACTIVE_IN,
+# CHANGE) e le proiezioni dei soli giorni coinvolti. Entrambe le cartelle devono contenere
+# new_calendar_dates.txt (reshape.py):
+#   python feed_update.py OLD_GTFS_DIR NEW_GTFS_DIR
+
+uri = "bolt://localhost:7687"
+username = "neo4j"
+password = "12345678"
+
+BATCH_SIZE = 1000
+
+
+def _read(gtfs_path, name):
+    with open(os.path.join(gtfs_path, name), newline='', encoding='utf-8-sig') as file:
+        yield from csv.DictReader(file)
+
+
+def _row_hash(*values):
+    digest = hashlib.blake2b('\x1f'.join(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class FeedSnapshot:
+    """Quanto serve del feed per il confronto: righe di stops, routes, trips e calendario,
+    e per ogni trip un hash delle sue righe di stop_times (indipendente dall'ordine)."""
+
+    def __init__(self, gtfs_path):
+        self.path = gtfs_path
+        self.agency = next(_read(gtfs_path, 'agency.txt'))['agency_name']
+        self.stops = {row['stop_id']: (row['stop_name'], float(row['stop_lat']), float(row['stop_lon']))
+                      for row in _read(gtfs_path, 'stops.txt')}
+        self.routes = {row['route_id']: (row.get('route_short_name', ''), row.get('route_long_name', ''),
+                                         int(row['route_type']))
+                       for row in _read(gtfs_path, 'routes.txt')}
+        self.trips = {row['trip_id']: (row['route_id'], row['service_id'], row.get('direction_id', ''),
+                                       row.get('shape_id', ''), row.get('trip_headsign', ''))
+                      for row in _read(gtfs_path, 'trips.txt')}
+        self.calendar = defaultdict(dict)
+        for row in _read(gtfs_path, 'new_calendar_dates.txt'):
+            self.calendar[row['service_id']][row['day']] = row['exception_type']
+        self.stop_times = defaultdict(int)
+        for row in _read(gtfs_path, 'stop_times.txt'):
+            self.stop_times[row['trip_id']] = (self.stop_times[row['trip_id']] + _row_hash(
+                row['stop_id'], row['stop_sequence'], row['arrival_time'], row['departure_time'])) % 2 ** 64
+
+    def days(self, service_id):
+        return set(self.calendar.get(service_id, ()))
+
+
+class FeedDiff:
+    """Differenze tra due feed, chiave per chiave.
+
+    added/removed/changed per trips, stops, routes e services; un trip è
+    cambiato se cambia la sua riga di trips.txt o una qualsiasi delle sue
+    righe di stop_times.txt.
+    """
+
+    def __init__(self, old, new):
+        self.old, self.new = old, new
+        self.trips = self._compare(old.trips, new.trips, old.stop_times, new.stop_times)
+        self.stops = self._compare(old.stops, new.stops)
+        self.routes = self._compare(old.routes, new.routes)
+        self.services = self._compare(old.calendar, new.calendar)
+        # Stop con coordinate diverse: cambiano i loro WALK_TO (un cambio di nome no)
+        self.relocated = {stop for stop in self.stops['changed'] if old.stops[stop][1:] != new.stops[stop][1:]}
+
+    @staticmethod
+    def _compare(old, new, old_extra=None, new_extra=None):
+        added = set(new) - set(old)
+        removed = set(old) - set(new)
+        changed = {key for key in set(old) & set(new)
+                   if old[key] != new[key] or (old_extra is not None and old_extra.get(key) != new_extra.get(key))}
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    @property
+    def empty(self):
+        return not any(keys for diff in (self.trips, self.stops, self.routes, self.services) for keys in diff.values())
+
+    def affected_days(self):
+        """Giorni i cui grafi (Stoptime del giorno, ACTIVE_IN, CHANGE, proiezioni) cambiano."""
+        days = set()
+        for trip in self.trips['removed'] | self.trips['changed']:
+            days |= self.old.days(self.old.trips[trip][1])
+        for trip in self.trips['added'] | self.trips['changed']:
+            days |= self.new.days(self.new.trips[trip][1])
+        for service in self.services['removed'] | self.services['added']:
+            days |= self.old.days(service) | self.new.days(service)
+        for service in self.services['changed']:
+            days |= self.old.days(service) ^ self.new.days(service)
+        # Uno Stop spostato cambia i WALK_TO, quindi i CHANGE di ogni giorno in cui è servito
+        moved = self.relocated | self.stops['removed'] | self.stops['added']
+        if moved:
+            for snapshot in (self.old, self.new):
+                services = set()
+                for row in _read(snapshot.path, 'stop_times.txt'):
+                    if row['stop_id'] in moved and row['trip_id'] in snapshot.trips:
+                        services.add(snapshot.trips[row['trip_id']][1])
+                for service in services:
+                    days |= snapshot.days(service)
+        return days
+
+    def summary(self):
+        return {name: {kind: len(keys) for kind, keys in diff.items()}
+                for name, diff in (('trips', self.trips), ('stops', self.stops), ('routes', self.routes),
+                                   ('services', self.services))}
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _run(session, query, key, items, **params):
+    for batch in _batches(items):
+        session.run(query, {key: batch, **params}).consume()
+
+
+def _gtfs_time(value):
+    return seconds_to_time(time_to_seconds(value)).isoformat()
+
+
+def apply_diff(driver, diff, projections=None, walk_radius=WALK_RADIUS):
+    """Applica diff al database e restituisce i giorni aggiornati.
+
+    Le proiezioni dei giorni coinvolti vengono eliminate tramite projections
+    (un ProjectionManager) o, in sua assenza, per nome; gli archi CHANGE
+    materializzati da changes_setup.py vengono ricalcolati per quei giorni.
+    """
+    old, new = diff.old, diff.new
+    trips, stops, routes, services = diff.trips, diff.stops, diff.routes, diff.services
+    days = diff.affected_days()
+    rewritten = trips['added'] | trips['changed']
+
+    # Stoptime dei trip da riscrivere, letti dal nuovo feed
+    stoptimes = [{'trip_id': row['trip_id'], 'stop_id': row['stop_id'], 'stop_sequence': int(row['stop_sequence']),
+                  'arrival_time': _gtfs_time(row['arrival_time']), 'departure_time': _gtfs_time(row['departure_time']),
+                  'arrival_seconds': time_to_seconds(row['arrival_time']),
+                  'departure_seconds': time_to_seconds(row['departure_time'])}
+                 for row in _read(new.path, 'stop_times.txt') if row['trip_id'] in rewritten]
+
+    # WALK_TO degli Stop aggiunti o spostati, con la griglia sul nuovo feed
+    moved = stops['added'] | diff.relocated
+    stop_ids = list(new.stops)
+    index = GridIndex([new.stops[stop][1] for stop in stop_ids], [new.stops[stop][2] for stop in stop_ids],
+                      walk_radius)
+    walks = {}
+    for stop in moved:
+        _, lat, lon = new.stops[stop]
+        near, distances = index.query_radius(lat, lon, walk_radius)
+        for other, distance in zip(near, distances):
+            walks[(stop, stop_ids[other])] = walks[(stop_ids[other], stop)] = float(distance)
+
+    with driver.session() as session:
+        _run(session, queries.FEED_DELETE_STOPTIMES, 'trip_ids', trips['removed'] | trips['changed'])
+        _run(session, queries.FEED_DELETE_TRIPS, 'trip_ids', trips['removed'])
+
+        _run(session, queries.FEED_MERGE_ROUTES, 'rows',
+             [{'route_id': route, 'short_name': new.routes[route][0], 'long_name': new.routes[route][1],
+               'type': new.routes[route][2]} for route in routes['added'] | routes['changed']], agency=new.agency)
+        _run(session, queries.FEED_MERGE_SERVICES, 'rows',
+             [{'service_id': service, 'days': [{'day': day, 'exception_type': exception_type}
+                                               for day, exception_type in new.calendar[service].items()]}
+              for service in services['added'] | services['changed']])
+        _run(session, queries.FEED_MERGE_STOPS, 'rows',
+             [{'stop_id': stop, 'name': new.stops[stop][0], 'lat': new.stops[stop][1], 'lon': new.stops[stop][2]}
+              for stop in stops['added'] | stops['changed']])
+
+        _run(session, queries.FEED_MERGE_TRIPS, 'rows',
+             [{'trip_id': trip, 'route_id': new.trips[trip][0], 'service_id': new.trips[trip][1],
+               'direction_id': new.trips[trip][2], 'shape_id': new.trips[trip][3], 'headsign': new.trips[trip][4]}
+              for trip in rewritten])
+        _run(session, queries.FEED_CREATE_STOPTIMES, 'rows', stoptimes)
+        _run(session, queries.FEED_CREATE_PRECEDES, 'trip_ids', rewritten)
+
+        _run(session, queries.FEED_DELETE_STOP_WALK_TO, 'stop_ids', diff.relocated)
+        _run(session, queries.WALK_TO_WRITE, 'rows',
+             [{'source': source, 'target': target, 'distance': distance}
+              for (source, target), distance in walks.items()])
+
+        _run(session, queries.FEED_DELETE_STOPS, 'stop_ids', stops['removed'])
+        _run(session, queries.FEED_DELETE_SERVICES, 'service_ids', services['removed'])
+        _run(session, queries.FEED_DELETE_ROUTES, 'route_ids', routes['removed'])
+
+        speeds = {}
+        for day in sorted(days):
+            session.run(queries.FEED_ACTIVE_IN, day=day).consume()
+            speeds[day] = session.run(queries.CHANGE_SPEEDS, day=day).value()
+        graphs = session.run(queries.GRAPH_SIZES).value() if projections is None else []
+
+    for day in sorted(days):
+        for speed in speeds[day]:
+            materialize_changes(driver, day, speed)
+        if projections is not None:
+            projections.invalidate(day)
+        else:
+            prefix = graph_name(day, '')
+            with driver.session() as session:
+                for name in graphs:
+                    if name.startswith(prefix):
+                        session.run(queries.GRAPH_DROP, graph_name=name).consume()
+    return days
+
+
+def update_feed(driver, old_path, new_path, projections=None, walk_radius=WALK_RADIUS):
+    """Confronta i due feed e applica le differenze: (FeedDiff, giorni aggiornati)."""
+    diff = FeedDiff(FeedSnapshot(old_path), FeedSnapshot(new_path))
+    if diff.empty:
+        return diff, set()
+    return diff, apply_diff(driver, diff, projections, walk_radius)
+
+
+if __name__ == '__main__':
+    old_path, new_path = sys.argv[1], sys.argv[2]
+    driver = GraphDatabase.driver(uri, auth=(username, password))
+    print('Connessione stabilita')
+    diff, days = update_feed(driver, old_path, new_path)
+    for name, counts in diff.summary().items():
+        print(f"{name}: {counts['added']} aggiunti, {counts['removed']} rimossi, {counts['changed']} modificati")
+    print(f"Giorni aggiornati: {', '.join(sorted(days)) if days else 'nessuno'}")
+    driver.close()
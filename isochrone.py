@@ -0,0 +1,102 @@
+"""One-to-all isochrones from a point and a departure time.
+
+A single Connection Scan without targets labels every stop of the day with
+its earliest arrival from the stops around the origin, instead of one
+routing query per destination. Arrivals can be spread to a square grid by
+walking from the reached stops, and returned as a DataFrame or as GeoJSON.
+"""
+import numpy as np
+import pandas as pd
+
+from csa import INF, ConnectionScan
+from spatial import EARTH_RADIUS, GridIndex
+from timetable import seconds_to_time, time_to_seconds
+
+# Meters per degree of latitude
+KY = np.pi * EARTH_RADIUS / 180
+
+
+def stop_arrivals(tt, speed, time, lat, lon, max_minutes, radius=300):
+    """Earliest arrival at every stop reached within max_minutes from (lat, lon).
+
+    Access walks to the stops within radius meters of the origin, as in
+    App.route_many. Returns (stops, arrivals in seconds, departure in seconds).
+    """
+    departure = time_to_seconds(time)
+    stops, distances = tt.near_stops(lat, lon, radius)
+    sources = {int(stop): int(distance / speed) for stop, distance in zip(stops, distances)}
+    labels = ConnectionScan.labels(tt, speed, departure, sources, departure + int(max_minutes * 60))
+    reached = np.flatnonzero(labels.arrival <= departure + max_minutes * 60)
+    return reached, labels.arrival[reached], departure
+
+
+def cell_arrivals(tt, speed, lat, lon, departure, stops, arrivals, max_minutes, cell_size=200, radius=300):
+    """Earliest arrival at the centre of every cell_size grid cell, walking up to radius meters from a stop.
+
+    The origin counts as a stop reached at departure. Returns the centres
+    (lat, lon) and arrivals of the cells reached within max_minutes.
+    """
+    deadline = departure + max_minutes * 60
+    points_lat = np.append(tt.stop_lat[stops], lat)
+    points_lon = np.append(tt.stop_lon[stops], lon)
+    points_arrival = np.append(arrivals, departure)
+    kx = KY * np.cos(np.radians(lat))
+    dlat, dlon = cell_size / KY, cell_size / kx
+    margin_lat, margin_lon = radius / KY, radius / kx
+    lats = np.arange(np.floor((points_lat.min() - margin_lat) / dlat), np.ceil((points_lat.max() + margin_lat) / dlat))
+    lons = np.arange(np.floor((points_lon.min() - margin_lon) / dlon), np.ceil((points_lon.max() + margin_lon) / dlon))
+    cell_lat, cell_lon = np.meshgrid((lats + 0.5) * dlat, (lons + 0.5) * dlon, indexing='ij')
+    cell_lat, cell_lon = cell_lat.ravel(), cell_lon.ravel()
+    index = GridIndex(cell_lat, cell_lon, max(radius, cell_size))
+    best = np.full(len(cell_lat), INF, dtype=np.int64)
+    for point_lat, point_lon, arrival in zip(points_lat, points_lon, points_arrival):
+        reach = min(radius, (deadline - arrival) * speed)
+        if reach < 0:
+            continue
+        cells, distances = index.query_radius(point_lat, point_lon, reach)
+        np.minimum.at(best, cells, arrival + (distances / speed).astype(np.int64))
+    reached = np.flatnonzero(best <= deadline)
+    return cell_lat[reached], cell_lon[reached], best[reached]
+
+
+def isochrone(tt, speed, time, lat, lon, max_minutes, radius=300, cell_size=None):
+    """DataFrame of the stops (or, with cell_size, grid cells) reached within max_minutes.
+
+    Stops come with stop_id, stop_name, lat, lon, arrival and minutes, cells
+    with lat, lon, arrival and minutes; minutes are counted from time.
+    """
+    stops, arrivals, departure = stop_arrivals(tt, speed, time, lat, lon, max_minutes, radius)
+    if cell_size is None:
+        frame = pd.DataFrame({'stop_id': [tt.stop_ids[stop] for stop in stops],
+                              'stop_name': [tt.stop_names[stop] for stop in stops],
+                              'lat': tt.stop_lat[stops], 'lon': tt.stop_lon[stops], 'seconds': arrivals})
+    else:
+        cell_lat, cell_lon, cell_arrival = cell_arrivals(tt, speed, lat, lon, departure, stops, arrivals,
+                                                         max_minutes, cell_size, radius)
+        frame = pd.DataFrame({'lat': cell_lat, 'lon': cell_lon, 'seconds': cell_arrival})
+    frame['arrival'] = [seconds_to_time(int(seconds)) for seconds in frame['seconds']]
+    frame['minutes'] = (frame['seconds'] - departure) / 60
+    return frame.drop(columns='seconds').sort_values('minutes', ignore_index=True)
+
+
+def to_geojson(frame, cell_size=None):
+    """GeoJSON FeatureCollection of an isochrone DataFrame.
+
+    Stops become Points; with cell_size the rows are grid cells and become
+    square Polygons of that side in meters.
+    """
+    features = []
+    for row in frame.itertuples(index=False):
+        properties = {key: value for key, value in row._asdict().items() if key not in ('lat', 'lon')}
+        properties['arrival'] = str(properties['arrival'])
+        properties['minutes'] = round(float(properties['minutes']), 2)
+        if cell_size is None:
+            geometry = {'type': 'Point', 'coordinates': [float(row.lon), float(row.lat)]}
+        else:
+            half_lat = cell_size / KY / 2
+            half_lon = cell_size / (KY * np.cos(np.radians(row.lat))) / 2
+            ring = [[float(row.lon + x * half_lon), float(row.lat + y * half_lat)]
+                    for x, y in ((-1, -1), (1, -1), (1, 1), (-1, 1), (-1, -1))]
+            geometry = {'type': 'Polygon', 'coordinates': [ring]}
+        features.append({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+    return {'type': 'FeatureCollection', 'features': features}
@@ -0,0 +1,86 @@
+"""Load test for service.py: concurrent point-to-point requests, latency percentiles.
+
+    python service.py 8080 &
+    python loadtest.py --requests 2000 --concurrency 200
+
+Origins and destinations are drawn from the Modena coordinate pairs used in
+main.py; departure times are spread over an hour so that only part of the
+requests can be coalesced by the service.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlencode
+
+import numpy as np
+
+COORDS = [
+    [(44.649988, 10.917893), (44.6274857758479, 10.947848294531108)],
+    [(44.6274857758479, 10.947848294531108), (44.631281, 10.873258)],
+    [(44.649988, 10.917893), (44.631281, 10.873258)],
+    [(44.651470232478886, 10.808315946994957), (44.63762254014361, 10.946646579247362)],
+    [(44.65311506793417, 10.93005907242455), (44.643695551154735, 10.930429915919644)],
+    [(44.63976076124965, 10.941661861492578), (44.63403438527048, 10.955699843803663)],
+    [(44.65311506793417, 10.93005907242455), (44.725732352761995, 11.04233547009754)],
+    [(44.60528176108951, 10.867088533100985), (44.64792367823092, 10.923039913894241)],
+    [(44.52641453612295, 10.86607842381116), (44.60528176108951, 10.867088533100985)]
+]
+
+
+async def get(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (path, host)).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body or b'null')
+
+
+async def load_test(host, port, date, requests, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        (start_lat, start_lon), (end_lat, end_lon) = random.choice(COORDS)
+        minute = random.randrange(60)
+        path = '/route?' + urlencode({'date': date, 'time': '14:%02d:00' % minute, 'speed': 1,
+                                      'start_lat': start_lat, 'start_lon': start_lon,
+                                      'end_lat': end_lat, 'end_lon': end_lon})
+        async with slots:
+            started = time.perf_counter()
+            try:
+                status, _ = await get(host, port, path)
+                errors += status != 200
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    _, before = await get(host, port, '/stats')
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    _, after = await get(host, port, '/stats')
+    latencies = np.array(latencies) * 1000
+    return {'requests': requests, 'concurrency': concurrency, 'errors': errors,
+            'throughput_rps': round(requests / elapsed, 1),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p90_ms': round(float(np.percentile(latencies, 90)), 1),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+            'max_ms': round(float(latencies.max()), 1),
+            'coalesced': after['coalesced'] - before['coalesced']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--date', default='2024-01-18')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    args = parser.parse_args()
+    report = asyncio.run(load_test(args.host, args.port, args.date, args.requests, args.concurrency))
+    print(json.dumps(report, indent=2))
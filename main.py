@@ -1,208 +1,374 @@
+import ast
 import pandas as pd
 from neo4j import GraphDatabase
 from datetime import datetime,timedelta, date
+import queries
+import feed_update
+import betweenness
+import isochrone
+from csa import ConnectionScan
+from raptor import Raptor
+from tdgraph import TimeDependentRouter
+from realtime import RealtimeFeed
+from timetable import Feed, time_to_seconds
+from transfer_patterns import TransferPatternRouter
+from projections import ProjectionManager
+from tracing import traced
+from window import DAY, RollingWindow
+from contextlib import nullcontext
 class App:
     """In this file we are going to extract from OSM crossings mapped as nodes"""
 
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, gtfs_path=None, snapshot_dir=None, projection_budget=2 * 2 ** 30,
+                 materialized_changes=False, walking_table=None, cache=None, transfer_patterns=None, tracer=None):
+        # tracer: a tracing.Tracer; spans for the App methods and, through the driver, every Cypher statement
+        self.tracer = tracer
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        if tracer is not None:
+            self.driver = tracer.driver(self.driver)
+        # One projection per (date, speed), evicted LRU over projection_budget bytes.
+        # materialized_changes: CHANGE edges already written by changes_setup.py
+        self.projections = ProjectionManager(self.driver, projection_budget, materialized=materialized_changes)
+        # In-process engines, available when the GTFS files (or their snapshots) are at hand.
+        # walking_table: footpaths with the pedestrian distances computed by walking.py
+        self.feed = Feed(gtfs_path, snapshot_dir=snapshot_dir, walking_table=walking_table) if gtfs_path else None
+        # CSA reads the schedule with the real-time delays applied so far, RAPTOR the plain schedule
+        self.realtime = RealtimeFeed(self.feed) if gtfs_path else None
+        self.csa = ConnectionScan(self.realtime) if gtfs_path else None
+        self.raptor = Raptor(self.feed) if gtfs_path else None
+        # Stop/route graph with timetables on the edges, a much smaller model than the Stoptime projection
+        self.tdgraph = TimeDependentRouter(self.feed) if gtfs_path else None
+        # transfer_patterns: directory written by transfer_patterns.py, for engine='transfer_patterns'
+        self.transfer_patterns = TransferPatternRouter(self.feed, transfer_patterns) if transfer_patterns else None
+        # cache: a cache.ResultCache in front of find_near_stops and the routing methods
+        self.cache = cache
+        # Per-day copies of the projections for the single-search point-to-point routing, stitched into the
+        # current and next service day for the queries running past midnight
+        self.window = RollingWindow(self.driver, self.projections)
 
     def close(self):
         self.driver.close()
-
-    def routing_graph_creation(self, date, speed):
-        query = """CALL gds.graph.project.cypher(
-                    "graph_walk",
-                    "match (d:Day {day:date('%s')})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return id(st) AS id, st.stop_sequence as stop_sequence,s.lon as lon,s.lat as lat",
-                    "match (d:Day{day:date('%s')})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop) match (r:Route)<-[:USES]-(t) with st as source,s as service, t.id as trip_source, stops as stops,r.id as line match (service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) where t.id <> trip_source and source.arrival_time + duration({seconds:toInteger(w.distance/%d)}) < st.departure_time match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(r:Route)  where r.id <> line with source,service,trip_source,stops,line,r.id as other_line,w.distance as walking_distance,apoc.agg.minItems(st,st.departure_time).items as targets unwind targets  as target match (target)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) return id(source) as source, id(target) as target, ':CHANGE' as type,duration.inSeconds(source.arrival_time,target.departure_time).seconds + duration({seconds:toInteger(w.distance/%d)}).seconds as waiting_time, duration({seconds:toInteger(w.distance/%d)}).seconds as walking_time UNION ALL match (d:Day {day:date('%s')})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2) return id(st) as source, id(st2) as target, type(p) as type, p.waiting_time as waiting_time, 0 as walking_time")
-            """ % (date, date, speed, speed, speed, date)
-        print(query)
+        if self.cache is not None:
+            self.cache.close()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def _span(self, name, **attributes):
+        """A tracing span around one stage of a method, nothing without a tracer."""
+        return self.tracer.span(name, **attributes) if self.tracer is not None else nullcontext()
+
+    def _cached(self, key, date, compute):
+        return compute() if self.cache is None else self.cache.get_or_compute(key, date, compute)
+
+    def _version(self, date, engine='gds'):
+        """Version of what answers engine's queries on date, part of the cache keys."""
+        return self.realtime.version(date) if engine == 'csa' else self.projections.version(date)
+
+    @traced
+    def routing_graph_creation(self, date, speed, graph_name='graph_walk', materialized=False, astar=False):
+        if not astar:
+            query = queries.PROJECTION_MATERIALIZED if materialized else queries.PROJECTION
+            with self.driver.session() as session:
+                return session.run(query, graph_name=graph_name, date=date, speed=speed).single()
+        query = queries.PROJECTION_MATERIALIZED_ASTAR if materialized else queries.PROJECTION_ASTAR
+        nm_per_second = self.projections.nm_per_second(date, speed)
         with self.driver.session() as session:
-            res = session.run(query)
-            print(res)
+            return session.run(query, graph_name=graph_name, date=date, speed=speed,
+                               nm_per_second=nm_per_second).single()
 
-    def get_metrics(self):
+    @traced
+    def get_metrics(self, graph_name='graph_walk'):
         with self.driver.session() as session:
-            result = session.write_transaction(self._get_metrics)
+            result = session.write_transaction(self._get_metrics, graph_name)
             return result
 
     @staticmethod
-    def _get_metrics(tx):
-        query = """CALL gds.graph.list(
-                      'graph_walk'
-                    ) YIELD
-                      nodeCount,
-                      relationshipCount,
-                      degreeDistribution,
-                      density,
-                      sizeInBytes return nodeCount,
-                      relationshipCount,
-                      degreeDistribution,
-                      density,
-                      sizeInBytes"""
-        result = tx.run(query)
+    def _get_metrics(tx, graph_name='graph_walk'):
+        result = tx.run(queries.METRICS, graph_name=graph_name)
         return result.values()
 
-    def betweennessCentrality(self):
+    @traced
+    def betweennessCentrality(self, graph_name='graph_walk', sampling_size=None, seed=None):
+        """Betweenness of every Stoptime, exact or, with sampling_size, from that many source nodes."""
+        config = {} if sampling_size is None else {'samplingSize': sampling_size}
+        if seed is not None:
+            config['samplingSeed'] = seed
         with self.driver.session() as session:
-            result = session.write_transaction(self._betweennessCentrality)
+            result = session.write_transaction(self._betweennessCentrality, graph_name, config)
             return result
 
     @staticmethod
-    def _betweennessCentrality(tx):
-        query = """CALL gds.betweenness.stream('graph_walk')
-                    YIELD nodeId, score
-                    match (st:Stoptime)-[:LOCATED_AT]->(s:Stop)
-                    where id(st) = id(gds.util.asNode(nodeId))
-                    return s.name,gds.util.asNode(nodeId).departure_time AS time,s.lat as lat,s.lon AS lon, score
-                    ORDER BY score DESC"""
-        result = tx.run(query)
+    def _betweennessCentrality(tx, graph_name='graph_walk', config=None):
+        result = tx.run(queries.BETWEENNESS, graph_name=graph_name, config=config or {})
         return result.values()
 
+    @traced
+    def betweenness_by_stop_hour(self, date, speed=1, sampling_size=None, sampling_ratio=None, seed=None, write=False,
+                                 out=None):
+        """Sampled betweenness summed per stop and hour on the server (betweenness.py).
+
+        sampling_ratio (share of the Stoptimes) or sampling_size set the
+        accuracy, exact without either. write=True stores the rows as
+        BETWEENNESS_IN relationships, out saves them to a .csv.gz/.npz file.
+        """
+        frame, _ = betweenness.run(self.driver, date, speed, sampling_size, sampling_ratio, seed, write=write, out=out,
+                                   projections=self.projections)
+        return frame
+
+    @traced
     def find_near_stops(self, date, start_lat, start_lon, radius):
-        query = '''match (d:Day{day: date('%s')})<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop)
-                    WITH distinct point({latitude: s.lat, longitude: s.lon}) AS coord, s as s
-                    with s, coord, point({latitude: %f, longitude: %f}) as startPoint
-                    where point.distance(coord, startPoint) < %d
-                    return distinct s.name''' % (date, start_lat, start_lon, radius)
-        print(query)
+        if self.cache is not None:
+            start_lat, start_lon = self.cache.point(start_lat, start_lon)
+            key = self.cache.key('near_stops', date, self.projections.version(date), start_lat, start_lon, radius)
+            return self._cached(key, date, lambda: self._find_near_stops(date, start_lat, start_lon, radius))
+        return self._find_near_stops(date, start_lat, start_lon, radius)
+
+    @traced
+    def _find_near_stops(self, date, start_lat, start_lon, radius):
         with self.driver.session() as session:
-            result = session.run(query)
+            result = session.run(queries.FIND_NEAR_STOPS, date=date, lat=start_lat, lon=start_lon, radius=radius)
             return result.values()
 
-    def routing(self, date, speed, time, source, target, max_duration=4):
+    @traced
+    def find_near_stops_many(self, date, coords, radius):
+        """Names of the stops near each (lat, lon) of coords, in a single query.
+
+        Returns one list of stop names per coordinate pair, in the same order.
+        """
+        with self.driver.session() as session:
+            result = session.run(queries.FIND_NEAR_STOPS_MANY, points=[list(coord) for coord in coords],
+                                 radius=radius, date=date)
+            return [names for _, names in result.values()]
+
+    @traced
+    def routing(self, date, speed, time, source, target, max_duration=4, engine='gds', algorithm='dijkstra'):
+        """Earliest arrival from the stop named source to the stop named target.
+
+        algorithm='astar' runs gds.shortestPath.astar, guided by the distance
+        to the target over the fastest vehicle speed of the day, instead of
+        gds.shortestPath.dijkstra; only engine='gds' searches the graph.
+        """
+        if algorithm not in ('dijkstra', 'astar'):
+            raise ValueError('unknown algorithm %r' % algorithm)
+        if algorithm == 'astar' and engine != 'gds':
+            raise ValueError("algorithm='astar' needs engine='gds', not %r" % engine)
+        if self.cache is not None:
+            time = self.cache.bucket(time)
+            key = self.cache.key('routing', date, engine, self._version(date, engine), speed, time, source, target,
+                                 max_duration, algorithm)
+            return self._cached(key, date, lambda: self._routing_engine(date, speed, time, source, target,
+                                                                        max_duration, engine, algorithm))
+        return self._routing_engine(date, speed, time, source, target, max_duration, engine, algorithm)
+
+    @traced
+    def _routing_engine(self, date, speed, time, source, target, max_duration=4, engine='gds', algorithm='dijkstra'):
+        if engine == 'csa':
+            return self.csa.routing(date, speed, time, source, target, max_duration)
+        if engine == 'transfer_patterns':
+            return self.transfer_patterns.routing(date, speed, time, source, target, max_duration)
+        if engine == 'tdgraph':
+            return self.tdgraph.routing(date, speed, time, source, target, max_duration)
+        with self._span('ProjectionManager.get', date=date, speed=speed):
+            graph_name = self.projections.get(date, speed, astar=algorithm == 'astar')
+        nm_per_second = self.projections.nm_per_second(date, speed) if algorithm == 'astar' else None
         with self.driver.session() as session:
-            result = session.write_transaction(self._routing, date, speed, time, source, target, max_duration)
+            result = session.write_transaction(self._routing, date, speed, time, source, target, max_duration,
+                                               graph_name, nm_per_second)
             return result
 
+    @traced
+    def profile_routing(self, date, speed, start_time, end_time, source, target, max_duration=4):
+        """All good departures from source to target between start_time and end_time.
+
+        Runs a single rRAPTOR range query instead of calling routing once per
+        departure time and returns one row per Pareto-optimal itinerary.
+        """
+        result = self.raptor.profile(date, speed, start_time, end_time, source, target, max_duration)
+        return pd.DataFrame(result, columns=['departure', 'arrival', 'changes', 'path'])
+
+    @traced
+    def route_many(self, date, time, od_pairs, speed=1, radius=300, max_duration=4):
+        """Route a whole list of ((start_lat, start_lon), (end_lat, end_lon)) pairs.
+
+        Candidate stops are looked up once per distinct coordinate and pairs
+        with the same origin share one one-to-all scan. Returns a DataFrame of
+        departure, arrival, cost (seconds, walking included) and changes.
+        """
+        return self.csa.route_many(date, speed, time, od_pairs, radius, max_duration)
+
+    @traced
+    def isochrone(self, date, time, lat, lon, max_minutes, speed=1, radius=300, cell_size=None, geojson=False):
+        """Arrival time at every stop reached within max_minutes from (lat, lon), in one one-to-all scan.
+
+        With cell_size (meters) arrivals are spread by walking to a square grid
+        instead; geojson=True returns a FeatureCollection instead of a DataFrame.
+        """
+        tt = self.realtime.timetable(date)
+        result = isochrone.isochrone(tt, speed, time, lat, lon, max_minutes, radius, cell_size)
+        return isochrone.to_geojson(result, cell_size) if geojson else result
+
     @staticmethod
-    def _routing(tx, date, speed, time, source, target, max_duration=4):
-        endtime = datetime.strptime(time, "%H:%M:%S") + timedelta(hours=max_duration)
-        endtime = endtime.strftime("%H:%M:%S")
-        query = """match (d:Day {day:date('%s')})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[r:LOCATED_AT]->(s:Stop {name: '%s'})
-        where st.departure_time > time('%s')
-        match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(rou:Route) 
-        with rou.id as source_line ,apoc.agg.minItems(st, st.departure_time).items as sources
-        with collect(sources) as sources
-        unwind sources as s with s[0] as the_source
-        match (d:Day {day:date('%s')})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)
-        with collect(id(st)) as target_ids,the_source as s
-        unwind target_ids as tg_id
-        match (st2:Stoptime)-[r:LOCATED_AT]->(stop:Stop {name:'%s'})
-        where id(st2) = tg_id and st2.departure_time < time('%s') 
-        and st2.departure_time > s.departure_time
-        with s as s,st2 as t order by s.departure_time, t.departure_time
-        CALL gds.shortestPath.dijkstra.stream('graph_walk', {
-                                                    sourceNode: s,
-                                                    targetNode: t,
-                                                    relationshipWeightProperty: 'waiting_time'
-                                                    })
-            YIELD index, sourceNode, targetNode, totalCost, path, nodeIds 
-            with s as source_,t as target_t,gds.util.asNode(sourceNode) as source,gds.util.asNode(targetNode) as target,gds.util.asNode(sourceNode).departure_time +duration({seconds:totalCost}) as seconds,totalCost as cost,gds.util.asNode(targetNode).arrival_time as arrival_time, [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes_in_path,[r in relationships(path)|[startNode(r),endNode(r)]] as pairs                                 
-        order by arrival_time,cost limit 1
-        unwind pairs as p
-        match (s1:Stoptime)
-        where id(s1)=id(p[0])
-        match (s2:Stoptime)
-        where id(s2)=id(p[1])
-        match (r:Route)<-[:USES]-(t:Trip)<-[:PART_OF_TRIP]-(s1)
-        match (s1)-[:LOCATED_AT]->(s:Stop)
-        match (next_r:Route)<-[:USES]-(next_t:Trip)<-[:PART_OF_TRIP]-(s2)
-        match (s2)-[:LOCATED_AT]->(next_s:Stop)
-        return t.id as trip,s1.departure_time as departure,r.id as line, s.name as starting_stop_name,s.id as starting_stop_id,[s.lat,s.lon] as starting_stop_coordinates,
-        next_t.id as next_trip,next_s.name as next_stop,next_s.id as next_stop_id,[next_s.lat,next_s.lon] as next_stop_coordinates,next_r.id as next_line
-                ,s2.arrival_time as arrival""" % (date, source, time, date, target, endtime)
-        print(query)
-        result = tx.run(query)
+    def _routing(tx, date, speed, time, source, target, max_duration=4, graph_name='graph_walk', nm_per_second=None):
+        departure = time_to_seconds(time)
+        # nm_per_second (ProjectionManager.nm_per_second) selects the A* statement
+        query = queries.ROUTING if nm_per_second is None else queries.ROUTING_ASTAR
+        result = tx.run(query, date=date, departure=departure, endtime=departure + max_duration * 3600, source=source,
+                        target=target, graph_name=graph_name, nm_per_second=nm_per_second)
         return result.values()
 
+    @traced
     def routing_between_two_points_in_space(self, date, start_lat, end_lat, start_lon, end_lon, start_list, end_list,
-                                            speed, time, max_duration=4):
+                                            speed, time, max_duration=4, search='single', algorithm='dijkstra'):
+        """Best itinerary between two points, from the candidate stops near each of them.
+
+        search='single' runs one multi-source, multi-target search on a copy of
+        the projection (expanded.py); search='pairs' runs the Cypher statement
+        calling Dijkstra for every pair of candidate Stoptimes. algorithm='astar'
+        turns either search into an A* towards the end point. When time plus
+        max_duration goes past midnight the single search also rides the trips
+        of the next service day (App.window_graph), and early in the morning
+        those of the previous one after midnight; time may be past 24:00:00.
+        """
+        if algorithm not in ('dijkstra', 'astar'):
+            raise ValueError('unknown algorithm %r' % algorithm)
+        if self.cache is not None:
+            # Keyed by the candidate stop sets: points sharing them share the itinerary
+            if isinstance(start_list, str):
+                start_list = ast.literal_eval(start_list)
+            if isinstance(end_list, str):
+                end_list = ast.literal_eval(end_list)
+            time = self.cache.bucket(time)
+            departure = time_to_seconds(time)
+            first = self.window.first_day(date, departure, departure + max_duration * 3600)
+            window = search == 'single' and first is not None
+            version = self.window.version(first) if window else self.projections.version(date)
+            key = self.cache.key('between_points', date, version, speed, time, set(start_list), set(end_list),
+                                 max_duration, search, algorithm)
+            return self._cached(key, date, lambda: self._routing_between_points(
+                date, start_lat, end_lat, start_lon, end_lon, start_list, end_list, speed, time, max_duration, search,
+                algorithm))
+        return self._routing_between_points(date, start_lat, end_lat, start_lon, end_lon, start_list, end_list, speed,
+                                            time, max_duration, search, algorithm)
+
+    @traced
+    def expanded_graph(self, date, speed):
+        """The projection of (date, speed) copied out of GDS, once per projection version."""
+        return self.window.day(date, speed)
+
+    @traced
+    def window_graph(self, date, speed):
+        """date and the next service day on one timeline (window.py), in seconds after midnight of date."""
+        return self.window.graph(date, speed)
+
+    @traced
+    def _routing_between_points(self, date, start_lat, end_lat, start_lon, end_lon, start_list, end_list, speed, time,
+                                max_duration=4, search='single', algorithm='dijkstra'):
+        if search == 'single':
+            if isinstance(start_list, str):
+                start_list = ast.literal_eval(start_list)
+            if isinstance(end_list, str):
+                end_list = ast.literal_eval(end_list)
+            departure = time_to_seconds(time)
+            endtime = departure + max_duration * 3600
+            # Past midnight the search goes on with the trips of the next service day, early in the morning
+            # it also boards those of the previous day running after midnight, on that day's timeline
+            first = self.window.first_day(date, departure, endtime)
+            graph = self.expanded_graph(date, speed) if first is None else self.window_graph(first, speed)
+            shift = DAY if first is not None and first != date else 0
+            with self._span('ExpandedGraph.search', heuristic=algorithm == 'astar') as span:
+                found = graph.search(start_lat, start_lon, end_lat, end_lon, start_list, end_list, speed,
+                                     departure + shift, endtime + shift, heuristic=algorithm == 'astar')
+                if span is not None:
+                    span.set(settled=graph.settled, found=found is not None)
+            if found is None:
+                return []
+            with self.driver.session() as session:
+                return session.read_transaction(self._path_rows, graph.pair_ids(found[0]))
+        with self._span('ProjectionManager.get', date=date, speed=speed):
+            graph_name = self.projections.get(date, speed, astar=algorithm == 'astar')
+        nm_per_second = self.projections.nm_per_second(date, speed) if algorithm == 'astar' else None
         with self.driver.session() as session:
             result = session.write_transaction(self._routing_between_two_points_in_space, date, start_lat, end_lat,
-                                               start_lon, end_lon, start_list, end_list, speed, time, max_duration)
+                                               start_lon, end_lon, start_list, end_list, speed, time, max_duration,
+                                               graph_name, nm_per_second)
             return result
 
+    @staticmethod
+    def _path_rows(tx, pair_ids):
+        result = tx.run(queries.EXPANDED_PATH, pair_ids=pair_ids)
+        return result.values()
+
     @staticmethod
     def _routing_between_two_points_in_space(tx, date, start_lat, end_lat, start_lon, end_lon, start_list, end_list,
-                                             speed, time, max_duration=4):
-        endtime = datetime.strptime(time, "%H:%M:%S") + timedelta(hours=max_duration)
-        endtime = endtime.strftime("%H:%M:%S")
-        query = """match (d:Day {day:date('%s')})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[r:LOCATED_AT]->(s:Stop)
-        where st.departure_time - duration({seconds: point.distance(point({latitude: s.lat, longitude: s.lon}),point({latitude: %f, longitude: %f}))/ %d})> time('%s') and any(x in s.name where x in %s)
-        match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(rou:Route) with rou.id as soruce_line ,apoc.agg.minItems(st, st.departure_time).items as sources
-        with collect(sources) as sources
-        unwind sources as s with s[0] as the_source
-        match (d:Day {day:date('%s')})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)
-        with collect(id(st)) as target_ids,the_source as s
-        unwind target_ids as tg_id
-        match (st2:Stoptime)-[r:LOCATED_AT]->(stop:Stop)
-        where id(st2) = tg_id and st2.departure_time + duration({seconds: point.distance(point({latitude: stop.lat, longitude: stop.lon}),point({latitude: %f, longitude: %f}))/ %d})< time('%s') 
-        and st2.departure_time > s.departure_time and any(x in stop.name where x in %s)
-        with s as s,st2 as t order by s.departure_time, t.departure_time
-        CALL gds.shortestPath.dijkstra.stream('graph_walk', {
-                                                    sourceNode: s,
-                                                    targetNode: t,
-                                                    relationshipWeightProperty: 'waiting_time'
-                                                    })
-        YIELD index, sourceNode, targetNode, totalCost, path, nodeIds 
-        with s as source_,t as target_t,gds.util.asNode(sourceNode) as source,
-        gds.util.asNode(targetNode) as target,
-        gds.util.asNode(sourceNode).departure_time +duration({seconds:totalCost}) as seconds,
-        totalCost as cost,
-        gds.util.asNode(targetNode).arrival_time as arrival_time, 
-        [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes_in_path,[r in relationships(path)|[startNode(r),endNode(r)]] as pairs
-        match (target)-[:LOCATED_AT]->(endStop:Stop)
-        match (source)-[:LOCATED_AT]->(startStop:Stop)
-        with endStop as endStop, startStop as startStop, source_ as source_ , target_t as target_t, cost + point.distance(point({latitude: startStop.lat, longitude: startStop.lon}),point({latitude: %f, longitude: %f}))/ %d + point.distance(point({latitude: endStop.lat, longitude: endStop.lon}),point({latitude:  %f, longitude: %f }))/ %d  as cost, seconds as seconds, arrival_time as arrival_time, arrival_time + duration({seconds: point.distance(point({latitude: endStop.lat, longitude: endStop.lon}),point({latitude: %f, longitude: %f }))/ %d}) as final_time, pairs as pairs 
-        order by final_time, cost
-        limit 1
-        unwind pairs as p
-        match (s1:Stoptime)
-        where id(s1)=id(p[0])
-        match (s2:Stoptime)
-        where id(s2)=id(p[1])
-        match (r:Route)<-[:USES]-(t:Trip)<-[:PART_OF_TRIP]-(s1)
-        match (s1)-[:LOCATED_AT]->(s:Stop)
-        match (next_r:Route)<-[:USES]-(next_t:Trip)<-[:PART_OF_TRIP]-(s2)
-        match (s2)-[:LOCATED_AT]->(next_s:Stop)
-        return t.id as trip,s1.departure_time as departure,r.id as line, s.name as starting_stop_name,s.id as starting_stop_id,[s.lat,s.lon] as starting_stop_coordinates,
-        next_t.id as next_trip,next_s.name as next_stop,next_s.id as next_stop_id,[next_s.lat,next_s.lon] as next_stop_coordinates,next_r.id as next_line
-                ,s2.arrival_time as arrival""" % (
-        date, start_lat, start_lon, speed, time, start_list, date, end_lat, end_lon, speed, endtime, end_list,
-        start_lat, start_lon, speed, end_lat, end_lon, speed, end_lat, end_lon, speed)
-        print(query)
-        result = tx.run(query)
+                                             speed, time, max_duration=4, graph_name='graph_walk', nm_per_second=None):
+        departure = time_to_seconds(time)
+        # Older callers pass the stop names as the str() of a list
+        if isinstance(start_list, str):
+            start_list = ast.literal_eval(start_list)
+        if isinstance(end_list, str):
+            end_list = ast.literal_eval(end_list)
+        query = queries.ROUTING_BETWEEN_POINTS if nm_per_second is None else queries.ROUTING_BETWEEN_POINTS_ASTAR
+        result = tx.run(query, date=date, departure=departure, endtime=departure + max_duration * 3600, speed=speed,
+                        start_lat=start_lat, start_lon=start_lon, end_lat=end_lat, end_lon=end_lon,
+                        start_names=list(start_list), end_names=list(end_list), graph_name=graph_name,
+                        nm_per_second=nm_per_second)
         return result.values()
 
+    @traced
     def distance_from_a_stop(self, node_id, lat, lon):
-        query = """match (s:Stop {id: '%s'})
-                    with point({latitude: s.lat, longitude: s.lon}) as p1, point({latitude: %f, longitude: %f}) as p2
-                    return point.distance(p1, p2)""" % (node_id, lat, lon)
         with self.driver.session() as session:
-            res = session.run(query)
+            res = session.run(queries.DISTANCE_FROM_A_STOP, stop_id=node_id, lat=lat, lon=lon)
             return res.value()
 
+    @traced
+    def update_feed(self, old_gtfs_path, new_gtfs_path):
+        """Apply a new GTFS edition incrementally (see feed_update.py).
+
+        Only the changed trips, stops, routes and services are rewritten and
+        only the projections, Timetables and snapshots of the affected days are
+        dropped; the snapshots are compiled again on next use. The transfer
+        patterns of those days are dropped too, until transfer_patterns.py
+        computes them again.
+        Returns the diff summary and the affected days.
+        """
+        diff, days = feed_update.update_feed(self.driver, old_gtfs_path, new_gtfs_path, self.projections)
+        if self.feed is not None:
+            self.feed.gtfs_path = new_gtfs_path
+            self.feed.invalidate(days)
+            for day in days:
+                self.realtime.clear(day)
+        if self.transfer_patterns is not None:
+            self.transfer_patterns.invalidate(days)
+        if self.cache is not None:
+            self.cache.invalidate(days)
+        return diff.summary(), days
+
+    @traced
+    def apply_realtime(self, path, date=None):
+        """Apply the GTFS-Realtime trip updates recorded in path (see realtime.py).
+
+        Only the in-process Timetables change: the database and the GDS
+        projections keep the schedule. Trips without a startDate are applied
+        to date. Returns the number of trips updated.
+        """
+        return self.realtime.load(path, date)
+
+    @traced
+    def clear_realtime(self, date=None):
+        """Drop the real-time delays of date, or of every day."""
+        self.realtime.clear(date)
+
+    @traced
     def number_of_stops(self, date):
-        query = """match (d:Day {day:date('%s')})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return count(distinct s)""" % (
-            date)
         with self.driver.session() as session:
-            res = session.run(query)
-            print(res)
+            res = session.run(queries.NUMBER_OF_STOPS, date=date)
+            return res.single()[0]
 
+    @traced
     def hours_of_service(self, date):
-        query = """match (d:Day {day:date('%s')})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop) 
-                    match (r:Route)<-[:USES]-(t) 
-                    with r.id as line,apoc.agg.minItems(st,st.departure_time).items as min_time,
-                        apoc.agg.maxItems(st,st.arrival_time).items as max_time 
-                    unwind min_time as starting 
-                    unwind max_time as ending 
-                    with line as line,starting.departure_time as departs,ending.arrival_time as arrive,
-                        duration.inSeconds(starting.departure_time,ending.arrival_time).hours as duration 
-                    return avg(duration)""" % (date)
         with self.driver.session() as session:
-            res = session.run(query)
-            print(res)
+            res = session.run(queries.HOURS_OF_SERVICE, date=date)
+            return res.single()[0]
 
 def time_difference_seconds(time1, time2):
     delta = timedelta(hours=time1.hour, minutes=time1.minute, seconds=time1.second) - \
@@ -210,7 +376,8 @@ def time_difference_seconds(time1, time2):
     return delta.total_seconds()
 
 def convert_to_datetime(value):
-    return value.to_native()
+    # Neo4j returns its own Time type, the in-process engines plain datetime.time
+    return value.to_native() if hasattr(value, 'to_native') else value
 
 
 def show_more_details(df_path):
@@ -270,7 +437,7 @@ end_near_stops
 
 
 
-result = greeter.routing_between_two_points_in_space(date, start_latitude, end_latitude, start_longitude, end_longitude, str(list(start_near_stops['stop_name'])), str(list(end_near_stops['stop_name'])), 1, time)
+result = greeter.routing_between_two_points_in_space(date, start_latitude, end_latitude, start_longitude, end_longitude, list(start_near_stops['stop_name']), list(end_near_stops['stop_name']), 1, time)
 df_path = pd.DataFrame(result,columns=['trip','departure','line','starting_stop_name','starting_stop_id','starting_stop_coordinates','next_trip','next_stop','next_stop_id','next_stop_coordinates','next_line','arrival'])
 df_path
 
@@ -343,7 +510,7 @@ for coord in coords:
     result = greeter.find_near_stops(date, coord[0][0], coord[0][1], radius)
     end_time = timeit.default_timer()
 
-    time_find_start_near_stops = end_time - end_time
+    time_find_start_near_stops = end_time - start_time
 
     start_near_stops = pd.DataFrame(result, columns=['stop_name'])
 
@@ -359,8 +526,8 @@ for coord in coords:
     # Routing
     start_time = timeit.default_timer()
     result = greeter.routing_between_two_points_in_space(date, coord[0][0], coord[1][0], coord[0][1], coord[1][1],
-                                                         str(list(start_near_stops['stop_name'])),
-                                                         str(list(end_near_stops['stop_name'])), 1, time)
+                                                         list(start_near_stops['stop_name']),
+                                                         list(end_near_stops['stop_name']), 1, time)
     end_time = timeit.default_timer()
 
     routing_time = end_time - start_time
@@ -368,6 +535,8 @@ for coord in coords:
     performance.loc[len(performance.index)] = [coord[0][0], coord[0][1], coord[1][0], coord[1][1],
                                                time_find_start_near_stops, time_find_end_near_stops, routing_time]
 
+performance['distance'] = performance.apply(calculate_distance, axis=1)
+
 plt.plot(performance['distance'], performance['routing_time'], marker='o', linestyle='-')
 plt.xlabel('Euclidean Distance')
 plt.ylabel('Routing Time (seconds)')
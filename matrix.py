@@ -0,0 +1,137 @@
+"""Stop-to-stop travel-time matrices for accessibility analysis.
+
+For every departure slot, each origin stop gets one one-to-all Connection
+Scan over a snapshot of the day (see snapshot.py). Origins are split into
+chunks handed to a process pool; workers memory-map the same snapshot, so
+each one only holds the rows of the chunk it is computing. Every chunk is
+written as its own compressed .npz and the run is resumable: chunks already
+on disk are skipped.
+
+    python matrix.py SNAPSHOT_DIR OUT_DIR --times 07:00,08:00 --speed 1 --workers 4
+
+OUT_DIR/meta.json records date, speed, slots and encoding; travel times are
+whole minutes from the departure slot (walking included), unreachable pairs
+are UNREACHABLE. load_matrix assembles one slot back into a single array.
+"""
+import argparse
+import json
+import os
+import timeit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from csa import ConnectionScan
+from snapshot import open_snapshot
+from timetable import time_to_seconds
+
+UNREACHABLE = -1
+
+_tt = None
+
+
+def _open(snapshot_path):
+    global _tt
+    _tt = open_snapshot(snapshot_path)
+
+
+def slot_name(time):
+    return 'slot_' + time.replace(':', '')[:4]
+
+
+def chunk_path(out_dir, time, chunk):
+    return os.path.join(out_dir, slot_name(time), 'chunk_%05d.npz' % chunk)
+
+
+def travel_times(tt, speed, departure, origins, max_minutes, dtype=np.int16):
+    """Rows of minutes from each origin stop to every stop, leaving at departure (seconds)."""
+    endtime = departure + max_minutes * 60
+    rows = np.full((len(origins), len(tt.stop_ids)), UNREACHABLE, dtype=dtype)
+    for row, origin in zip(rows, origins):
+        sources = {int(origin): 0}
+        for neighbour, distance in zip(*tt.footpaths(origin)):
+            if neighbour != origin:
+                sources[int(neighbour)] = int(distance / speed)
+        labels = ConnectionScan.labels(tt, speed, departure, sources, endtime)
+        reached = labels.arrival <= endtime
+        row[reached] = np.ceil((labels.arrival[reached] - departure) / 60)
+    return rows
+
+
+def _compute_chunk(out_dir, time, chunk, origins, speed, max_minutes, dtype):
+    rows = travel_times(_tt, speed, time_to_seconds(time), origins, max_minutes, dtype)
+    path = chunk_path(out_dir, time, chunk)
+    # Written under another name first: a chunk on disk is always complete
+    tmp = path[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(tmp, origins=origins, minutes=rows)
+    os.replace(tmp, path)
+    return time, chunk
+
+
+def compute_matrices(snapshot_path, out_dir, times, speed=1, max_minutes=180, chunk_size=256, workers=None):
+    """Compute (or complete) the matrices of every slot of times; returns the chunks computed now."""
+    tt = open_snapshot(snapshot_path)
+    dtype = np.int16 if max_minutes < np.iinfo(np.int16).max else np.int32
+    n_stops = len(tt.stop_ids)
+    meta = {'date': tt.date, 'speed': speed, 'times': list(times), 'max_minutes': max_minutes,
+            'chunk_size': chunk_size, 'stops': n_stops, 'dtype': np.dtype(dtype).name, 'unreachable': UNREACHABLE,
+            'snapshot': os.path.abspath(snapshot_path)}
+    os.makedirs(out_dir, exist_ok=True)
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            previous = json.load(file)
+        for key in ('date', 'speed', 'max_minutes', 'chunk_size', 'stops'):
+            if previous[key] != meta[key]:
+                raise ValueError('%s holds matrices with %s=%s, not %s' % (out_dir, key, previous[key], meta[key]))
+        meta['times'] = sorted(set(previous['times']) | set(times))
+    with open(meta_path, 'w') as file:
+        json.dump(meta, file, indent=2)
+    np.save(os.path.join(out_dir, 'stop_ids.npy'), np.asarray(tt.stop_ids))
+
+    tasks = []
+    for time in times:
+        os.makedirs(os.path.join(out_dir, slot_name(time)), exist_ok=True)
+        for chunk, start in enumerate(range(0, n_stops, chunk_size)):
+            if not os.path.exists(chunk_path(out_dir, time, chunk)):
+                origins = np.arange(start, min(start + chunk_size, n_stops), dtype=np.int32)
+                tasks.append((out_dir, time, chunk, origins, speed, max_minutes, dtype))
+    if not tasks:
+        return 0
+    with ProcessPoolExecutor(workers, initializer=_open, initargs=(snapshot_path,)) as pool:
+        futures = [pool.submit(_compute_chunk, *task) for task in tasks]
+        for done, future in enumerate(as_completed(futures), 1):
+            time, chunk = future.result()
+            print('%s chunk %d done (%d/%d)' % (time, chunk, done, len(tasks)))
+    return len(tasks)
+
+
+def load_matrix(out_dir, time):
+    """Minutes matrix of one slot, origins by rows and destinations by columns, in stop index order."""
+    with open(os.path.join(out_dir, 'meta.json')) as file:
+        meta = json.load(file)
+    matrix = np.full((meta['stops'], meta['stops']), UNREACHABLE, dtype=meta['dtype'])
+    slot = os.path.join(out_dir, slot_name(time))
+    for name in sorted(os.listdir(slot)):
+        if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+            with np.load(os.path.join(slot, name)) as chunk:
+                matrix[chunk['origins']] = chunk['minutes']
+    return matrix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('snapshot')
+    parser.add_argument('out')
+    parser.add_argument('--times', default='08:00:00', help='comma separated departure slots, HH:MM[:SS]')
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--max-minutes', type=int, default=180)
+    parser.add_argument('--chunk-size', type=int, default=256, help='origins per chunk (rows held by a worker)')
+    parser.add_argument('--workers', type=int, help='processes, by default one per CPU')
+    args = parser.parse_args()
+    times = [time if time.count(':') == 2 else time + ':00' for time in args.times.split(',')]
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    start = timeit.default_timer()
+    computed = compute_matrices(args.snapshot, args.out, times, speed, args.max_minutes, args.chunk_size,
+                                args.workers)
+    print('%d chunks computed in %.1f s' % (computed, timeit.default_timer() - start))
@@ -0,0 +1,36 @@
+from neo4j import GraphDatabase
+
+import queries
+
+# Migrazione una tantum dei database creati da new_dbSetup.py prima di Stop.location e ACTIVE_IN,
+# che find_near_stops (queries.FIND_NEAR_STOPS) e la velocità massima dei mezzi (queries.MAX_VEHICLE_SPEED)
+# richiedono. Si può rieseguire: tocca solo gli Stop senza location e ACTIVE_IN è creato con merge.
+#   python migrate_stops.py
+
+uri = "bolt://localhost:7687"
+username = "neo4j"
+password = "12345678"
+
+
+def migrate_stops(driver):
+    """Imposta Stop.location, crea l'indice spaziale e collega ogni Stop ai giorni in cui è servito.
+
+    Restituisce il numero di Day collegati e di Stop rimasti senza location (senza lat/lon).
+    """
+    with driver.session() as session:
+        session.run(queries.STOP_LOCATION).consume()
+        session.run(queries.STOP_LOCATION_INDEX).consume()
+        _, days = session.run(queries.STOP_ACTIVE_IN).single()
+        missing = session.run(queries.STOPS_WITHOUT_LOCATION).single()[0]
+    return days, missing
+
+
+if __name__ == '__main__':
+    driver = GraphDatabase.driver(uri, auth=(username, password))
+    print('Connessione stabilita')
+    days, missing = migrate_stops(driver)
+    print(f'Stop collegati ai giorni di servizio: {days} Day')
+    if missing:
+        print(f'Attenzione: {missing} Stop senza lat/lon restano senza location')
+    driver.close()
+    print('Migrazione completata')
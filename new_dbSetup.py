@@ -1,5 +1,7 @@
 from neo4j import GraphDatabase, exceptions
 
+import queries
+
 # Credenziali d'accesso Neo4j
 uri = "bolt://localhost:7687"
 username = "neo4j"
@@ -28,6 +30,9 @@ with driver.session() as session:
         print('Constraint e indici creati...')
     except exceptions.ClientError:
         print("Vincoli e indici già esistenti")
+    # Fuori dal try: su un DB esistente i vincoli già creati non devono saltare l'indice spaziale
+    # (per gli Stop caricati senza location e senza ACTIVE_IN c'è migrate_stops.py)
+    session.run(queries.STOP_LOCATION_INDEX)
 
     print("Inserimento del'Agenzia")
     query = """load csv with headers from  
@@ -52,13 +57,16 @@ with driver.session() as session:
     print("Inserimento degli Stop")
     query = """load csv with headers from 
             'file:///stops.txt' as csv  
-            create (:Stop {id: csv.stop_id, name: csv.stop_name, lat: toFloat(csv.stop_lat), lon: toFloat(csv.stop_lon)});"""
+            create (:Stop {id: csv.stop_id, name: csv.stop_name, lat: toFloat(csv.stop_lat), lon: toFloat(csv.stop_lon),
+                           location: point({latitude: toFloat(csv.stop_lat), longitude: toFloat(csv.stop_lon)})});"""
     session.run(query)
 
     print("Inserimento degli StopTimes")
+    # arrival_seconds/departure_seconds: secondi dalla mezzanotte del giorno di servizio, anche oltre le 24
+    # per le corse dopo mezzanotte; arrival_time/departure_time restano l'orario del giorno
     query = """CALL apoc.periodic.iterate(
             "load csv with headers from 'file:///stop_times.txt' as csv return csv",
-            "match (t:Trip {id: csv.trip_id}), (s:Stop {id: csv.stop_id}) create (t)<-[:PART_OF_TRIP]-(st:Stoptime {arrival_time: time(csv.arrival_time), departure_time: time(csv.departure_time), stop_sequence: toInteger(csv.stop_sequence)})-[:LOCATED_AT]->(s)",
+            "match (t:Trip {id: csv.trip_id}), (s:Stop {id: csv.stop_id}) with t, s, csv, [x in split(csv.arrival_time, ':') | toInteger(x)] as a, [x in split(csv.departure_time, ':') | toInteger(x)] as d create (t)<-[:PART_OF_TRIP]-(st:Stoptime {arrival_time: time({hour: a[0] % 24, minute: a[1], second: a[2]}), departure_time: time({hour: d[0] % 24, minute: d[1], second: d[2]}), arrival_seconds: a[0] * 3600 + a[1] * 60 + a[2], departure_seconds: d[0] * 3600 + d[1] * 60 + d[2], stop_sequence: toInteger(csv.stop_sequence)})-[:LOCATED_AT]->(s)",
             {batchSize:1000, parallel:true})"""
     session.run(query)
 
@@ -70,7 +78,7 @@ with driver.session() as session:
     session.run(query)
 
     query="""match (s1:Stoptime)-[p:PRECEDES]->(s2:Stoptime)
-            set p.waiting_time=duration.inSeconds(s1.departure_time, s2.arrival_time).seconds"""
+            set p.waiting_time=s2.arrival_seconds - s1.departure_seconds"""
     session.run(query)
 
     print("Assicurarsi di aver caricato il file new_calendar_dates.txt realizzato con lo script reshape.py")
@@ -90,6 +98,9 @@ with driver.session() as session:
             {batchSize:500})"""
     session.run(query)
 
+    print("Collegamento degli Stop ai giorni in cui sono serviti")
+    session.run(queries.STOP_ACTIVE_IN)
+
     print("Inserimento delle relazioni tra gli Stop vicini")
     query = """MATCH (s1:Stop)
             WITH point({latitude: s1.lat, longitude: s1.lon}) AS p1, s1
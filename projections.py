@@ -0,0 +1,213 @@
+"""Named GDS projections of the routing graph, one per (date, walking speed).
+
+Instead of the single "graph_walk" projection, ProjectionManager keeps several
+projections alive, named after the day and speed they serve, and drops the
+least recently used ones when the total sizeInBytes reported by gds.graph.list
+goes over the memory budget. The next day can be projected in the background
+so that the daily switch does not wait for a projection.
+
+A* needs its own projection, named with an _astar suffix and only projected
+when an A* query asks for it: it also carries astar_cost, waiting_time scaled
+to the nautical miles that the fastest vehicle of the day covers in that time
+(see nm_per_second). Plain projections do not depend on that speed.
+"""
+import threading
+from collections import OrderedDict
+from datetime import date as ddate, timedelta
+
+import queries
+
+METERS_PER_NAUTICAL_MILE = 1852
+# Seconds counted for a ride timed 0 s, i.e. two consecutive stops published with the same time
+MIN_HOP = 60
+
+
+def graph_name(date, speed, astar=False):
+    """Projection name for a day ('YYYY-MM-DD') and a walking speed in m/s, with astar_cost if astar."""
+    name = 'graph_walk_%s_%s' % (date.replace('-', ''), str(speed).replace('.', '_'))
+    return name + '_astar' if astar else name
+
+
+class ProjectionManager:
+    """LRU cache of routing projections under a memory budget in bytes."""
+
+    def __init__(self, driver, max_bytes=2 * 2 ** 30, prefetch_next_day=True, materialized=False):
+        self.driver = driver
+        self.max_bytes = max_bytes
+        self.prefetch_next_day = prefetch_next_day
+        # Read CHANGE edges persisted by changes_setup.py instead of computing them
+        self.materialized = materialized
+        # Projection name -> (date, speed, astar), least recently used first
+        self._lru = OrderedDict()
+        self._pending = {}
+        self._lock = threading.RLock()
+        # Date -> number of invalidations, to tell results computed on older projections
+        self._versions = {}
+        # Date -> fastest ride of the day in m/s
+        self._vehicle_speeds = {}
+
+    def __contains__(self, name):
+        return name in self._lru
+
+    def version(self, date):
+        return self._versions.get(date, 0) + self._versions.get(None, 0)
+
+    def vehicle_speed(self, date):
+        """Fastest straight-line speed in m/s between consecutive stops of a trip on date.
+
+        Rides timed 0 s count as MIN_HOP, the others as their waiting_time.
+        Raises ValueError when the day has no ride or some stops have no
+        location, which would leave faster rides out.
+        """
+        with self._lock:
+            if date in self._vehicle_speeds:
+                return self._vehicle_speeds[date]
+        with self.driver.session() as session:
+            speed, unlocated = session.run(queries.MAX_VEHICLE_SPEED, date=date, min_hop=MIN_HOP).single()
+        if unlocated:
+            raise ValueError('%d rides of %s between stops without Stop.location, set it with migrate_stops.py'
+                             % (unlocated, date))
+        if not speed:
+            raise ValueError('no ride on %s to take the vehicle speed from' % date)
+        with self._lock:
+            self._vehicle_speeds[date] = speed
+        return speed
+
+    def nm_per_second(self, date, speed):
+        """Nautical miles per second of the fastest way of moving on date, riding or walking at speed.
+
+        With astar_cost = waiting_time * nm_per_second the haversine distance
+        of gds.shortestPath.astar, in nautical miles, is the distance left
+        at this speed. A ride timed 0 s covers its distance at no cost and
+        would make the speed infinite, so it is counted as MIN_HOP here:
+        A* only underestimates as far as no such ride is faster than its
+        stops' distance over MIN_HOP.
+        """
+        return max(self.vehicle_speed(date), speed) / METERS_PER_NAUTICAL_MILE
+
+    def get(self, date, speed, evict=True, astar=False):
+        """Name of the projection serving (date, speed), projecting it if needed.
+
+        A known projection is only moved to the recently used end; projecting
+        runs outside the lock, once per name, and is the only case followed
+        by gds.graph.list and eviction (evict=False leaves that to the caller).
+        astar=True asks for the projection with astar_cost, which raises
+        ValueError where the vehicle speed of the day cannot be computed.
+        """
+        name = graph_name(date, speed, astar)
+        done = None
+        while done is None:
+            with self._lock:
+                if name in self._lru:
+                    self._lru.move_to_end(name)
+                    break
+                pending = self._pending.get(name)
+                if pending is None:
+                    done = self._pending[name] = threading.Event()
+                    break
+            pending.wait()
+        if done is not None:
+            try:
+                if not self.exists(name):
+                    self.project(date, speed, astar)
+                with self._lock:
+                    self._lru[name] = (date, speed, astar)
+            finally:
+                with self._lock:
+                    self._pending.pop(name, None)
+                done.set()
+            if evict:
+                self.evict((name,))
+        if self.prefetch_next_day:
+            self.prefetch(str(ddate.fromisoformat(date) + timedelta(days=1)), speed, astar)
+        return name
+
+    def project(self, date, speed, astar=False):
+        name = graph_name(date, speed, astar)
+        with self.driver.session() as session:
+            if astar:
+                query = queries.PROJECTION_MATERIALIZED_ASTAR if self.materialized else queries.PROJECTION_ASTAR
+                session.run(query, graph_name=name, date=date, speed=speed,
+                            nm_per_second=self.nm_per_second(date, speed)).consume()
+            else:
+                query = queries.PROJECTION_MATERIALIZED if self.materialized else queries.PROJECTION
+                session.run(query, graph_name=name, date=date, speed=speed).consume()
+        return name
+
+    def prefetch(self, date, speed, astar=False):
+        """Project (date, speed) in a background thread, unless it is already there."""
+        name = graph_name(date, speed, astar)
+        with self._lock:
+            if name in self._lru or name in self._pending:
+                return
+            done = self._pending[name] = threading.Event()
+        threading.Thread(target=self._prefetch, args=(date, speed, astar, done), daemon=True).start()
+
+    def _prefetch(self, date, speed, astar, done):
+        name = graph_name(date, speed, astar)
+        try:
+            if not self.exists(name):
+                self.project(date, speed, astar)
+            with self._lock:
+                self._lru[name] = (date, speed, astar)
+                # A prefetched projection has not been used yet: it goes first in line for the next eviction...
+                self._lru.move_to_end(name, last=False)
+                # ...and neither it nor the projection in use make room for it
+                keep = (name, next(reversed(self._lru)))
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+            done.set()
+        self.evict(keep)
+
+    def exists(self, name):
+        with self.driver.session() as session:
+            return session.run(queries.GRAPH_EXISTS, graph_name=name).single()[0]
+
+    def sizes(self):
+        """sizeInBytes of every projection managed here, as reported by gds.graph.list."""
+        with self.driver.session() as session:
+            result = session.run(queries.GRAPH_SIZES)
+            sizes = {name: size for name, size in result.values()}
+        with self._lock:
+            return {name: sizes[name] for name in self._lru if name in sizes}
+
+    def evict(self, keep=()):
+        """Drop least recently used projections, other than those named in keep, until the budget is met."""
+        sizes = self.sizes()
+        with self._lock:
+            total = sum(sizes.values())
+            victims = []
+            for name in self._lru:
+                if total <= self.max_bytes:
+                    break
+                if name in keep or name in self._pending:
+                    continue
+                victims.append(name)
+                total -= sizes.get(name, 0)
+        for name in victims:
+            self.drop(name)
+
+    def drop(self, name):
+        with self._lock:
+            self._lru.pop(name, None)
+        with self.driver.session() as session:
+            session.run(queries.GRAPH_DROP, graph_name=name).consume()
+
+    def expire(self, before, names=None):
+        """Drop the projections of the days before the date before ('YYYY-MM-DD'), only those in names if given."""
+        for name, (day, _, _) in list(self._lru.items()):
+            if day < before and name not in self._pending and (names is None or name in names):
+                self.drop(name)
+
+    def invalidate(self, date=None):
+        """Drop the projections of date, or all of them when date is None."""
+        with self._lock:
+            self._versions[date] = self._versions.get(date, 0) + 1
+            if date is None:
+                self._vehicle_speeds.clear()
+            else:
+                self._vehicle_speeds.pop(date, None)
+        for name, (day, _, _) in list(self._lru.items()):
+            if date is None or day == date:
+                self.drop(name)
@@ -1,8 +1,15 @@
+from walking import FootNodeIndex, WalkingTable
+
+
 class App:
     """In this file we are going to extract from OSM crossings mapped as nodes"""
 
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, walking_table=None):
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        # Distanze pedonali precalcolate da walking.py: i tratti a piedi diventano una lookup
+        self.walking = WalkingTable.load(walking_table) if walking_table else None
+        # Indice dei FootNode per lo snapping, caricato alla prima richiesta
+        self._footnodes = None
 
     def close(self):
         self.driver.close()
@@ -172,6 +179,12 @@ class App:
         result = tx.run(query)
         return result.values()
 
+    @property
+    def footnodes(self):
+        if self._footnodes is None:
+            self._footnodes = FootNodeIndex.from_neo4j(self.driver)
+        return self._footnodes
+
     def get_nearest_footnode_with_distance(self, lat: float, lon: float) -> tuple:
         """
         Trova il FootNode più vicino alle coordinate specificate e restituisce la distanza euclidea.
@@ -180,36 +193,43 @@ class App:
         :param lon: Longitudine del punto di interesse.
         :return: Una tupla con l'ID o nome del FootNode più vicino e la distanza euclidea.
         """
-        with self.driver.session() as session:
-            result = session.run("""
-                MATCH (footnode:FootNode)
-                WITH footnode, point({latitude: $lat, longitude: $lon}) AS location
-                RETURN footnode.id AS footnode_id, 
-                       point.distance(point({latitude: footnode.longitude, longitude: footnode.latitude}), location) AS distance
-                ORDER BY distance
-                LIMIT 1
-            """, lat=lat, lon=lon)
-
-            record = result.single()
+        return self.footnodes.nearest(lat, lon)
 
-            if record is None:
-                return None, float('inf')
+    def get_nearest_footnodes(self, coords):
+        """
+        Snapping di un intero array di coordinate in una sola chiamata.
 
-            return record['footnode_id'], record['distance']
+        :param coords: Lista di coppie (lat, lon).
+        :return: Due array con l'ID del FootNode più vicino (None se assente) e la distanza in metri.
+        """
+        coords = list(coords)
+        return self.footnodes.nearest_many([lat for lat, _ in coords], [lon for _, lon in coords])
 
-    def get_walking_distance(self, footnode_start: str, footnode_end: str) -> float:
+    def get_walking_distance(self, footnode_start: str, footnode_end: str, stop_end: bool = False) -> float:
         """
         Calcola la distanza a piedi tra due FootNode nel grafo utilizzando i percorsi pedonali nel database Neo4j.
 
-        :param footnode_start: Il nome o ID del nodo di partenza (FootNode).
-        :param footnode_end: Il nome o ID del nodo di arrivo (FootNode).
+        Con stop_end=True il nodo di arrivo è uno Stop: con una tabella di walking.py la distanza
+        FootNode -> Stop entro max_distance è letta dalla tabella, esatta, senza interrogare il grafo.
+        Tra due FootNode si usa sempre apoc.algo.dijkstra. Gli ID di FootNode (OSM) e di Stop (GTFS)
+        possono coincidere, per questo è il chiamante a dire quale dei due è footnode_end.
+
+        :param footnode_start: L'ID del FootNode di partenza.
+        :param footnode_end: L'ID del nodo di arrivo (FootNode, o Stop con stop_end=True).
+        :param stop_end: True se footnode_end è l'ID di uno Stop.
         :return: La distanza a piedi in metri o un valore molto grande se non esiste un percorso.
         """
+        if footnode_start == footnode_end and not stop_end:
+            return 0
+        if stop_end and self.walking is not None:
+            distance = self.walking.from_footnode(footnode_start, footnode_end)
+            if distance < float('inf'):
+                return distance
+
         with self.driver.session() as session:
             result = session.run("""
-                MATCH (start:FootNode {name: $footnode_start})
-                OPTIONAL MATCH (start)-[:SHORTEST_ROUTE_TO|FOOT_ROUTE|CONTAINS|CONTINUE_ON_FOOTWAY|CONTINUE_ON_FOOTWAY_BY_CROSSING_ROAD*]->(end:FootNode {name: $footnode_end})
-                WHERE end IS NOT NULL
+                MATCH (start:FootNode {id: $footnode_start})
+                MATCH (end:%s {id: $footnode_end})
                 CALL apoc.algo.dijkstra(
                     start, end, 
                     'SHORTEST_ROUTE_TO|FOOT_ROUTE|CONTAINS>|<CONTAINS|CONTINUE_ON_FOOTWAY|CONTINUE_ON_FOOTWAY_BY_CROSSING_ROAD', 
@@ -217,7 +237,7 @@ class App:
                 ) 
                 YIELD weight
                 RETURN weight AS distance
-            """, footnode_start=footnode_start, footnode_end=footnode_end)
+            """ % ('Stop' if stop_end else 'FootNode'), footnode_start=footnode_start, footnode_end=footnode_end)
 
             record = result.single()
             if record is None:
@@ -230,8 +250,7 @@ class App:
         end_coords = (row.iloc[2], row.iloc[3])
 
         # Trova il FootNode più vicino a ciascuna coppia di coordinate
-        footnode_start, _ = self.get_nearest_footnode_with_distance(start_coords[0], start_coords[1])
-        footnode_end, _ = self.get_nearest_footnode_with_distance(end_coords[0], end_coords[1])
+        (footnode_start, footnode_end), _ = self.get_nearest_footnodes([start_coords, end_coords])
 
         if footnode_start and footnode_end:
             distance_meters = self.get_walking_distance(footnode_start, footnode_end)
@@ -252,7 +271,7 @@ class App:
         print(f"FootNode trovato: {footnode_id} a distanza {footnode_distance} metri")
 
         # Calcola la distanza a piedi dal FootNode trovato allo Stop specificato
-        walking_distance = self.get_walking_distance(footnode_id, node_id)
+        walking_distance = self.get_walking_distance(footnode_id, node_id, stop_end=True)
 
         if walking_distance == float('inf'):
             print("Non è stato possibile trovare un percorso pedonale tra il FootNode e lo Stop specificato.")
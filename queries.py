@@ -0,0 +1,400 @@
+"""Named, parameterized Cypher statements used by App and ProjectionManager.
+
+The text of every statement is constant and all the values (dates, times,
+coordinates, speeds, stop names, projection names) travel as parameters, so
+Neo4j plans each statement once and serves later calls from its plan cache.
+"""
+
+# Fastest ride of the day in m/s, the straight-line distance between consecutive stops over the time taken,
+# $min_hop seconds for a ride timed 0, and the number of rides between stops without a location, which it cannot see.
+# Scales astar_cost, the weight read by gds.shortestPath.astar (see ASTAR)
+MAX_VEHICLE_SPEED = """match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2:Stoptime)
+        match (st)-[:LOCATED_AT]->(s1:Stop)
+        match (st2)-[:LOCATED_AT]->(s2:Stop)
+        return max(point.distance(s1.location, s2.location) / case when p.waiting_time > 0 then p.waiting_time else $min_hop end) as speed,
+            count(case when s1.location is null or s2.location is null then 1 end) as unlocated"""
+
+PROJECTION = """CALL gds.graph.project.cypher(
+        $graph_name,
+        "match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return id(st) AS id, st.stop_sequence as stop_sequence,s.lon as lon,s.lat as lat",
+        "match (d:Day{day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop) match (r:Route)<-[:USES]-(t) with st as source,s as service, t.id as trip_source, stops as stops,r.id as line match (service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) where t.id <> trip_source and source.arrival_seconds + toInteger(w.distance/$speed) < st.departure_seconds match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(r:Route)  where r.id <> line with source,service,trip_source,stops,line,r.id as other_line,w.distance as walking_distance,apoc.agg.minItems(st,st.departure_seconds).items as targets unwind targets  as target match (target)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) return id(source) as source, id(target) as target, ':CHANGE' as type,target.departure_seconds - source.arrival_seconds + toInteger(w.distance/$speed) as waiting_time, toInteger(w.distance/$speed) as walking_time UNION ALL match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2) return id(st) as source, id(st2) as target, type(p) as type, p.waiting_time as waiting_time, 0 as walking_time",
+        {parameters: {date: $date, speed: $speed}})
+        YIELD graphName, nodeCount, relationshipCount
+        RETURN graphName, nodeCount, relationshipCount"""
+
+# Same projection, reading the CHANGE edges written by changes_setup.py
+PROJECTION_MATERIALIZED = """CALL gds.graph.project.cypher(
+        $graph_name,
+        "match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return id(st) AS id, st.stop_sequence as stop_sequence,s.lon as lon,s.lat as lat",
+        "match (st:Stoptime)-[c:CHANGE]->(st2:Stoptime) where c.day = date($date) and c.speed = $speed return id(st) as source, id(st2) as target, type(c) as type, c.waiting_time as waiting_time, c.walking_time as walking_time UNION ALL match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2) return id(st) as source, id(st2) as target, type(p) as type, p.waiting_time as waiting_time, 0 as walking_time",
+        {parameters: {date: $date, speed: $speed}})
+        YIELD graphName, nodeCount, relationshipCount
+        RETURN graphName, nodeCount, relationshipCount"""
+
+# PROJECTION plus astar_cost, the weight read by gds.shortestPath.astar (see ASTAR), scaled by $nm_per_second
+PROJECTION_ASTAR = """CALL gds.graph.project.cypher(
+        $graph_name,
+        "match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return id(st) AS id, st.stop_sequence as stop_sequence,s.lon as lon,s.lat as lat",
+        "match (d:Day{day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop) match (r:Route)<-[:USES]-(t) with st as source,s as service, t.id as trip_source, stops as stops,r.id as line match (service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) where t.id <> trip_source and source.arrival_seconds + toInteger(w.distance/$speed) < st.departure_seconds match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(r:Route)  where r.id <> line with source,service,trip_source,stops,line,r.id as other_line,w.distance as walking_distance,apoc.agg.minItems(st,st.departure_seconds).items as targets unwind targets  as target match (target)-[:LOCATED_AT]->(s2:Stop)-[w:WALK_TO]->(stops) return id(source) as source, id(target) as target, ':CHANGE' as type,target.departure_seconds - source.arrival_seconds + toInteger(w.distance/$speed) as waiting_time, toInteger(w.distance/$speed) as walking_time, (target.departure_seconds - source.arrival_seconds + toInteger(w.distance/$speed)) * $nm_per_second as astar_cost UNION ALL match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2) return id(st) as source, id(st2) as target, type(p) as type, p.waiting_time as waiting_time, 0 as walking_time, p.waiting_time * $nm_per_second as astar_cost",
+        {parameters: {date: $date, speed: $speed, nm_per_second: $nm_per_second}})
+        YIELD graphName, nodeCount, relationshipCount
+        RETURN graphName, nodeCount, relationshipCount"""
+
+# Same projection, reading the CHANGE edges written by changes_setup.py, plus astar_cost
+PROJECTION_MATERIALIZED_ASTAR = """CALL gds.graph.project.cypher(
+        $graph_name,
+        "match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop) return id(st) AS id, st.stop_sequence as stop_sequence,s.lon as lon,s.lat as lat",
+        "match (st:Stoptime)-[c:CHANGE]->(st2:Stoptime) where c.day = date($date) and c.speed = $speed return id(st) as source, id(st2) as target, type(c) as type, c.waiting_time as waiting_time, c.walking_time as walking_time, c.waiting_time * $nm_per_second as astar_cost UNION ALL match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[p:PRECEDES]->(st2) return id(st) as source, id(st2) as target, type(p) as type, p.waiting_time as waiting_time, 0 as walking_time, p.waiting_time * $nm_per_second as astar_cost",
+        {parameters: {date: $date, speed: $speed, nm_per_second: $nm_per_second}})
+        YIELD graphName, nodeCount, relationshipCount
+        RETURN graphName, nodeCount, relationshipCount"""
+
+GRAPH_EXISTS = "CALL gds.graph.exists($graph_name) YIELD exists RETURN exists"
+
+GRAPH_SIZES = "CALL gds.graph.list() YIELD graphName, sizeInBytes RETURN graphName, sizeInBytes"
+
+GRAPH_DROP = "CALL gds.graph.drop($graph_name, false) YIELD graphName RETURN graphName"
+
+METRICS = """CALL gds.graph.list($graph_name)
+        YIELD nodeCount, relationshipCount, degreeDistribution, density, sizeInBytes
+        RETURN nodeCount, relationshipCount, degreeDistribution, density, sizeInBytes"""
+
+# $config: {} for exact scores, {samplingSize, samplingSeed} for sampled ones (see betweenness.py)
+BETWEENNESS = """CALL gds.betweenness.stream($graph_name, $config)
+        YIELD nodeId, score
+        with gds.util.asNode(nodeId) as st, score
+        match (st)-[:LOCATED_AT]->(s:Stop)
+        return s.name,st.departure_time AS time,s.lat as lat,s.lon AS lon, score
+        ORDER BY score DESC"""
+
+# Scores summed per stop and hour of departure on the server, times $scale (nodes / samplingSize when sampled)
+BETWEENNESS_BY_STOP_HOUR = """CALL gds.betweenness.stream($graph_name, $config)
+        YIELD nodeId, score
+        with gds.util.asNode(nodeId) as st, score
+        match (st)-[:LOCATED_AT]->(s:Stop)
+        with s, st.departure_time.hour as hour, sum(score) * $scale as score, count(*) as stoptimes
+        return s.id as stop_id, s.name as stop_name, s.lat as lat, s.lon as lon, hour, score, stoptimes
+        order by stop_id, hour"""
+
+BETWEENNESS_WRITE = """unwind $rows as row
+        match (s:Stop {id: row.stop_id})
+        match (d:Day {day: date($date)})
+        merge (s)-[b:BETWEENNESS_IN {hour: row.hour, speed: $speed}]->(d)
+        set b.score = row.score, b.stoptimes = row.stoptimes, b.sampling_size = $sampling_size"""
+
+BETWEENNESS_READ = """match (s:Stop)-[b:BETWEENNESS_IN {speed: $speed}]->(d:Day {day: date($date)})
+        return s.id as stop_id, s.name as stop_name, s.lat as lat, s.lon as lon, b.hour as hour, b.score as score,
+        b.stoptimes as stoptimes
+        order by stop_id, hour"""
+
+# Point index seek on Stop.location, then keep the stops served on the day
+FIND_NEAR_STOPS = """match (s:Stop)
+        where point.distance(s.location, point({latitude: $lat, longitude: $lon})) < $radius
+        and exists { (s)-[:ACTIVE_IN]->(:Day {day: date($date)}) }
+        return distinct s.name"""
+
+FIND_NEAR_STOPS_MANY = """unwind range(0, size($points) - 1) as i
+        with i, point({latitude: $points[i][0], longitude: $points[i][1]}) as p
+        optional match (s:Stop)
+        where point.distance(s.location, p) < $radius
+        and exists { (s)-[:ACTIVE_IN]->(:Day {day: date($date)}) }
+        return i, collect(distinct s.name) as names order by i"""
+
+# What FIND_NEAR_STOPS reads, created by new_dbSetup.py and by migrate_stops.py on older databases
+STOP_LOCATION_INDEX = "create point index stop_location_index if not exists for (s:Stop) on (s.location)"
+
+STOP_LOCATION = """match (s:Stop) where s.location is null and s.lat is not null and s.lon is not null
+        call { with s set s.location = point({latitude: s.lat, longitude: s.lon}) } in transactions of 10000 rows"""
+
+STOP_ACTIVE_IN = """CALL apoc.periodic.iterate(
+        "match (d:Day) return d",
+        "match (d)<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(:Trip)<-[:PART_OF_TRIP]-(:Stoptime)-[:LOCATED_AT]->(s:Stop) with distinct d, s merge (s)-[:ACTIVE_IN]->(d)",
+        {batchSize: 1})
+        YIELD batches, total
+        RETURN batches, total"""
+
+STOPS_WITHOUT_LOCATION = "match (s:Stop) where s.location is null return count(s)"
+
+# Expands the winning path into one row per Stoptime pair; shared by the routing statements
+PATH_ROWS = """unwind pairs as p
+        match (s1:Stoptime)
+        where id(s1)=id(p[0])
+        match (s2:Stoptime)
+        where id(s2)=id(p[1])
+        match (r:Route)<-[:USES]-(t:Trip)<-[:PART_OF_TRIP]-(s1)
+        match (s1)-[:LOCATED_AT]->(s:Stop)
+        match (next_r:Route)<-[:USES]-(next_t:Trip)<-[:PART_OF_TRIP]-(s2)
+        match (s2)-[:LOCATED_AT]->(next_s:Stop)
+        return t.id as trip,s1.departure_time as departure,r.id as line, s.name as starting_stop_name,s.id as starting_stop_id,[s.lat,s.lon] as starting_stop_coordinates,
+        next_t.id as next_trip,next_s.name as next_stop,next_s.id as next_stop_id,[next_s.lat,next_s.lon] as next_stop_coordinates,next_r.id as next_line
+                ,s2.arrival_time as arrival"""
+
+# Shortest path from the Stoptime s to the Stoptime t, totalCost in seconds
+DIJKSTRA = """
+        CALL gds.shortestPath.dijkstra.stream($graph_name, {
+                                                    sourceNode: s,
+                                                    targetNode: t,
+                                                    relationshipWeightProperty: 'waiting_time'
+                                                    })
+        YIELD index, sourceNode, targetNode, totalCost, path, nodeIds"""
+
+# Same with A*: GDS measures its haversine heuristic in nautical miles, so the weight is astar_cost, waiting_time
+# times the distance in nautical miles covered per second at the fastest speed of the day, and totalCost is turned
+# back into seconds
+ASTAR = """
+        CALL gds.shortestPath.astar.stream($graph_name, {
+                                                    sourceNode: s,
+                                                    targetNode: t,
+                                                    latitudeProperty: 'lat',
+                                                    longitudeProperty: 'lon',
+                                                    relationshipWeightProperty: 'astar_cost'
+                                                    })
+        YIELD index, sourceNode, targetNode, totalCost as distance, path, nodeIds
+        with s, t, index, sourceNode, targetNode, distance / $nm_per_second as totalCost, path, nodeIds"""
+
+# Every (departure at $source, later Stoptime at $target) pair as s, t, before the shortest path call. $departure and
+# $endtime are seconds on the clock of the service day, like Stoptime.departure_seconds (past 86400 after midnight)
+ROUTING_PAIRS = """match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[r:LOCATED_AT]->(s:Stop {name: $source})
+        where st.departure_seconds > $departure
+        match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(rou:Route)
+        with rou.id as source_line ,apoc.agg.minItems(st, st.departure_seconds).items as sources
+        with collect(sources) as sources
+        unwind sources as s with s[0] as the_source
+        match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)
+        with collect(id(st)) as target_ids,the_source as s
+        unwind target_ids as tg_id
+        match (st2:Stoptime)-[r:LOCATED_AT]->(stop:Stop {name: $target})
+        where id(st2) = tg_id and st2.departure_seconds < $endtime
+        and st2.departure_seconds > s.departure_seconds
+        with s as s,st2 as t order by s.departure_seconds, t.departure_seconds
+        """
+
+ROUTING_BEST = """
+            with s as source_,t as target_t,gds.util.asNode(sourceNode) as source,gds.util.asNode(targetNode) as target,gds.util.asNode(sourceNode).departure_time +duration({seconds:totalCost}) as seconds,totalCost as cost,gds.util.asNode(targetNode).arrival_seconds as arrival_time, [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes_in_path,[r in relationships(path)|[startNode(r),endNode(r)]] as pairs
+        order by arrival_time,cost limit 1
+        """ + PATH_ROWS
+
+ROUTING = ROUTING_PAIRS + DIJKSTRA + ROUTING_BEST
+
+ROUTING_ASTAR = ROUTING_PAIRS + ASTAR + ROUTING_BEST
+
+ROUTING_BETWEEN_POINTS_PAIRS = """match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[r:LOCATED_AT]->(s:Stop)
+        where s.name in $start_names and st.departure_seconds - point.distance(point({latitude: s.lat, longitude: s.lon}),point({latitude: $start_lat, longitude: $start_lon}))/ $speed > $departure
+        match (st)-[:PART_OF_TRIP]->(t)-[:USES]->(rou:Route) with rou.id as soruce_line ,apoc.agg.minItems(st, st.departure_seconds).items as sources
+        with collect(sources) as sources
+        unwind sources as s with s[0] as the_source
+        match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)
+        with collect(id(st)) as target_ids,the_source as s
+        unwind target_ids as tg_id
+        match (st2:Stoptime)-[r:LOCATED_AT]->(stop:Stop)
+        where id(st2) = tg_id and stop.name in $end_names and st2.departure_seconds + point.distance(point({latitude: stop.lat, longitude: stop.lon}),point({latitude: $end_lat, longitude: $end_lon}))/ $speed < $endtime
+        and st2.departure_seconds > s.departure_seconds
+        with s as s,st2 as t order by s.departure_seconds, t.departure_seconds
+        """
+
+ROUTING_BETWEEN_POINTS_BEST = """
+        with s as source_,t as target_t,gds.util.asNode(sourceNode) as source,
+        gds.util.asNode(targetNode) as target,
+        gds.util.asNode(sourceNode).departure_time +duration({seconds:totalCost}) as seconds,
+        totalCost as cost,
+        gds.util.asNode(targetNode).arrival_seconds as arrival_time,
+        [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes_in_path,[r in relationships(path)|[startNode(r),endNode(r)]] as pairs
+        match (target)-[:LOCATED_AT]->(endStop:Stop)
+        match (source)-[:LOCATED_AT]->(startStop:Stop)
+        with endStop as endStop, startStop as startStop, source_ as source_ , target_t as target_t, cost + point.distance(point({latitude: startStop.lat, longitude: startStop.lon}),point({latitude: $start_lat, longitude: $start_lon}))/ $speed + point.distance(point({latitude: endStop.lat, longitude: endStop.lon}),point({latitude: $end_lat, longitude: $end_lon}))/ $speed  as cost, seconds as seconds, arrival_time as arrival_time, arrival_time + point.distance(point({latitude: endStop.lat, longitude: endStop.lon}),point({latitude: $end_lat, longitude: $end_lon}))/ $speed as final_time, pairs as pairs
+        order by final_time, cost
+        limit 1
+        """ + PATH_ROWS
+
+ROUTING_BETWEEN_POINTS = ROUTING_BETWEEN_POINTS_PAIRS + DIJKSTRA + ROUTING_BETWEEN_POINTS_BEST
+
+ROUTING_BETWEEN_POINTS_ASTAR = ROUTING_BETWEEN_POINTS_PAIRS + ASTAR + ROUTING_BETWEEN_POINTS_BEST
+
+# Stoptimes of the day with their times in seconds, to search the projection outside of GDS (expanded.py)
+EXPANDED_NODES = """match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop)
+        return id(st) as id,
+        st.departure_seconds as departure, st.arrival_seconds as arrival,
+        s.name as name, s.lat as lat, s.lon as lon"""
+
+EXPANDED_EDGES = """CALL gds.graph.relationshipProperty.stream($graph_name, 'waiting_time')
+        YIELD sourceNodeId, targetNodeId, relationshipType, propertyValue
+        RETURN sourceNodeId, targetNodeId, relationshipType = 'PRECEDES' as ride, propertyValue"""
+
+# Rows of a path given as [id(Stoptime), id(Stoptime)] pairs
+EXPANDED_PATH = """unwind $pair_ids as ids
+        match (a:Stoptime) where id(a) = ids[0]
+        match (b:Stoptime) where id(b) = ids[1]
+        with collect([a, b]) as pairs
+        """ + PATH_ROWS
+
+# Whether trips of $date still run after midnight, false without the Day or its rides (window.py)
+OVERNIGHT_SERVICE = """return exists { match (:Day {day: date($date)})<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)
+        where st.departure_seconds >= $day_seconds } as service"""
+
+# CHANGE edges from the Stoptimes of $date to the first departure of every other line of $next_date at the WALK_TO
+# neighbours, within $max_wait; the next day's times are shifted by $day_seconds (window.py)
+OVERNIGHT_CHANGES = """match (d:Day {day: date($date)})<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop)
+        where st.arrival_seconds > $day_seconds - $max_wait
+        match (t)-[:USES]->(r:Route)
+        with st, stops, r.id as line
+        match (next:Day {day: date($next_date)})<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(t2:Trip)<-[:PART_OF_TRIP]-(st2:Stoptime)-[:LOCATED_AT]->(:Stop)-[w:WALK_TO]->(stops)
+        where st.arrival_seconds + toInteger(w.distance / $speed) < st2.departure_seconds + $day_seconds
+        and st2.departure_seconds + $day_seconds < st.arrival_seconds + $max_wait
+        match (t2)-[:USES]->(r2:Route) where r2.id <> line
+        with st, r2.id as other_line, toInteger(w.distance / $speed) as walking_time,
+            apoc.agg.minItems(st2, st2.departure_seconds).items as targets
+        unwind targets as target
+        return id(st) as source, id(target) as target,
+            target.departure_seconds + $day_seconds - st.arrival_seconds + walking_time as waiting_time"""
+
+DISTANCE_FROM_A_STOP = """match (s:Stop {id: $stop_id})
+        with point({latitude: s.lat, longitude: s.lon}) as p1, point({latitude: $lat, longitude: $lon}) as p2
+        return point.distance(p1, p2)"""
+
+NUMBER_OF_STOPS = """match (d:Day {day:date($date)})<-[:VALID_IN]-(ser:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(s:Stop)
+        return count(distinct s)"""
+
+HOURS_OF_SERVICE = """match (d:Day {day:date($date)})<-[:VALID_IN]-(s:Service)<-[:SERVICE_TYPE]-(t:Trip)<-[:PART_OF_TRIP]-(st:Stoptime)-[:LOCATED_AT]->(stops:Stop)
+        match (r:Route)<-[:USES]-(t)
+        with r.id as line,apoc.agg.minItems(st,st.departure_seconds).items as min_time,
+            apoc.agg.maxItems(st,st.arrival_seconds).items as max_time
+        unwind min_time as starting
+        unwind max_time as ending
+        with line as line,starting.departure_time as departs,ending.arrival_time as arrive,
+            (ending.arrival_seconds - starting.departure_seconds) / 3600 as duration
+        return avg(duration)"""
+
+# Pedestrian network (FootNode graph): the relationships followed by App.get_walking_distance, both ways
+FOOT_NODES = """match (f:FootNode)
+        return elementId(f) as node, f.id as id, f.latitude as lat, f.longitude as lon"""
+
+FOOT_EDGES = """match (a)-[r:SHORTEST_ROUTE_TO|FOOT_ROUTE|CONTAINS|CONTINUE_ON_FOOTWAY|CONTINUE_ON_FOOTWAY_BY_CROSSING_ROAD]->(b)
+        where r.length is not null
+        return elementId(a) as source, elementId(b) as target, r.length as length"""
+
+# FootNode.location built with latitude and longitude in the right places, under a point index
+FOOTNODE_LOCATION = """match (f:FootNode) where f.latitude is not null and f.longitude is not null
+        call { with f set f.location = point({latitude: f.latitude, longitude: f.longitude}) } in transactions of 10000 rows"""
+
+FOOTNODE_LOCATION_INDEX = "create point index footnode_location_index if not exists for (f:FootNode) on (f.location)"
+
+# Bounded by $radius so that the point index is used: one row per point of $points ([lat, lon] pairs)
+# with a FootNode closer than $radius
+NEAREST_FOOTNODE = """unwind range(0, size($points) - 1) as i
+        with i, point({latitude: $points[i][0], longitude: $points[i][1]}) as location
+        call {
+            with location
+            match (f:FootNode) where point.distance(f.location, location) < $radius
+            return f.id as footnode_id, point.distance(f.location, location) as distance
+            order by distance limit 1
+        }
+        return i, footnode_id, distance"""
+
+STOP_COORDINATES = "match (s:Stop) return s.id, s.lat, s.lon"
+
+WALK_TO_DELETE = """match (:Stop)-[w:WALK_TO]->(:Stop)
+        call { with w delete w } in transactions of 10000 rows"""
+
+WALK_TO_WRITE = """unwind $rows as row
+        match (s1:Stop {id: row.source}), (s2:Stop {id: row.target})
+        merge (s1)-[w:WALK_TO]->(s2)
+        set w.distance = row.distance"""
+
+# Incremental feed updates (feed_update.py): every statement works on a batch of rows ($rows) or ids
+FEED_DELETE_STOPTIMES = """unwind $trip_ids as trip_id
+        match (t:Trip {id: trip_id})<-[:PART_OF_TRIP]-(st:Stoptime)
+        detach delete st"""
+
+FEED_DELETE_TRIPS = """unwind $trip_ids as trip_id
+        match (t:Trip {id: trip_id})
+        detach delete t"""
+
+FEED_MERGE_ROUTES = """unwind $rows as row
+        merge (r:Route {id: row.route_id})
+        set r.short_name = row.short_name, r.long_name = row.long_name, r.type = row.type
+        with r
+        match (a:Agency {name: $agency})
+        merge (a)-[:OPERATES]->(r)"""
+
+FEED_DELETE_ROUTES = """unwind $route_ids as route_id
+        match (r:Route {id: route_id})
+        detach delete r"""
+
+FEED_MERGE_SERVICES = """unwind $rows as row
+        merge (s:Service {service_id: row.service_id})
+        with s, row
+        call { with s match (s)-[v:VALID_IN]->(:Day) delete v }
+        call { with s match (t:Trip {service_id: s.service_id}) merge (t)-[:SERVICE_TYPE]->(s) }
+        unwind row.days as day
+        merge (d:Day {day: date(day.day)})
+        set d.exception_type = day.exception_type
+        merge (s)-[:VALID_IN]->(d)"""
+
+FEED_DELETE_SERVICES = """unwind $service_ids as service_id
+        match (s:Service {service_id: service_id})
+        detach delete s"""
+
+FEED_MERGE_STOPS = """unwind $rows as row
+        merge (s:Stop {id: row.stop_id})
+        set s.name = row.name, s.lat = row.lat, s.lon = row.lon,
+        s.location = point({latitude: row.lat, longitude: row.lon})"""
+
+FEED_DELETE_STOPS = """unwind $stop_ids as stop_id
+        match (s:Stop {id: stop_id})
+        detach delete s"""
+
+FEED_DELETE_STOP_WALK_TO = """unwind $stop_ids as stop_id
+        match (:Stop {id: stop_id})-[w:WALK_TO]-(:Stop)
+        delete w"""
+
+FEED_MERGE_TRIPS = """unwind $rows as row
+        merge (t:Trip {id: row.trip_id})
+        set t.service_id = row.service_id, t.direction_id = row.direction_id, t.shape_id = row.shape_id,
+        t.headsign = row.headsign
+        with t, row
+        call { with t match (t)-[old:USES|SERVICE_TYPE]->() delete old }
+        call { with t, row match (r:Route {id: row.route_id}) merge (t)-[:USES]->(r) }
+        call { with t, row match (s:Service {service_id: row.service_id}) merge (t)-[:SERVICE_TYPE]->(s) }"""
+
+FEED_CREATE_STOPTIMES = """unwind $rows as row
+        match (t:Trip {id: row.trip_id}), (s:Stop {id: row.stop_id})
+        create (t)<-[:PART_OF_TRIP]-(st:Stoptime {arrival_time: time(row.arrival_time),
+        departure_time: time(row.departure_time), arrival_seconds: row.arrival_seconds,
+        departure_seconds: row.departure_seconds, stop_sequence: row.stop_sequence})-[:LOCATED_AT]->(s)"""
+
+# Same rule as new_dbSetup.py, restricted to the given trips
+FEED_CREATE_PRECEDES = """unwind $trip_ids as trip_id
+        match (s1:Stoptime)-[:PART_OF_TRIP]->(t:Trip {id: trip_id}), (s2:Stoptime)-[:PART_OF_TRIP]->(t)
+        where s2.stop_sequence = s1.stop_sequence + 1
+        create (s1)-[:PRECEDES {waiting_time: s2.arrival_seconds - s1.departure_seconds}]->(s2)"""
+
+FEED_ACTIVE_IN = """match (d:Day {day: date($day)})
+        call { with d match (:Stop)-[a:ACTIVE_IN]->(d) delete a }
+        call { with d
+            match (d)<-[:VALID_IN]-(:Service)<-[:SERVICE_TYPE]-(:Trip)<-[:PART_OF_TRIP]-(:Stoptime)-[:LOCATED_AT]->(s:Stop)
+            with distinct d, s
+            merge (s)-[:ACTIVE_IN]->(d) }"""
+
+CHANGE_SPEEDS = """match ()-[c:CHANGE]->() where c.day = date($day)
+        return distinct c.speed"""
+
+# arrival_seconds/departure_seconds of the Stoptimes loaded before they existed, from the times of day: along a trip a
+# time earlier than the previous one has gone past midnight. PRECEDES waiting_time is recomputed on them
+STOPTIME_SECONDS = """CALL apoc.periodic.iterate(
+        "match (t:Trip) where exists { (t)<-[:PART_OF_TRIP]-(st:Stoptime) where st.departure_seconds is null } return t",
+        "match (t)<-[:PART_OF_TRIP]-(st:Stoptime)
+         with st order by st.stop_sequence
+         with collect(st) as stoptimes
+         with stoptimes, reduce(clock = [], st in stoptimes | clock + [
+             st.arrival_time.hour * 3600 + st.arrival_time.minute * 60 + st.arrival_time.second,
+             st.departure_time.hour * 3600 + st.departure_time.minute * 60 + st.departure_time.second]) as clock
+         with stoptimes, [k in range(0, size(clock) - 1) | clock[k] + 86400 * size([j in range(1, k) where clock[j] < clock[j - 1]])] as seconds
+         unwind range(0, size(stoptimes) - 1) as i
+         with stoptimes, seconds, i, stoptimes[i] as st
+         set st.arrival_seconds = seconds[2 * i], st.departure_seconds = seconds[2 * i + 1]
+         with stoptimes, seconds, i, st where i > 0
+         match (previous)-[p:PRECEDES]->(st) where previous = stoptimes[i - 1]
+         set p.waiting_time = seconds[2 * i] - seconds[2 * i - 1]",
+        {batchSize: 1000, parallel: false})
+        YIELD batches, total
+        RETURN batches, total"""
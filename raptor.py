@@ -0,0 +1,273 @@
+"""Range queries with rRAPTOR over the in-memory Timetable.
+
+Trips sharing the same ordered list of stops form a route pattern (a GTFS
+Route usually splits into one pattern per direction and variant). RAPTOR works
+in rounds: round k holds the earliest arrivals using k trips, i.e. k - 1
+changes. rRAPTOR runs the departures of a time window from the latest to the
+earliest and keeps the labels between runs, because anything reachable
+departing later is reachable departing earlier.
+
+    python raptor.py GTFS_DIR 2024-01-18 --verify 100
+
+checks random profiles against a Connection Scan at every departure.
+"""
+import argparse
+import random
+import timeit
+from datetime import timedelta
+
+import numpy as np
+
+from timetable import Feed, seconds_to_time, time_to_seconds
+
+INF = np.iinfo(np.int32).max
+
+
+class RoutePatterns:
+    """Trips of a Timetable grouped by their stop sequence."""
+
+    def __init__(self, tt):
+        groups = {}
+        for trip in range(len(tt.trip_ids)):
+            start, end = tt.trip_offsets[trip], tt.trip_offsets[trip + 1]
+            if end - start > 1:
+                groups.setdefault(tuple(tt.st_stop[start:end]), []).append(trip)
+        self.stops = []
+        self.trips = []
+        for stops, trips in groups.items():
+            trips.sort(key=lambda trip: tt.st_departure[tt.trip_offsets[trip]])
+            self.stops.append(np.array(stops, dtype=np.int32))
+            self.trips.append(np.array(trips, dtype=np.int32))
+        # Patterns serving each stop, with the position of the stop in the pattern
+        self.stop_patterns = [[] for _ in range(len(tt.stop_ids))]
+        for pattern, stops in enumerate(self.stops):
+            for position, stop in enumerate(stops):
+                self.stop_patterns[stop].append((pattern, position))
+        # Stoptime index of (trip, position) is first_st[pattern][trip] + position
+        self.first_st = [tt.trip_offsets[trips] for trips in self.trips]
+        self.departures = [tt.st_departure[first[:, None] + np.arange(len(stops))]
+                           for first, stops in zip(self.first_st, self.stops)]
+        self.arrivals = [tt.st_arrival[first[:, None] + np.arange(len(stops))]
+                         for first, stops in zip(self.first_st, self.stops)]
+
+
+def count_changes(lines):
+    """Changes of an itinerary as main.py counts them: distinct lines minus one."""
+    lines = len(set(lines))
+    return 0 if lines <= 1 else lines - 1
+
+
+class Raptor:
+    """Profile (range) queries on the Timetables of a Feed."""
+
+    def __init__(self, feed, max_rounds=5):
+        self.feed = feed
+        self.max_rounds = max_rounds
+        self._patterns = {}
+
+    def patterns(self, date):
+        tt = self.feed.timetable(date)
+        # Rebuilt when the Feed has loaded the date again, e.g. after a feed update
+        if date not in self._patterns or self._patterns[date][0] is not tt:
+            self._patterns[date] = (tt, RoutePatterns(tt))
+        return self._patterns[date][1]
+
+    def profile(self, date, speed, start_time, end_time, source, target, max_duration=4):
+        """Pareto set of itineraries leaving the stop named source in [start_time, end_time].
+
+        Returns (departure, arrival, changes, rows) tuples ordered by departure,
+        where rows follow the App._routing layout. An itinerary is kept only if
+        no other one leaves later (or at the same time), arrives earlier (or at
+        the same time) and needs no more changes.
+        """
+        tt = self.feed.timetable(date)
+        sources = {stop: 0 for stop in tt.stops_by_name(source)}
+        targets = {stop: 0 for stop in tt.stops_by_name(target)}
+        horizon = time_to_seconds(end_time) + int(timedelta(hours=max_duration).total_seconds())
+        journeys = self.range_scan(tt, self.patterns(date), speed, time_to_seconds(start_time),
+                                   time_to_seconds(end_time), sources, targets, horizon)
+
+        itineraries = []
+        for departure, arrival, legs in journeys:
+            rows = tt.itinerary(legs)
+            changes = count_changes(tt.route_ids[tt.trip_route[tt.st_trip[board]]] for board, _ in legs)
+            itineraries.append((departure, arrival, changes, rows))
+        pareto = [(dep, arr, changes, rows) for dep, arr, changes, rows in itineraries
+                  if not any(other[0] >= dep and other[1] <= arr and other[2] <= changes
+                             and other[:3] != (dep, arr, changes) for other in itineraries)]
+        pareto.sort(key=lambda journey: journey[0])
+        unique = []
+        for journey in pareto:
+            if not unique or unique[-1][:3] != journey[:3]:
+                unique.append(journey)
+        return [(seconds_to_time(dep), seconds_to_time(arr), changes, rows) for dep, arr, changes, rows in unique]
+
+    def range_scan(self, tt, patterns, speed, start, end, sources, targets, horizon):
+        """rRAPTOR from the source stops to the target stops.
+
+        sources and targets map stop indices to walking seconds, as in
+        ConnectionScan.scan. Returns (departure, arrival, legs) for every
+        departure and round that improved the arrival at the targets.
+        """
+        # Departures from the sources inside the window, latest first
+        departures = set()
+        for stop, walk in sources.items():
+            for pattern, position in patterns.stop_patterns[stop]:
+                column = patterns.departures[pattern][:, position] - walk
+                departures.update(int(dep) for dep in column[(column >= start) & (column <= end)])
+
+        rounds = self.max_rounds + 1
+        n_stops = len(tt.stop_ids)
+        # Round labels are kept between runs: an arrival with k trips departing later is one departing earlier.
+        # A single best arrival over all rounds is not, a later run's label with more trips would prune the
+        # labels with fewer trips of an earlier run
+        labels = np.full((rounds, n_stops), INF, dtype=np.int64)
+        # Leg that produced each label: boarding and alighting Stoptime
+        board = np.full((rounds, n_stops), -1, dtype=np.int64)
+        alight = np.full((rounds, n_stops), -1, dtype=np.int64)
+        target_best = np.full(rounds, INF, dtype=np.int64)
+        journeys = []
+
+        for departure in sorted(departures, reverse=True):
+            marked = set()
+            for stop, walk in sources.items():
+                # One second earlier so that a trip leaving exactly at departure can be boarded
+                if departure + walk - 1 < labels[0, stop]:
+                    labels[0, stop] = departure + walk - 1
+                    board[0, stop] = alight[0, stop] = -1
+                marked.add(stop)
+
+            for k in range(1, rounds):
+                if not marked:
+                    break
+                improved = labels[k - 1] < labels[k]
+                labels[k][improved] = labels[k - 1][improved]
+                board[k][improved] = board[k - 1][improved]
+                alight[k][improved] = alight[k - 1][improved]
+
+                queue = {}
+                for stop in marked:
+                    for pattern, position in patterns.stop_patterns[stop]:
+                        if position < queue.get(pattern, len(patterns.stops[pattern])):
+                            queue[pattern] = position
+                marked = set()
+                target_arrival, target_leg = target_best[k], None
+
+                for pattern, first in queue.items():
+                    stops = patterns.stops[pattern]
+                    deps, arrs = patterns.departures[pattern], patterns.arrivals[pattern]
+                    trip, boarded_at = -1, -1
+                    for position in range(first, len(stops)):
+                        stop = stops[position]
+                        if trip >= 0:
+                            arr = arrs[trip, position]
+                            leg = (patterns.first_st[pattern][trip] + boarded_at,
+                                   patterns.first_st[pattern][trip] + position)
+                            if stop in targets and arr + targets[stop] < target_arrival:
+                                target_arrival, target_leg = arr + targets[stop], leg
+                            if arr < min(labels[k, stop], target_arrival, horizon):
+                                labels[k, stop] = arr
+                                board[k, stop], alight[k, stop] = leg
+                                marked.add(stop)
+                        previous = labels[k - 1, stop]
+                        if previous < INF and (trip < 0 or previous < deps[trip, position]):
+                            candidate = np.searchsorted(deps[:, position], previous, side='right')
+                            if candidate < len(deps) and (trip < 0 or candidate < trip):
+                                trip, boarded_at = candidate, position
+
+                for stop in list(marked):
+                    neighbours, distances = tt.footpaths(stop)
+                    for neighbour, distance in zip(neighbours, distances):
+                        walked = labels[k, stop] + int(distance / speed)
+                        if neighbour != stop and walked < labels[k, neighbour]:
+                            labels[k, neighbour] = walked
+                            board[k, neighbour], alight[k, neighbour] = board[k, stop], alight[k, stop]
+                            marked.add(neighbour)
+
+                if target_leg is not None:
+                    target_best[k] = target_arrival
+                    journeys.append((departure, int(target_arrival), self.legs(tt, board, alight, k, target_leg)))
+        return journeys
+
+    @staticmethod
+    def legs(tt, board, alight, k, last_leg):
+        """Walk the round labels back from the leg reaching the target."""
+        legs = [last_leg]
+        stop = tt.st_stop[last_leg[0]]
+        for round_ in range(k - 1, 0, -1):
+            if board[round_, stop] < 0:
+                break
+            legs.append((board[round_, stop], alight[round_, stop]))
+            stop = tt.st_stop[board[round_, stop]]
+        legs.reverse()
+        return legs
+
+
+def verify(raptor, date, queries=100, seed=0, speed=1, window=3600, max_duration=4):
+    """Check random profiles against ConnectionScan.scan.
+
+    At the departure of every entry, the entries leaving then or later must
+    reach the target when the scan leaving at that departure does (later
+    counts them otherwise), and the scan leaving at any minute of the window
+    must be matched by an entry leaving then or later and arriving no later
+    (missed). Scan journeys with more trips than max_rounds are skipped.
+    earlier counts the profiles beating the scan, which happens when the
+    scan drops a footpath from a stop it had already reached on foot.
+    Returns (queries, entries, later, earlier, missed, mean profile seconds).
+    """
+    # csa.py imports count_changes from here
+    from csa import ConnectionScan
+    tt = raptor.feed.timetable(date)
+    rng = random.Random(seed)
+    names = sorted({str(tt.stop_names[stop]) for stop in tt.active_stops})
+    entries, later, earlier, missed, profile_time = 0, 0, 0, 0, 0.0
+
+    def scan(departure, sources, targets, endtime):
+        """(departure from the origin, arrival, trips) of the scan, INF without a journey."""
+        # The scan boards after departure, the profile at departure
+        legs = ConnectionScan.scan(tt, speed, departure - 1, sources, targets, endtime)
+        if not legs:
+            return INF, INF, 0
+        board, alight = legs[0][0], legs[-1][1]
+        return (int(tt.st_departure[board]) - sources[int(tt.st_stop[board])],
+                int(tt.st_arrival[alight]) + targets[int(tt.st_stop[alight])], len(legs))
+
+    for _ in range(queries):
+        source, target = rng.sample(names, 2)
+        start = rng.randrange(6 * 3600, 20 * 3600)
+        end = start + window
+        endtime = end + max_duration * 3600
+        sources = {int(stop): 0 for stop in tt.stops_by_name(source)}
+        targets = {int(stop): 0 for stop in tt.stops_by_name(target)}
+        begin = timeit.default_timer()
+        profile = [(time_to_seconds(str(dep)), time_to_seconds(str(arr)))
+                   for dep, arr, _, _ in raptor.profile(date, speed, str(seconds_to_time(start)), str(seconds_to_time(end)),
+                                                        source, target, max_duration)]
+        profile_time += timeit.default_timer() - begin
+        entries += len(profile)
+        for departure in sorted({dep for dep, _ in profile}):
+            _, arrival, trips = scan(departure, sources, targets, endtime)
+            front = min(arr for dep, arr in profile if dep >= departure)
+            later += front > arrival and trips <= raptor.max_rounds
+            earlier += front < arrival
+        for departure in range(start, end + 1, 60):
+            leaving, arrival, trips = scan(departure, sources, targets, endtime)
+            # Journeys boarding after the window are not part of the profile
+            if leaving <= end and trips <= raptor.max_rounds:
+                missed += not any(dep >= departure and arr <= arrival for dep, arr in profile)
+    return queries, entries, later, earlier, missed, profile_time / queries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gtfs')
+    parser.add_argument('date')
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--verify', type=int, default=100, help='random profiles checked')
+    parser.add_argument('--window', type=int, default=60, help='minutes of departures per profile')
+    args = parser.parse_args()
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    queries, entries, later, earlier, missed, seconds = verify(Raptor(Feed(args.gtfs)), args.date, args.verify,
+                                                               speed=speed, window=args.window * 60)
+    print('%d profiles, %d itineraries: %d arrive later than the scan, %d earlier, %d scan journeys missed; '
+          '%.1f ms per profile' % (queries, entries, later, earlier, missed, seconds * 1000))
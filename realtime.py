@@ -0,0 +1,252 @@
+"""Real-time delay overlay on the in-memory Timetable.
+
+Trip updates in the GTFS-Realtime layout (the JSON mapping of FeedMessage,
+camelCase or snake_case keys, or binary .pb files when gtfs-realtime-bindings
+is installed) are turned into per-Stoptime arrival and departure delays. The
+scheduled arrays, Neo4j and the GDS projections are never touched: routing
+reads a view of the Timetable whose times include the delays and whose
+connections are re-sorted only around the updated trips.
+
+    {"entity": [{"id": "1", "tripUpdate": {
+        "trip": {"tripId": "T0_0", "startDate": "20240118"},
+        "stopTimeUpdate": [{"stopSequence": 3, "arrival": {"delay": 120}}]}}]}
+
+As in GTFS-Realtime, a delay holds for the following stops of the trip until
+the next stop time update, an update replaces whatever was known about its
+trip and scheduleRelationship CANCELED removes the trip. Stops with
+scheduleRelationship SKIPPED are still considered served.
+
+    python realtime.py GTFS_DIR DATE UPDATES [SOURCE TARGET TIME]
+
+replays recorded update files (a file or a directory, in name order) and
+prints how long each one took to apply.
+"""
+import copy
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+# Departure and arrival of the Stoptimes of a cancelled trip: after any endtime of a scan
+CANCELLED = np.iinfo(np.int32).max // 2
+
+
+def _get(message, *keys):
+    """message[key] for the first of keys (camelCase, snake_case) present."""
+    for key in keys:
+        if key in message:
+            return message[key]
+    return None
+
+
+def read_updates(path):
+    """FeedMessage dicts from a file, or from every file of a directory in name order."""
+    if os.path.isdir(path):
+        return [message for name in sorted(os.listdir(path)) for message in read_updates(os.path.join(path, name))]
+    if path.endswith('.pb'):
+        from google.protobuf.json_format import MessageToDict
+        from google.transit import gtfs_realtime_pb2
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        with open(path, 'rb') as file:
+            feed.ParseFromString(file.read())
+        return [MessageToDict(feed)]
+    with open(path) as file:
+        message = json.load(file)
+    return message if isinstance(message, list) else [message]
+
+
+class DelayOverlay:
+    """Delays of the Stoptimes of one Timetable, and the Timetable view that applies them."""
+
+    def __init__(self, tt, timezone='Europe/Rome'):
+        self.tt = tt
+        self.arrival_delay = np.zeros(len(tt.st_stop), dtype=np.int32)
+        self.departure_delay = np.zeros(len(tt.st_stop), dtype=np.int32)
+        self.cancelled = np.zeros(len(tt.trip_ids), dtype=bool)
+        # Epoch seconds of the local midnight of the service day, for absolute times
+        self.midnight = int(datetime.fromisoformat(tt.date).replace(tzinfo=ZoneInfo(timezone)).timestamp())
+        self.version = 0
+        self._trip_index = {str(trip_id): i for i, trip_id in enumerate(tt.trip_ids)}
+        self._stop_index = {str(stop_id): i for i, stop_id in enumerate(tt.stop_ids)}
+        self._view = None
+        self._dirty = set()
+
+    def _delay(self, event, scheduled):
+        if not event:
+            return None
+        delay = _get(event, 'delay')
+        if delay is not None:
+            return int(delay)
+        time = _get(event, 'time')
+        return int(time) - self.midnight - int(scheduled) if time is not None else None
+
+    def _position(self, start, end, update):
+        sequence = _get(update, 'stopSequence', 'stop_sequence')
+        if sequence is not None:
+            k = start + int(np.searchsorted(self.tt.st_sequence[start:end], int(sequence)))
+            if k < end and self.tt.st_sequence[k] == int(sequence):
+                return k
+        stop = self._stop_index.get(str(_get(update, 'stopId', 'stop_id')))
+        if stop is not None:
+            found = np.flatnonzero(self.tt.st_stop[start:end] == stop)
+            if len(found):
+                return start + int(found[0])
+        return None
+
+    def apply_trip_update(self, trip_update):
+        """Replace the delays of one trip; False if the trip does not run on this day."""
+        descriptor = _get(trip_update, 'trip') or {}
+        trip = self._trip_index.get(str(_get(descriptor, 'tripId', 'trip_id')))
+        if trip is None:
+            return False
+        start, end = self.tt.trip_offsets[trip], self.tt.trip_offsets[trip + 1]
+        self.cancelled[trip] = _get(descriptor, 'scheduleRelationship', 'schedule_relationship') in ('CANCELED', 3)
+        self.arrival_delay[start:end] = 0
+        self.departure_delay[start:end] = 0
+
+        updates = []
+        for update in _get(trip_update, 'stopTimeUpdate', 'stop_time_update') or []:
+            k = self._position(start, end, update)
+            if k is not None:
+                updates.append((k, update))
+        updates.sort(key=lambda item: item[0])
+        for i, (k, update) in enumerate(updates):
+            following = updates[i + 1][0] if i + 1 < len(updates) else end
+            previous = int(self.departure_delay[k - 1]) if k > start else 0
+            arrival = self._delay(_get(update, 'arrival'), self.tt.st_arrival[k])
+            departure = self._delay(_get(update, 'departure'), self.tt.st_departure[k])
+            arrival = arrival if arrival is not None else (departure if departure is not None else previous)
+            departure = departure if departure is not None else arrival
+            self.arrival_delay[k], self.departure_delay[k] = arrival, departure
+            # Propagated to the next stops until the next update
+            self.arrival_delay[k + 1:following] = departure
+            self.departure_delay[k + 1:following] = departure
+        self._dirty.add(trip)
+        self.version += 1
+        return True
+
+    def apply(self, message):
+        """Apply the trip updates of a FeedMessage dict; returns the number of trips updated."""
+        updated = 0
+        for entity in _get(message, 'entity') or []:
+            trip_update = _get(entity, 'tripUpdate', 'trip_update')
+            if trip_update is not None:
+                updated += self.apply_trip_update(trip_update)
+        return updated
+
+    def timetable(self):
+        """The Timetable with real-time times, rebuilt only around the trips updated since last call."""
+        tt = self.tt
+        if self._view is None:
+            self._view = copy.copy(tt)
+            self._view.st_arrival = tt.st_arrival.copy()
+            self._view.st_departure = tt.st_departure.copy()
+            self._view._connections = tt.connections.copy()
+        if not self._dirty:
+            return self._view
+        view = self._view
+        trips = np.fromiter(self._dirty, dtype=np.int64)
+        for trip in trips:
+            start, end = tt.trip_offsets[trip], tt.trip_offsets[trip + 1]
+            if self.cancelled[trip]:
+                view.st_arrival[start:end] = CANCELLED
+                view.st_departure[start:end] = CANCELLED
+            else:
+                view.st_arrival[start:end] = tt.st_arrival[start:end] + self.arrival_delay[start:end]
+                view.st_departure[start:end] = np.maximum(tt.st_departure[start:end] + self.departure_delay[start:end],
+                                                          view.st_arrival[start:end])
+        # Connections of the other trips keep their order: merge the updated ones back in
+        connections = view._connections
+        moved = np.isin(tt.st_trip[connections], trips)
+        kept, moved = connections[~moved], connections[moved]
+        moved = moved[np.argsort(view.st_departure[moved], kind='stable')]
+        at = np.searchsorted(view.st_departure[kept], view.st_departure[moved], side='right')
+        view._connections = np.insert(kept, at, moved)
+        self._dirty.clear()
+        return view
+
+
+class RealtimeFeed:
+    """A Feed whose Timetables carry the delays applied so far.
+
+    Drop-in for Feed in ConnectionScan: days without updates are served by
+    the underlying Feed unchanged.
+    """
+
+    def __init__(self, feed, timezone='Europe/Rome'):
+        self.feed = feed
+        self.timezone = timezone
+        self.overlays = {}
+
+    def overlay(self, date):
+        if date not in self.overlays:
+            self.overlays[date] = DelayOverlay(self.feed.timetable(date), self.timezone)
+        return self.overlays[date]
+
+    def timetable(self, date):
+        overlay = self.overlays.get(date)
+        return overlay.timetable() if overlay is not None else self.feed.timetable(date)
+
+    def version(self, date):
+        """Number of trip updates applied to date, to tell results computed before and after them."""
+        overlay = self.overlays.get(date)
+        return overlay.version if overlay is not None else 0
+
+    def apply(self, message, date=None):
+        """Apply a FeedMessage; each trip goes to its startDate, or to date when it has none."""
+        by_date = {}
+        for entity in _get(message, 'entity') or []:
+            trip_update = _get(entity, 'tripUpdate', 'trip_update')
+            if trip_update is None:
+                continue
+            start_date = _get(_get(trip_update, 'trip') or {}, 'startDate', 'start_date')
+            day = '%s-%s-%s' % (start_date[:4], start_date[4:6], start_date[6:]) if start_date else date
+            if day is not None:
+                by_date.setdefault(day, []).append(trip_update)
+        updated = 0
+        for day, trip_updates in by_date.items():
+            overlay = self.overlay(day)
+            updated += sum(overlay.apply_trip_update(trip_update) for trip_update in trip_updates)
+        return updated
+
+    def load(self, path, date=None):
+        """Apply every FeedMessage recorded in path (file or directory)."""
+        return sum(self.apply(message, date) for message in read_updates(path))
+
+    def clear(self, date=None):
+        """Back to the schedule for date, or for every day."""
+        for day in list(self.overlays):
+            if date is None or day == date:
+                del self.overlays[day]
+
+
+if __name__ == '__main__':
+    from csa import ConnectionScan
+    from timetable import Feed
+
+    gtfs_path, date, updates = sys.argv[1:4]
+    feed = RealtimeFeed(Feed(gtfs_path))
+    feed.feed.timetable(date)
+    csa = ConnectionScan(feed)
+    query = sys.argv[4:7]
+    if query:
+        rows = csa.routing(date, 1, query[2], query[0], query[1])
+        print('schedule: arrival %s' % (rows[-1][-1] if rows else None))
+    paths = [os.path.join(updates, name) for name in sorted(os.listdir(updates))] if os.path.isdir(updates) else [updates]
+    for path in paths:
+        start = timeit.default_timer()
+        updated = feed.load(path, date)
+        applied = timeit.default_timer() - start
+        start = timeit.default_timer()
+        feed.timetable(date)
+        rebuilt = timeit.default_timer() - start
+        print('%s: %d trips updated in %.2f ms, view rebuilt in %.2f ms' % (os.path.basename(path), updated,
+                                                                          applied * 1000, rebuilt * 1000))
+        if query:
+            rows = csa.routing(date, 1, query[2], query[0], query[1])
+            print('    arrival %s' % (rows[-1][-1] if rows else None))
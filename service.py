@@ -0,0 +1,205 @@
+"""Asyncio routing service over the async Neo4j driver.
+
+Exposes find_near_stops, routing and point-to-point routing on a small local
+HTTP API (GET, JSON answers):
+
+    /near_stops?date=2024-01-18&lat=44.649988&lon=10.917893&radius=300
+    /routing?date=2024-01-18&time=14:00:00&source=...&target=...&speed=1
+    /route?date=2024-01-18&time=14:00:00&start_lat=..&start_lon=..&end_lat=..&end_lon=..&speed=1&radius=300
+    /stats
+
+All queries share one bounded connection pool. Identical requests arriving
+while the first one is still running are coalesced: departure times are
+rounded up to time_bucket seconds, so that no answer leaves before the time
+asked for, and requests with the same (date, time bucket, origin,
+destination) await the same query. The projection serving each
+(date, speed) is looked up once and kept here; eviction runs in the
+background after a projection is added.
+
+    python service.py [port]
+"""
+import asyncio
+import json
+import sys
+from urllib.parse import parse_qsl, urlsplit
+
+from neo4j import AsyncGraphDatabase, GraphDatabase
+
+import queries
+from projections import ProjectionManager
+from timetable import time_to_seconds
+
+
+def speed_param(value):
+    """Walking speed from a query string, kept an int when integral like in App."""
+    speed = float(value)
+    return int(speed) if speed.is_integer() else speed
+
+
+class RoutingService:
+    """Async counterpart of App sharing one pool of max_connections sessions."""
+
+    def __init__(self, uri, user, password, max_connections=50, time_bucket=60, radius=300):
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_connections)
+        # Projections are managed synchronously, off the event loop
+        self._sync_driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=2)
+        self.projections = ProjectionManager(self._sync_driver)
+        self.slots = asyncio.Semaphore(max_connections)
+        self.time_bucket = time_bucket
+        self.radius = radius
+        self._in_flight = {}
+        # (date, speed) -> (projection version, graph name)
+        self._graph_names = {}
+        self._evicting = None
+        self.coalesced = 0
+
+    async def close(self):
+        await self.driver.close()
+        self._sync_driver.close()
+
+    def bucket(self, time):
+        seconds = time_to_seconds(time)
+        seconds += -seconds % self.time_bucket
+        return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    async def coalesce(self, key, factory):
+        """Await the running task for key, or start one with factory().
+
+        The task leaves _in_flight when it is done, not when the request that
+        started it is, so cancelling that request leaves the others waiting on it.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieved here in case every request awaiting it was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def graph_name(self, date, speed):
+        """Projection serving (date, speed); ProjectionManager.get only runs when it is not known here."""
+        version = self.projections.version(date)
+        cached = self._graph_names.get((date, speed))
+        if cached is not None and cached[0] == version and cached[1] in self.projections:
+            return cached[1]
+        name = await self.coalesce(('projection', date, speed),
+                                   lambda: asyncio.to_thread(self.projections.get, date, speed, evict=False))
+        self._graph_names[(date, speed)] = (version, name)
+        self.evict(name)
+        return name
+
+    def evict(self, keep):
+        """Meet the projection budget in a background thread, unless an eviction is running."""
+        if self._evicting is None or self._evicting.done():
+            self._evicting = asyncio.ensure_future(asyncio.to_thread(self.projections.evict, (keep,)))
+
+    async def run(self, query, **params):
+        async with self.slots:
+            async with self.driver.session() as session:
+                result = await session.run(query, **params)
+                return await result.values()
+
+    async def find_near_stops(self, date, lat, lon, radius):
+        key = ('near_stops', date, lat, lon, radius)
+        rows = await self.coalesce(key, lambda: self.run(queries.FIND_NEAR_STOPS, date=date, lat=lat, lon=lon,
+                                                         radius=radius))
+        return [row[0] for row in rows]
+
+    async def routing(self, date, speed, time, source, target, max_duration=4):
+        time = self.bucket(time)
+        key = ('routing', date, speed, time, source, target)
+        return await self.coalesce(key, lambda: self._routing(date, speed, time, source, target, max_duration))
+
+    async def _routing(self, date, speed, time, source, target, max_duration):
+        graph_name = await self.graph_name(date, speed)
+        departure = time_to_seconds(time)
+        return await self.run(queries.ROUTING, date=date, departure=departure, endtime=departure + max_duration * 3600,
+                              source=source, target=target, graph_name=graph_name)
+
+    async def route(self, date, speed, time, start_lat, start_lon, end_lat, end_lon, max_duration=4):
+        time = self.bucket(time)
+        key = ('route', date, speed, time, start_lat, start_lon, end_lat, end_lon)
+        return await self.coalesce(key, lambda: self._route(date, speed, time, start_lat, start_lon, end_lat,
+                                                            end_lon, max_duration))
+
+    async def _route(self, date, speed, time, start_lat, start_lon, end_lat, end_lon, max_duration):
+        start_names, end_names = await asyncio.gather(
+            self.find_near_stops(date, start_lat, start_lon, self.radius),
+            self.find_near_stops(date, end_lat, end_lon, self.radius))
+        if not start_names or not end_names:
+            return []
+        graph_name = await self.graph_name(date, speed)
+        departure = time_to_seconds(time)
+        return await self.run(queries.ROUTING_BETWEEN_POINTS, date=date, departure=departure,
+                              endtime=departure + max_duration * 3600, speed=speed,
+                              start_lat=start_lat, start_lon=start_lon, end_lat=end_lat, end_lon=end_lon,
+                              start_names=start_names, end_names=end_names, graph_name=graph_name)
+
+    async def handle(self, path, params):
+        if path == '/near_stops':
+            return await self.find_near_stops(params['date'], float(params['lat']), float(params['lon']),
+                                              float(params.get('radius', self.radius)))
+        if path == '/routing':
+            return await self.routing(params['date'], speed_param(params.get('speed', 1)), params['time'],
+                                      params['source'], params['target'])
+        if path == '/route':
+            return await self.route(params['date'], speed_param(params.get('speed', 1)), params['time'],
+                                    float(params['start_lat']), float(params['start_lon']),
+                                    float(params['end_lat']), float(params['end_lon']))
+        if path == '/stats':
+            return {'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+        raise KeyError(path)
+
+    async def serve_client(self, reader, writer):
+        try:
+            try:
+                request_line = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass
+                method, target, _ = request_line.decode().split(' ', 2)
+                url = urlsplit(target)
+                body = await self.handle(url.path, dict(parse_qsl(url.query)))
+                status = '200 OK'
+            except KeyError as error:
+                body, status = {'error': 'missing or unknown %s' % error}, '404 Not Found'
+            except ValueError as error:
+                # A malformed request line or parameter, UnicodeDecodeError included
+                body, status = {'error': str(error)}, '400 Bad Request'
+            except ConnectionError:
+                return
+            except Exception as error:
+                body, status = {'error': str(error)}, '500 Internal Server Error'
+            payload = json.dumps(body, default=str).encode()
+            writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (status, len(payload))).encode() + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.serve_client, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+
+    async def main():
+        service = RoutingService('neo4j://localhost:7687', 'neo4j', '12345678')
+        try:
+            await service.serve(port=port)
+        finally:
+            await service.close()
+
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+"""Columnar binary snapshot of one service day.
+
+compile_snapshot turns the GTFS files of a day into a directory of .npy
+arrays plus a meta.json; open_snapshot maps them back with np.memmap, so any
+number of worker processes share the same pages and start without parsing a
+single CSV line. The footpaths are those of walk_radius, or of a walking.py
+table; meta.json records which, and Feed only maps a snapshot whose
+footpaths are the ones it would compute (footpaths_match).
+
+    python snapshot.py GTFS_230406_240405/ 2024-01-18 snapshots/2024-01-18 [--walking-table walking.npz]
+
+prints the size of the snapshot next to the sizeInBytes of the GDS
+projections of the same day (gds.graph.list), when Neo4j is reachable.
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+import queries
+from projections import graph_name
+from timetable import WALK_RADIUS, Timetable
+
+# Arrays stored in a snapshot, in the order of the Timetable constructor
+FIELDS = ['stop_ids', 'stop_names', 'stop_lat', 'stop_lon', 'route_ids', 'trip_ids', 'trip_route',
+          'trip_offsets', 'st_stop', 'st_sequence', 'st_arrival', 'st_departure',
+          'fp_indptr', 'fp_indices', 'fp_distance']
+# Derived arrays saved as well, so that opening a snapshot does no sorting
+DERIVED = ['connections', 'st_trip']
+
+
+def compile_snapshot(gtfs_path, date, path, walk_radius=WALK_RADIUS, walking_table=None):
+    """Build the Timetable of date from the GTFS files and write it to path.
+
+    walking_table, the path of a table written by walking.py, replaces the
+    straight-line footpaths as in Feed.
+    """
+    walking = None
+    if walking_table:
+        from walking import WalkingTable
+        walking = WalkingTable.load(walking_table)
+    tt = Timetable.from_gtfs(gtfs_path, date, walk_radius, walking)
+    save_snapshot(tt, path, walk_radius, walking_table)
+    return tt
+
+
+def save_snapshot(tt, path, walk_radius=WALK_RADIUS, walking_table=None):
+    """Write the arrays of tt, whose footpaths come from walk_radius or walking_table, to the directory path.
+
+    Any previous snapshot at path is replaced.
+    """
+    tmp = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name in FIELDS + DERIVED:
+        np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(getattr(tt, name)))
+    meta = {'date': tt.date, 'walk_radius': walk_radius,
+            'walking_table': os.path.abspath(walking_table) if walking_table else None,
+            'stops': len(tt.stop_ids), 'trips': len(tt.trip_ids), 'stoptimes': len(tt.st_stop),
+            'footpaths': len(tt.fp_indices), 'nbytes': int(tt.nbytes)}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+
+def open_snapshot(path):
+    """Timetable whose arrays are read-only memory maps of the snapshot files."""
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in FIELDS + DERIVED}
+    return Timetable(meta['date'], *(arrays[name] for name in FIELDS),
+                     connections=arrays['connections'], st_trip=arrays['st_trip'])
+
+
+def footpaths_match(path, walk_radius=WALK_RADIUS, walking_table=None):
+    """Whether the snapshot at path has the footpaths of walk_radius, or of walking_table when given."""
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    if walking_table:
+        return meta.get('walking_table') == os.path.abspath(walking_table)
+    return meta.get('walking_table') is None and meta['walk_radius'] == walk_radius
+
+
+def snapshot_size(path):
+    """Bytes on disk of a snapshot, i.e. what its memory maps can page in."""
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def projection_sizes(driver, date):
+    """sizeInBytes of the GDS projections of date, at any walking speed, from gds.graph.list."""
+    prefix = graph_name(date, '')
+    with driver.session() as session:
+        return {name: size for name, size in session.run(queries.GRAPH_SIZES).values() if name.startswith(prefix)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gtfs')
+    parser.add_argument('date')
+    parser.add_argument('path')
+    parser.add_argument('--walking-table', help='footpaths from a table written by walking.py')
+    parser.add_argument('--no-gds', action='store_true', help='do not compare with the GDS projections')
+    parser.add_argument('--uri', default='neo4j://localhost:7687')
+    parser.add_argument('--user', default='neo4j')
+    parser.add_argument('--password', default='12345678')
+    args = parser.parse_args()
+    tt = compile_snapshot(args.gtfs, args.date, args.path, walking_table=args.walking_table)
+    size = snapshot_size(args.path)
+    print(f'Snapshot of {args.date}: {len(tt.stop_ids)} stops, {len(tt.trip_ids)} trips, {len(tt.st_stop)} stoptimes, '
+          f'{len(tt.fp_indices)} footpaths')
+    print(f'Snapshot: {size / 2 ** 20:.1f} MiB')
+    if not args.no_gds:
+        from neo4j import GraphDatabase, exceptions
+
+        driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
+        try:
+            sizes = projection_sizes(driver, args.date)
+        except exceptions.ServiceUnavailable as error:
+            print(f'GDS projections not compared: {error}')
+        else:
+            if not sizes:
+                print(f'No GDS projection of {args.date} in gds.graph.list')
+            for name, gds_size in sorted(sizes.items()):
+                print(f'{name}: {gds_size / 2 ** 20:.1f} MiB in GDS, the snapshot is {size / gds_size:.2f} of it')
+        finally:
+            driver.close()
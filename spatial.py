@@ -0,0 +1,115 @@
+"""In-memory spatial index over WGS-84 coordinates.
+
+Points are bucketed in square cells of a local equirectangular projection and
+the cells are kept sorted by key, so a radius query is a handful of binary
+searches over the neighbouring cells, O(log n + k), followed by an exact
+haversine check on the k candidates.
+"""
+import numpy as np
+
+# Earth radius used by Neo4j point.distance on WGS-84 points
+EARTH_RADIUS = 6378140.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters, vectorized over NumPy arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """Radius and nearest-neighbour queries over arrays of latitudes and longitudes."""
+
+    def __init__(self, lat, lon, cell_size=300):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_size = cell_size
+        # Meters per degree, measured at the mean latitude of the points
+        self.lat0 = float(np.mean(self.lat)) if len(self.lat) else 0.0
+        self.ky = np.pi * EARTH_RADIUS / 180
+        self.kx = self.ky * np.cos(np.radians(self.lat0))
+        cx, cy = self._cells(self.lat, self.lon)
+        keys = self._key(cx, cy)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        # Cells spanned by the points: no search needs to reach further than this
+        self.span = int(max(np.ptp(cx), np.ptp(cy))) + 1 if len(keys) else 0
+
+    def _cells(self, lat, lon):
+        cx = np.floor(np.asarray(lon) * self.kx / self.cell_size).astype(np.int64)
+        cy = np.floor(np.asarray(lat) * self.ky / self.cell_size).astype(np.int64)
+        return cx, cy
+
+    @staticmethod
+    def _key(cx, cy):
+        return (cx << 32) + (cy + 2 ** 31)
+
+    def _candidates(self, lat, lon, reach):
+        """Indices of the points in the cells within reach cells of (lat, lon)."""
+        cx, cy = self._cells(lat, lon)
+        found = []
+        for dx in range(-reach, reach + 1):
+            keys = self._key(cx + dx, cy + np.arange(-reach, reach + 1))
+            # Cells with the same cx are contiguous in key order
+            start = np.searchsorted(self.keys, keys[0], side='left')
+            end = np.searchsorted(self.keys, keys[-1], side='right')
+            if end > start:
+                found.append(self.order[start:end])
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def query_radius(self, lat, lon, radius):
+        """Points closer than radius meters: (indices, distances) sorted by distance."""
+        reach = int(np.ceil(radius / self.cell_size))
+        candidates = self._candidates(lat, lon, reach)
+        distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+        near = distances < radius
+        candidates, distances = candidates[near], distances[near]
+        order = np.argsort(distances, kind='stable')
+        return candidates[order], distances[order]
+
+    def query_radius_many(self, lats, lons, radius):
+        """query_radius for every coordinate pair of lats and lons."""
+        return [self.query_radius(lat, lon, radius) for lat, lon in zip(lats, lons)]
+
+    def nearest(self, lat, lon, max_distance=np.inf):
+        """Closest point to (lat, lon) as (index, distance), (-1, inf) if none within max_distance."""
+        reach = 1
+        while len(self.lat):
+            if reach <= self.span:
+                candidates = self._candidates(lat, lon, reach)
+            else:
+                candidates = np.arange(len(self.lat))
+            if len(candidates):
+                distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+                best = int(np.argmin(distances))
+                # Anything outside the searched cells is at least reach * cell_size away
+                if distances[best] <= reach * self.cell_size or reach > self.span:
+                    if distances[best] < max_distance:
+                        return int(candidates[best]), float(distances[best])
+                    break
+            if reach * self.cell_size >= max_distance or reach > self.span:
+                break
+            reach *= 2
+        return -1, np.inf
+
+    def nearest_many(self, lats, lons, max_distance=np.inf):
+        """nearest for every coordinate pair: (indices, distances) arrays."""
+        result = [self.nearest(lat, lon, max_distance) for lat, lon in zip(lats, lons)]
+        indices = np.array([index for index, _ in result], dtype=np.int64)
+        distances = np.array([distance for _, distance in result], dtype=np.float64)
+        return indices, distances
+
+    def pairs_within(self, radius):
+        """CSR adjacency (indptr, indices, distance) of every point to the points closer than radius."""
+        indptr = np.zeros(len(self.lat) + 1, dtype=np.int64)
+        indices, distances = [], []
+        for i in range(len(self.lat)):
+            near, distance = self.query_radius(self.lat[i], self.lon[i], radius)
+            order = np.argsort(near, kind='stable')
+            indices.append(near[order])
+            distances.append(distance[order])
+            indptr[i + 1] = indptr[i] + len(near)
+        indices = np.concatenate(indices).astype(np.int32) if indices else np.zeros(0, dtype=np.int32)
+        distances = np.concatenate(distances).astype(np.float32) if distances else np.zeros(0, dtype=np.float32)
+        return indptr, indices, distances
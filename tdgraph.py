@@ -0,0 +1,287 @@
+"""Time-dependent stop/route graph, a compact alternative to the Stoptime projection.
+
+The graph_walk projection has a node per Stoptime and an edge per PRECEDES
+and per feasible CHANGE, so it grows with trips x stops x neighbour
+departures. Here nodes are stops and (route pattern, position) pairs, the
+stop-route nodes, and timetables live on the edges instead:
+
+- ride: (pattern, i) -> (pattern, i + 1), with the departures of the
+  pattern's trips at position i sorted, the earliest arrival at i + 1 among
+  the trips leaving at or after each of them, and the Stoptime boarded;
+- board: stop -> (pattern, i + 1), the ride of (pattern, i) taken strictly
+  after the time at the stop, as a CHANGE leaves strictly after arrival plus
+  walk;
+- alight: (pattern, i) -> stop;
+- walk: stop -> WALK_TO neighbour (the stop itself included), distance / speed.
+
+Stops are split into an arrival and a departure node so that, as in the
+projection, a walk is always between two rides. The earliest-arrival search
+is a time-dependent Dijkstra whose labels are times: a ride edge is
+evaluated with a binary search in its departures. Legs are returned as
+(board Stoptime, alight Stoptime) so itineraries come in the App._routing
+layout through Timetable.itinerary.
+
+    python tdgraph.py GTFS_DIR DATE [--pairs 200] [--speed 1]
+
+compares this model with the Stoptime graph (expanded.py) on size, build
+time and query time.
+"""
+import argparse
+import heapq
+import random
+import timeit
+
+import numpy as np
+
+from csa import INF
+from raptor import RoutePatterns
+from spatial import haversine
+from timetable import Feed, time_to_seconds
+
+
+class TimeDependentGraph:
+    """Stop-route graph of one Timetable, with sorted departure/arrival arrays on the ride edges."""
+
+    def __init__(self, tt, patterns=None):
+        patterns = patterns or RoutePatterns(tt)
+        self.n_stops = len(tt.stop_ids)
+        # Stop-route node of (pattern, position) is node_offsets[pattern] + position
+        self.node_offsets = np.zeros(len(patterns.stops) + 1, dtype=np.int64)
+        np.cumsum([len(stops) for stops in patterns.stops], out=self.node_offsets[1:])
+        self.node_stop = np.concatenate(patterns.stops).astype(np.int32) if patterns.stops else np.zeros(0, np.int32)
+        # Ride edge of node (pattern, i) towards (pattern, i + 1): slice ride_offsets[node]:ride_offsets[node + 1]
+        departures, arrivals, boards, sizes = [], [], [], []
+        for pattern, stops in enumerate(patterns.stops):
+            first = patterns.first_st[pattern]
+            for position in range(len(stops)):
+                if position == len(stops) - 1:
+                    sizes.append(0)
+                    continue
+                departure = patterns.departures[pattern][:, position]
+                order = np.argsort(departure, kind='stable')
+                arrival = patterns.arrivals[pattern][order, position + 1]
+                # Earliest arrival over the trips leaving at or after each departure, and the trip giving it
+                best = np.arange(len(order))
+                for k in range(len(order) - 2, -1, -1):
+                    if arrival[best[k + 1]] < arrival[k]:
+                        best[k] = best[k + 1]
+                departures.append(departure[order])
+                arrivals.append(arrival[best])
+                boards.append(first[order[best]] + position)
+                sizes.append(len(order))
+        self.ride_offsets = np.zeros(len(self.node_stop) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.ride_offsets[1:])
+        concat = lambda arrays, dtype: np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype)
+        self.ride_departure = concat(departures, np.int32)
+        self.ride_arrival = concat(arrivals, np.int32)
+        self.ride_board = concat(boards, np.int64)
+        # Board edges: stop -> stop-route nodes (pattern, i) whose ride leaves the stop
+        board = [[self.node_offsets[pattern] + position for pattern, position in patterns.stop_patterns[stop]
+                  if position < len(patterns.stops[pattern]) - 1] for stop in range(self.n_stops)]
+        self.board_offsets = np.zeros(self.n_stops + 1, dtype=np.int64)
+        np.cumsum([len(nodes) for nodes in board], out=self.board_offsets[1:])
+        self.board_nodes = np.array([node for nodes in board for node in nodes], dtype=np.int64)
+        # Walk edges: the WALK_TO footpaths of the timetable
+        self.fp_indptr, self.fp_indices, self.fp_distance = tt.fp_indptr, tt.fp_indices, tt.fp_distance
+        self.st_departure = tt.st_departure
+
+    @property
+    def node_count(self):
+        """Stop-route nodes plus the arrival and departure node of every stop."""
+        return len(self.node_stop) + 2 * self.n_stops
+
+    @property
+    def relationship_count(self):
+        """Ride, board, alight and walk edges."""
+        rides = int(np.count_nonzero(np.diff(self.ride_offsets)))
+        return rides + len(self.board_nodes) + len(self.node_stop) + len(self.fp_indices)
+
+    @property
+    def nbytes(self):
+        """Memory held by the graph arrays, the shared timetable arrays excluded."""
+        own = ('node_offsets', 'node_stop', 'ride_offsets', 'ride_departure', 'ride_arrival', 'ride_board',
+               'board_offsets', 'board_nodes')
+        return sum(getattr(self, name).nbytes for name in own)
+
+    def ride(self, node, time, strict):
+        """(arrival at the next node, boarded Stoptime) of the earliest trip leaving node at (strict: after) time."""
+        start, end = self.ride_offsets[node], self.ride_offsets[node + 1]
+        k = start + np.searchsorted(self.ride_departure[start:end], time, side='right' if strict else 'left')
+        if k == end:
+            return INF, -1
+        return int(self.ride_arrival[k]), int(self.ride_board[k])
+
+    def search(self, speed, departure, sources, targets, endtime):
+        """Earliest arrival from the source stops to the target stops.
+
+        sources and targets map stop indices to the walking seconds from the
+        origin and towards the destination, as in ConnectionScan.scan; rides
+        leave strictly after departure plus the access walk and before
+        endtime. Returns (arrival plus egress, legs), (INF, []) if no target
+        is reached.
+        """
+        n_routes = len(self.node_stop)
+        # Node ids: stop-route nodes, then arrival stops, then departure stops
+        arrival_stop, departure_stop = n_routes, n_routes + self.n_stops
+        label = np.full(n_routes + 2 * self.n_stops, INF, dtype=np.int64)
+        previous = np.full(len(label), -1, dtype=np.int64)
+        boarded = np.full(n_routes, -1, dtype=np.int64)
+        heap = []
+        for stop, walk in sources.items():
+            label[departure_stop + stop] = departure + walk
+            heap.append((departure + walk, departure_stop + stop))
+        heapq.heapify(heap)
+
+        def relax(node, time, source, board=-1):
+            if time < label[node]:
+                label[node], previous[node] = time, source
+                if board >= 0:
+                    boarded[node] = board
+                heapq.heappush(heap, (time, node))
+
+        best, best_node = INF, -1
+        while heap:
+            time, node = heapq.heappop(heap)
+            if time >= best:
+                break
+            if time > label[node]:
+                continue
+            if node < n_routes:
+                # On board at (pattern, i): ride on, or get off at the stop
+                if self.ride_offsets[node + 1] > self.ride_offsets[node]:
+                    arrival, board = self.ride(node, time, strict=False)
+                    if board >= 0 and self.st_departure[board] < endtime:
+                        relax(node + 1, arrival, node, board)
+                relax(arrival_stop + self.node_stop[node], time, node)
+            elif node < departure_stop:
+                stop = node - arrival_stop
+                if stop in targets and time + targets[stop] < best:
+                    best, best_node = time + targets[stop], node
+                for neighbour, distance in zip(self.fp_indices[self.fp_indptr[stop]:self.fp_indptr[stop + 1]],
+                                               self.fp_distance[self.fp_indptr[stop]:self.fp_indptr[stop + 1]]):
+                    relax(departure_stop + neighbour, time + int(distance / speed), node)
+            else:
+                stop = node - departure_stop
+                for route_node in self.board_nodes[self.board_offsets[stop]:self.board_offsets[stop + 1]]:
+                    arrival, board = self.ride(route_node, time, strict=True)
+                    if board >= 0 and self.st_departure[board] < endtime:
+                        relax(route_node + 1, arrival, node, board)
+        if best_node < 0:
+            return INF, []
+        return int(best), self.legs(previous, boarded, previous[best_node])
+
+    def legs(self, previous, boarded, node):
+        """(board Stoptime, alight Stoptime) legs of the rides ending at the stop-route node node."""
+        steps = []
+        while 0 <= node < len(self.node_stop):
+            if boarded[node] >= 0:
+                steps.append(int(boarded[node]))
+            node = previous[node]
+            while node >= len(self.node_stop) and previous[node] >= 0:
+                node = previous[node]
+        steps.reverse()
+        legs = []
+        for board in steps:
+            # A ride step boarding the Stoptime just alighted continues the same trip
+            if legs and legs[-1][1] == board:
+                legs[-1] = (legs[-1][0], board + 1)
+            else:
+                legs.append((board, board + 1))
+        return legs
+
+
+class TimeDependentRouter:
+    """Earliest-arrival routing on the time-dependent graphs of the Timetables of a Feed."""
+
+    def __init__(self, feed):
+        self.feed = feed
+        self._graphs = {}
+
+    def graph(self, date):
+        tt = self.feed.timetable(date)
+        # Rebuilt when the Feed has loaded the date again, e.g. after a feed update
+        if date not in self._graphs or self._graphs[date][0] is not tt:
+            self._graphs[date] = (tt, TimeDependentGraph(tt))
+        return self._graphs[date][1]
+
+    def routing(self, date, speed, time, source, target, max_duration=4):
+        """Earliest arrival from the stop named source to the stop named target, in the App._routing rows."""
+        graph = self.graph(date)
+        tt = self.feed.timetable(date)
+        departure = time_to_seconds(time)
+        sources = {stop: 0 for stop in tt.stops_by_name(source)}
+        targets = {stop: 0 for stop in tt.stops_by_name(target)}
+        _, legs = graph.search(speed, departure, sources, targets, departure + max_duration * 3600)
+        return tt.itinerary(legs)
+
+
+def compare(tt, speed=1, pairs=200, radius=300, seed=0):
+    """Size, build time and mean query time of the Stoptime graph and of the time-dependent graph.
+
+    Arrivals are compared too. The Stoptime graph can chain CHANGE edges
+    through a Stoptime without riding from it, walking twice in a row, so
+    it sometimes arrives earlier; stoptime_earlier counts those queries.
+    """
+    from expanded import ExpandedGraph
+
+    start = timeit.default_timer()
+    expanded = ExpandedGraph.from_timetable(tt, speed)
+    expanded_build = timeit.default_timer() - start
+    start = timeit.default_timer()
+    graph = TimeDependentGraph(tt)
+    graph_build = timeit.default_timer() - start
+
+    rng = random.Random(seed)
+    active = [int(stop) for stop in tt.active_stops]
+    expanded_time = graph_time = 0.0
+    stoptime_earlier = time_dependent_earlier = 0
+    for _ in range(pairs):
+        origin, destination = rng.sample(active, 2)
+        departure = rng.randrange(6 * 3600, 20 * 3600)
+        endtime = departure + 4 * 3600
+        lat, lon = tt.stop_lat[origin], tt.stop_lon[origin]
+        end_lat, end_lon = tt.stop_lat[destination], tt.stop_lon[destination]
+        # Candidate stops by name, like find_near_stops and expanded.py
+        start_names = {tt.stop_names[stop] for stop in tt.near_stops(lat, lon, radius)[0]}
+        end_names = {tt.stop_names[stop] for stop in tt.near_stops(end_lat, end_lon, radius)[0]}
+        sources = {int(stop): int(haversine(tt.stop_lat[stop], tt.stop_lon[stop], lat, lon) / speed)
+                   for name in start_names for stop in tt.stops_by_name(name)}
+        targets = {int(stop): int(haversine(tt.stop_lat[stop], tt.stop_lon[stop], end_lat, end_lon) / speed)
+                   for name in end_names for stop in tt.stops_by_name(name)}
+        start = timeit.default_timer()
+        found = expanded.search(lat, lon, end_lat, end_lon, start_names, end_names, speed, departure, endtime)
+        expanded_time += timeit.default_timer() - start
+        start = timeit.default_timer()
+        arrival, _ = graph.search(speed, departure, sources, targets, endtime)
+        graph_time += timeit.default_timer() - start
+        # Same up to the rounding of the walks, whole seconds here and fractional in expanded.py
+        expanded_arrival = INF if found is None else found[1]
+        if expanded_arrival < arrival - 2:
+            stoptime_earlier += 1
+        elif arrival < expanded_arrival - 2:
+            time_dependent_earlier += 1
+    return {
+        'stoptime': {'nodes': len(expanded.node_ids), 'relationships': len(expanded.indices),
+                     'bytes': expanded.nbytes, 'build_seconds': expanded_build, 'query_ms': expanded_time / pairs * 1000},
+        'time_dependent': {'nodes': graph.node_count, 'relationships': graph.relationship_count,
+                           'bytes': graph.nbytes, 'build_seconds': graph_build, 'query_ms': graph_time / pairs * 1000},
+        'pairs': pairs, 'stoptime_earlier': stoptime_earlier,
+        'time_dependent_earlier': time_dependent_earlier}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gtfs')
+    parser.add_argument('date')
+    parser.add_argument('--pairs', type=int, default=200)
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--radius', type=float, default=300)
+    args = parser.parse_args()
+    result = compare(Feed(args.gtfs).timetable(args.date), args.speed, args.pairs, args.radius)
+    for model in ('stoptime', 'time_dependent'):
+        entry = result[model]
+        print('%-15s %9d nodes %10d relationships %8.1f MiB  build %6.2f s  query %7.2f ms' % (
+            model, entry['nodes'], entry['relationships'], entry['bytes'] / 2 ** 20, entry['build_seconds'],
+            entry['query_ms']))
+    print('%d queries: %d earlier on the Stoptime graph, %d earlier on the time-dependent graph' % (
+        result['pairs'], result['stoptime_earlier'], result['time_dependent_earlier']))
@@ -0,0 +1,25 @@
+"""Shared fixtures: a four-stop GTFS feed and GTFS-Realtime messages recorded against it.
+
+The modules live at the top of the repository, next to this directory.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+sys.path.insert(0, ROOT)
+
+DATE = '2024-01-18'
+
+
+@pytest.fixture
+def gtfs_path():
+    return os.path.join(FIXTURES, 'gtfs')
+
+
+@pytest.fixture
+def updates():
+    """Path of a recorded FeedMessage by name."""
+    return lambda name: os.path.join(FIXTURES, 'gtfs_rt', name + '.json')
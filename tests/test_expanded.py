@@ -0,0 +1,32 @@
+"""Fastest ride of an ExpandedGraph, the speed that bounds its A* heuristic."""
+import numpy as np
+import pytest
+
+from conftest import DATE
+from expanded import ExpandedGraph
+from projections import MIN_HOP
+from spatial import haversine
+from timetable import Timetable
+
+
+@pytest.fixture
+def graph(gtfs_path):
+    return ExpandedGraph.from_timetable(Timetable.from_gtfs(gtfs_path, DATE), 1)
+
+
+def ride_distances(graph):
+    source = np.repeat(np.arange(len(graph.node_ids)), np.diff(graph.indptr))[graph.ride]
+    target = graph.indices[graph.ride]
+    return haversine(graph.lat[source], graph.lon[source], graph.lat[target], graph.lon[target])
+
+
+def test_vehicle_speed_is_the_fastest_ride(graph):
+    distances = ride_distances(graph)
+    assert graph.vehicle_speed() == pytest.approx((distances / graph.weight[graph.ride]).max())
+
+
+@pytest.mark.parametrize('seconds, counted', [(30, 30), (0, MIN_HOP)])
+def test_only_rides_timed_0_count_as_min_hop(graph, seconds, counted):
+    rides = np.flatnonzero(graph.ride)
+    graph.weight[rides[0]] = seconds
+    assert graph.vehicle_speed() == pytest.approx(ride_distances(graph)[0] / counted)
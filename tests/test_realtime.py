@@ -0,0 +1,87 @@
+"""DelayOverlay and RealtimeFeed against the recorded updates of tests/fixtures/gtfs_rt.
+
+The fixture feed runs on 2024-01-18 from STOP A to STOP D:
+T1 (R1) 08:00 A, 08:10 B, 08:20 C, 08:30 D; T2 (R2) 08:05 A, 08:40 D;
+T3 (R1) 08:30 A, 08:40 B, 08:50 C, 09:00 D.
+"""
+import numpy as np
+
+from conftest import DATE
+from csa import ConnectionScan
+from realtime import CANCELLED, RealtimeFeed
+from timetable import Feed, time_to_seconds
+
+
+def stoptimes(tt, trip_id):
+    trip = list(tt.trip_ids).index(trip_id)
+    return slice(tt.trip_offsets[trip], tt.trip_offsets[trip + 1])
+
+
+def times(values):
+    return [time_to_seconds(value) for value in values]
+
+
+def arrival(feed, time='07:55:00', source='STOP A', target='STOP D'):
+    rows = ConnectionScan(feed).routing(DATE, 1, time, source, target)
+    return str(rows[-1][-1]) if rows else None
+
+
+def test_delay_holds_until_the_next_update(gtfs_path, updates):
+    feed = RealtimeFeed(Feed(gtfs_path))
+    assert feed.load(updates('delays')) == 2
+    tt = feed.timetable(DATE)
+    # T1: 5 minutes late at B, and so at C and D
+    t1 = stoptimes(tt, 'T1')
+    assert list(tt.st_arrival[t1]) == times(['08:00:00', '08:15:00', '08:25:00', '08:35:00'])
+    assert list(tt.st_departure[t1]) == times(['08:00:00', '08:15:00', '08:25:00', '08:35:00'])
+    # T3: 2 minutes late from A, 1 minute from C on (absolute time of the update)
+    t3 = stoptimes(tt, 'T3')
+    assert list(tt.st_departure[t3]) == times(['08:32:00', '08:42:00', '08:51:00', '09:01:00'])
+    assert feed.version(DATE) == 2
+
+
+def test_update_replaces_the_previous_one_of_its_trip(gtfs_path, updates):
+    feed = RealtimeFeed(Feed(gtfs_path))
+    feed.load(updates('delays'))
+    feed.load(updates('reorder'))
+    tt = feed.timetable(DATE)
+    # T1 leaves A 10 minutes late and the 5 minutes at B are forgotten; T3 keeps its delays
+    assert list(tt.st_departure[stoptimes(tt, 'T1')]) == times(['08:10:00', '08:20:00', '08:30:00', '08:40:00'])
+    assert tt.st_departure[stoptimes(tt, 'T3')][0] == time_to_seconds('08:32:00')
+
+
+def test_cancelled_trip(gtfs_path, updates):
+    feed = RealtimeFeed(Feed(gtfs_path))
+    assert feed.load(updates('cancelled')) == 1
+    tt = feed.timetable(DATE)
+    assert (tt.st_departure[stoptimes(tt, 'T1')] == CANCELLED).all()
+    # Only T2 is left before T3
+    assert arrival(feed) == '08:40:00'
+
+
+def test_connections_resorted_after_delays(gtfs_path, updates):
+    feed = RealtimeFeed(Feed(gtfs_path))
+    scheduled = feed.timetable(DATE)
+    first = scheduled.connections[0]
+    assert scheduled.trip_ids[scheduled.st_trip[first]] == 'T1'
+    feed.load(updates('reorder'))
+    tt = feed.timetable(DATE)
+    departures = tt.st_departure[tt.connections]
+    assert (np.diff(departures) >= 0).all()
+    assert sorted(tt.connections) == sorted(scheduled.connections)
+    # T1 now leaves A at 08:10, after T2
+    assert [str(tt.trip_ids[tt.st_trip[c]]) for c in tt.connections[:2]] == ['T2', 'T1']
+    # The schedule itself is untouched
+    assert scheduled.st_departure[first] == time_to_seconds('08:00:00')
+
+
+def test_csa_arrival_follows_the_overlay(gtfs_path, updates):
+    feed = RealtimeFeed(Feed(gtfs_path))
+    assert arrival(feed) == '08:30:00'
+    feed.load(updates('delays'))
+    assert arrival(feed) == '08:35:00'
+    feed.load(updates('reorder'))
+    # T1 reaches D at 08:40 like T2
+    assert arrival(feed) == '08:40:00'
+    feed.clear(DATE)
+    assert arrival(feed) == '08:30:00'
@@ -0,0 +1,51 @@
+"""Feed snapshots across a new GTFS edition."""
+import os
+import shutil
+
+import numpy as np
+
+from conftest import DATE
+from snapshot import compile_snapshot
+from timetable import Feed, time_to_seconds
+from walking import WalkingTable
+
+
+def test_invalidate_recompiles_the_snapshot(gtfs_path, tmp_path):
+    snapshots = str(tmp_path / 'snapshots')
+    compile_snapshot(gtfs_path, DATE, os.path.join(snapshots, DATE))
+    new_edition = str(tmp_path / 'gtfs')
+    shutil.copytree(gtfs_path, new_edition)
+    with open(os.path.join(new_edition, 'stop_times.txt')) as file:
+        stop_times = file.read()
+    with open(os.path.join(new_edition, 'stop_times.txt'), 'w') as file:
+        file.write(stop_times.replace('T1,08:00:00,08:00:00', 'T1,08:01:00,08:01:00'))
+
+    feed = Feed(gtfs_path, snapshot_dir=snapshots)
+    assert feed.timetable(DATE).st_departure.min() == time_to_seconds('08:00:00')
+    feed.gtfs_path = new_edition
+    feed.invalidate([DATE])
+    assert not os.path.exists(os.path.join(snapshots, DATE))
+    assert feed.timetable(DATE).st_departure.min() == time_to_seconds('08:01:00')
+    # Compiled again from the new edition, for the next process opening it
+    assert Feed(gtfs_path, snapshot_dir=snapshots).timetable(DATE).st_departure.min() == time_to_seconds('08:01:00')
+
+
+def test_snapshot_keeps_the_walking_table(gtfs_path, tmp_path):
+    # STOP A and STOP B are 1.6 km apart: a walk between them only comes from the table
+    table = WalkingTable(np.array(['A', 'B', 'C', 'D']), np.array([], dtype=str),
+                         np.array([0, 2, 4, 5, 6]), np.array([0, 1, 0, 1, 2, 3]),
+                         np.array([0.0, 1700.0, 1700.0, 0.0, 0.0, 0.0]),
+                         np.zeros(1, dtype=np.int64), np.array([], dtype=np.int64), np.array([]), 2000)
+    walking_table = str(tmp_path / 'walking.npz')
+    table.save(walking_table)
+    snapshots = str(tmp_path / 'snapshots')
+    compile_snapshot(gtfs_path, DATE, os.path.join(snapshots, DATE), walking_table=walking_table)
+
+    tt = Feed(gtfs_path, snapshot_dir=snapshots, walking_table=walking_table).timetable(DATE)
+    assert isinstance(tt.fp_indices, np.memmap)
+    a, b = list(tt.stop_ids).index('A'), list(tt.stop_ids).index('B')
+    assert b in tt.fp_indices[tt.fp_indptr[a]:tt.fp_indptr[a + 1]]
+    # Without the table the snapshot's footpaths are not the Feed's: the GTFS files are read instead
+    tt = Feed(gtfs_path, snapshot_dir=snapshots).timetable(DATE)
+    assert not isinstance(tt.fp_indices, np.memmap)
+    assert b not in tt.fp_indices[tt.fp_indptr[a]:tt.fp_indptr[a + 1]]
@@ -0,0 +1,43 @@
+"""Transfer patterns against the feed they were computed on."""
+import os
+import shutil
+
+import pytest
+
+from conftest import DATE
+from timetable import Feed
+from transfer_patterns import TransferPatternRouter, precompute
+
+
+@pytest.fixture
+def patterns(gtfs_path, tmp_path):
+    path = str(tmp_path / 'patterns')
+    precompute(gtfs_path, path)
+    return path
+
+
+def test_routing_on_the_patterns(gtfs_path, patterns):
+    router = TransferPatternRouter(Feed(gtfs_path), patterns)
+    assert str(router.routing(DATE, 1, '07:55:00', 'STOP A', 'STOP D')[-1][-1]) == '08:30:00'
+
+
+def test_date_without_patterns(gtfs_path, patterns):
+    router = TransferPatternRouter(Feed(gtfs_path), patterns)
+    with pytest.raises(ValueError, match='no transfer patterns for 2024-01-19'):
+        router.routing('2024-01-19', 1, '07:55:00', 'STOP A', 'STOP D')
+    router.invalidate([DATE])
+    with pytest.raises(ValueError, match='no transfer patterns for %s' % DATE):
+        router.routing(DATE, 1, '07:55:00', 'STOP A', 'STOP D')
+
+
+def test_other_stops_are_refused(gtfs_path, patterns, tmp_path):
+    new_edition = str(tmp_path / 'gtfs')
+    shutil.copytree(gtfs_path, new_edition)
+    with open(os.path.join(new_edition, 'stops.txt')) as file:
+        lines = file.read().splitlines()
+    # Same stops in another order: the indices of the patterns would point at other stops
+    with open(os.path.join(new_edition, 'stops.txt'), 'w') as file:
+        file.write('\n'.join(lines[:1] + lines[:0:-1]) + '\n')
+    router = TransferPatternRouter(Feed(new_edition), patterns)
+    with pytest.raises(ValueError, match='other stops'):
+        router.routing(DATE, 1, '07:55:00', 'STOP A', 'STOP D')
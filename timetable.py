@@ -0,0 +1,270 @@
+"""Array-backed timetable of one service day, read straight from the GTFS files.
+
+The arrays mirror what new_dbSetup.py loads in Neo4j: every row of
+stop_times.txt whose trip runs on the day becomes a Stoptime, consecutive
+Stoptimes of a trip are the PRECEDES edges and stops closer than 300 m are
+joined by WALK_TO footpaths.
+"""
+import csv
+import os
+import shutil
+from datetime import time as dtime
+
+import numpy as np
+
+from spatial import GridIndex
+
+# Same threshold used by new_dbSetup.py for the WALK_TO relationships
+WALK_RADIUS = 300
+
+
+def time_to_seconds(value):
+    """Convert a GTFS 'HH:MM:SS' string (hours may exceed 24) to seconds."""
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def seconds_to_time(seconds):
+    """Convert seconds after midnight to a datetime.time, as Neo4j time() does."""
+    seconds = int(seconds) % 86400
+    return dtime(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def active_services(gtfs_path, date):
+    """Service ids linked to the given day in new_calendar_dates.txt.
+
+    Like the VALID_IN relationships built by new_dbSetup.py, every row of the
+    day is taken regardless of its exception_type.
+    """
+    with open(os.path.join(gtfs_path, 'new_calendar_dates.txt'), newline='') as file:
+        return {row['service_id'] for row in csv.DictReader(file) if row['day'] == date}
+
+
+def walk_footpaths(lat, lon, radius=WALK_RADIUS):
+    """CSR adjacency (indptr, indices, distance) of the stops closer than radius."""
+    return GridIndex(lat, lon, radius).pairs_within(radius)
+
+
+class Timetable:
+    """Stops, trips, Stoptimes and WALK_TO footpaths of a single service day.
+
+    Stoptimes are stored trip by trip: the Stoptimes of trip i are the slice
+    trip_offsets[i]:trip_offsets[i + 1], ordered by stop_sequence. Times are
+    integer seconds after midnight of the service day.
+    """
+
+    def __init__(self, date, stop_ids, stop_names, stop_lat, stop_lon, route_ids, trip_ids, trip_route,
+                 trip_offsets, st_stop, st_sequence, st_arrival, st_departure, fp_indptr, fp_indices, fp_distance,
+                 connections=None, st_trip=None):
+        self.date = date
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.route_ids = route_ids
+        self.trip_ids = trip_ids
+        self.trip_route = trip_route
+        self.trip_offsets = trip_offsets
+        self.st_stop = st_stop
+        self.st_sequence = st_sequence
+        self.st_arrival = st_arrival
+        self.st_departure = st_departure
+        self.fp_indptr = fp_indptr
+        self.fp_indices = fp_indices
+        self.fp_distance = fp_distance
+        self._connections = connections
+        self._st_trip = st_trip
+        self._name_index = None
+        self._active_index = None
+
+    @classmethod
+    def from_gtfs(cls, gtfs_path, date, walk_radius=WALK_RADIUS, walking_table=None):
+        """Load the Stoptimes of the trips running on date ('YYYY-MM-DD').
+
+        Footpaths are the stops closer than walk_radius in a straight line, or
+        the walking distances of walking_table (see walking.py) when given.
+        """
+        services = active_services(gtfs_path, date)
+
+        with open(os.path.join(gtfs_path, 'stops.txt'), newline='', encoding='utf-8-sig') as file:
+            stops = list(csv.DictReader(file))
+        stop_index = {row['stop_id']: i for i, row in enumerate(stops)}
+
+        trip_index, trip_ids, trip_route_ids = {}, [], []
+        with open(os.path.join(gtfs_path, 'trips.txt'), newline='', encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                if row['service_id'] in services:
+                    trip_index[row['trip_id']] = len(trip_ids)
+                    trip_ids.append(row['trip_id'])
+                    trip_route_ids.append(row['route_id'])
+
+        rows = []
+        with open(os.path.join(gtfs_path, 'stop_times.txt'), newline='', encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                trip = trip_index.get(row['trip_id'])
+                if trip is not None:
+                    rows.append((trip, int(row['stop_sequence']), stop_index[row['stop_id']],
+                                 time_to_seconds(row['arrival_time']), time_to_seconds(row['departure_time'])))
+        rows.sort()
+        table = np.array(rows, dtype=np.int64).reshape(-1, 5)
+
+        route_ids, trip_route = np.unique(np.array(trip_route_ids, dtype=str), return_inverse=True)
+        trip_offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(table[:, 0], minlength=len(trip_ids)), out=trip_offsets[1:])
+
+        lat = np.array([float(row['stop_lat']) for row in stops])
+        lon = np.array([float(row['stop_lon']) for row in stops])
+        if walking_table is not None:
+            fp_indptr, fp_indices, fp_distance = walking_table.footpaths([row['stop_id'] for row in stops])
+        else:
+            fp_indptr, fp_indices, fp_distance = walk_footpaths(lat, lon, walk_radius)
+
+        return cls(date,
+                   np.array([row['stop_id'] for row in stops], dtype=str),
+                   np.array([row['stop_name'] for row in stops], dtype=str),
+                   lat, lon, route_ids,
+                   np.array(trip_ids, dtype=str),
+                   trip_route.astype(np.int32),
+                   trip_offsets,
+                   table[:, 2].astype(np.int32),
+                   table[:, 1].astype(np.int32),
+                   table[:, 3].astype(np.int32),
+                   table[:, 4].astype(np.int32),
+                   fp_indptr, fp_indices, fp_distance)
+
+    @property
+    def st_trip(self):
+        """Trip index of every Stoptime."""
+        if self._st_trip is None:
+            self._st_trip = np.repeat(np.arange(len(self.trip_ids), dtype=np.int32), np.diff(self.trip_offsets))
+        return self._st_trip
+
+    @property
+    def connections(self):
+        """PRECEDES edges as Stoptime indices, sorted by departure time.
+
+        Connection c leaves Stoptime connections[c] and reaches the next
+        Stoptime of the same trip, connections[c] + 1.
+        """
+        if self._connections is None:
+            last = np.zeros(len(self.st_stop), dtype=bool)
+            last[self.trip_offsets[1:][np.diff(self.trip_offsets) > 0] - 1] = True
+            departures = np.flatnonzero(~last)
+            order = np.argsort(self.st_departure[departures], kind='stable')
+            self._connections = departures[order].astype(np.int64)
+        return self._connections
+
+    def stops_by_name(self, name):
+        """Indices of the stops called name (one per direction, usually)."""
+        if self._name_index is None:
+            self._name_index = {}
+            for i, stop_name in enumerate(self.stop_names):
+                self._name_index.setdefault(str(stop_name), []).append(i)
+        return self._name_index.get(name, [])
+
+    @property
+    def active_stops(self):
+        """Indices of the stops served by at least one Stoptime of the day."""
+        return np.unique(self.st_stop)
+
+    def near_stops(self, lat, lon, radius):
+        """Active stops closer than radius meters to (lat, lon): (indices, distances) by distance."""
+        if self._active_index is None:
+            active = self.active_stops
+            self._active_index = (active, GridIndex(self.stop_lat[active], self.stop_lon[active], max(radius, 100)))
+        active, index = self._active_index
+        near, distances = index.query_radius(lat, lon, radius)
+        return active[near], distances
+
+    def footpaths(self, stop):
+        """Neighbour stops and WALK_TO distances in meters of stop."""
+        start, end = self.fp_indptr[stop], self.fp_indptr[stop + 1]
+        return self.fp_indices[start:end], self.fp_distance[start:end]
+
+    def itinerary_row(self, st1, st2):
+        """One path step in the column layout returned by App._routing."""
+        s, next_s = self.st_stop[st1], self.st_stop[st2]
+        t, next_t = self.st_trip[st1], self.st_trip[st2]
+        return [str(self.trip_ids[t]), seconds_to_time(self.st_departure[st1]), str(self.route_ids[self.trip_route[t]]),
+                str(self.stop_names[s]), str(self.stop_ids[s]), [float(self.stop_lat[s]), float(self.stop_lon[s])],
+                str(self.trip_ids[next_t]), str(self.stop_names[next_s]), str(self.stop_ids[next_s]),
+                [float(self.stop_lat[next_s]), float(self.stop_lon[next_s])],
+                str(self.route_ids[self.trip_route[next_t]]), seconds_to_time(self.st_arrival[st2])]
+
+    def itinerary(self, legs):
+        """Expand ridden legs, (board Stoptime, alight Stoptime), into App._routing rows."""
+        rows = []
+        for i, (board, alight) in enumerate(legs):
+            if i > 0:
+                rows.append(self.itinerary_row(legs[i - 1][1], board))
+            for st in range(board, alight):
+                rows.append(self.itinerary_row(st, st + 1))
+        return rows
+
+    @property
+    def nbytes(self):
+        """Memory held by the timetable arrays."""
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+
+class Feed:
+    """GTFS feed on disk whose Timetables are loaded once per date and shared by the engines.
+
+    When snapshot_dir holds a snapshot of the date (see snapshot.py) with
+    the footpaths of walk_radius or walking_table, as here, it is
+    memory-mapped instead of parsing the GTFS files; invalidate() deletes the
+    snapshots of the days it forgets, which are compiled again on next use.
+    walking_table, the path of a table written by walking.py, replaces the
+    straight-line footpaths.
+    """
+
+    def __init__(self, gtfs_path, walk_radius=WALK_RADIUS, snapshot_dir=None, walking_table=None):
+        self.gtfs_path = gtfs_path
+        self.walk_radius = walk_radius
+        self.snapshot_dir = snapshot_dir
+        self.walking_table = walking_table
+        self._walking = None
+        self._timetables = {}
+        # Dates whose snapshot invalidate() deleted, to compile again from the GTFS files
+        self._stale = set()
+
+    def timetable(self, date):
+        """Timetable of date, loaded on first use."""
+        if date not in self._timetables:
+            path = os.path.join(self.snapshot_dir, date) if self.snapshot_dir else None
+            if path and os.path.isdir(path) and self._snapshot_matches(path):
+                from snapshot import open_snapshot
+                self._timetables[date] = open_snapshot(path)
+            else:
+                if self.walking_table and self._walking is None:
+                    from walking import WalkingTable
+                    self._walking = WalkingTable.load(self.walking_table)
+                tt = Timetable.from_gtfs(self.gtfs_path, date, self.walk_radius, self._walking)
+                if date in self._stale:
+                    from snapshot import save_snapshot
+                    save_snapshot(tt, path, self.walk_radius, self.walking_table)
+                    self._stale.discard(date)
+                self._timetables[date] = tt
+        return self._timetables[date]
+
+    def _snapshot_matches(self, path):
+        # A snapshot compiled with other footpaths is left alone: the GTFS files are read instead
+        from snapshot import footpaths_match
+        return footpaths_match(path, self.walk_radius, self.walking_table)
+
+    def invalidate(self, dates=None):
+        """Forget the Timetables of dates, or all of them, so they are loaded again on next use.
+
+        The snapshots of those dates in snapshot_dir are deleted, otherwise the
+        old edition would be mapped again; each is compiled again from the GTFS
+        files the next time its date is used.
+        """
+        for date in list(self._timetables):
+            if dates is None or date in dates:
+                del self._timetables[date]
+        if self.snapshot_dir and os.path.isdir(self.snapshot_dir):
+            for date in os.listdir(self.snapshot_dir) if dates is None else dates:
+                path = os.path.join(self.snapshot_dir, date)
+                if os.path.isfile(os.path.join(path, 'meta.json')):
+                    shutil.rmtree(path)
+                    self._stale.add(date)
@@ -0,0 +1,331 @@
+"""Structured tracing of the App methods and of the Cypher statements they run.
+
+A Tracer records spans: name, wall time, attributes and parent, grouped in
+traces (one per outermost call). App(..., tracer=Tracer(...)) opens a span
+for every public method and for the stages behind them, and wraps the Neo4j
+driver so that every statement gets a 'cypher' span with the statement
+name from queries.py, the rows returned and the result_available_after /
+result_consumed_after timings of the driver summary. With profile=True the
+sampled statements run under PROFILE and their spans also carry the total
+db hits and the operator plan.
+
+Sampling keeps it cheap enough to stay on: sample_rate is the share of
+traces kept (and profiled), and traces whose outermost span takes more than
+slow_ms are kept anyway, so slow route queries are always explained. Kept
+spans are written as JSON lines to path and held in memory in spans.
+
+    python tracing.py traces.jsonl [--top 10]
+
+prints the slowest traces of a file as trees of their spans.
+"""
+import argparse
+import contextvars
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import queries
+
+_current = contextvars.ContextVar('span', default=None)
+
+# Statement text -> name in queries.py, to label the cypher spans
+_STATEMENTS = {value: name for name, value in vars(queries).items() if name.isupper() and isinstance(value, str)}
+
+
+def statement_name(query):
+    return _STATEMENTS.get(query, 'ad_hoc')
+
+
+def _scalar(value):
+    """value if it fits in a JSON attribute, else a short description."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value if not isinstance(value, str) or len(value) <= 200 else value[:200] + '...'
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        return '<%s of %d>' % (type(value).__name__, len(value))
+    return '<%s>' % type(value).__name__
+
+
+def plan_summary(plan):
+    """(total db hits, operator tree) of a PROFILE plan from the driver summary."""
+    children = [plan_summary(child) for child in plan.get('children', [])]
+    hits = plan.get('dbHits', 0) + sum(child_hits for child_hits, _ in children)
+    node = {'operator': plan.get('operatorType'), 'rows': plan.get('rows'), 'db_hits': plan.get('dbHits'),
+            'children': [tree for _, tree in children]}
+    return hits, node
+
+
+class Trace:
+    """Spans of one outermost call, kept or dropped together when it ends."""
+
+    def __init__(self, sampled):
+        self.id = '%016x' % random.getrandbits(64)
+        self.sampled = sampled
+        self.spans = []
+
+
+class Span:
+    def __init__(self, tracer, trace, name, parent, attributes):
+        self.trace = trace
+        self.id = '%x' % next(tracer._ids)
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {'trace_id': self.trace.id, 'span_id': self.id, 'parent_id': self.parent.id if self.parent else None,
+                'name': self.name, 'start': self.start, 'duration_ms': self.duration * 1000,
+                'attributes': self.attributes}
+
+
+class Tracer:
+    """Collects spans, keeps sample_rate of the traces plus the ones slower than slow_ms."""
+
+    def __init__(self, path=None, sample_rate=1.0, slow_ms=None, profile=False, max_spans=10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.profile = profile
+        # Kept spans, most recent last
+        self.spans = deque(maxlen=max_spans)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a') if path else None
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_ms is not None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Span around the with block, child of the span open in this context if any."""
+        parent = _current.get()
+        if not self.enabled:
+            yield None
+            return
+        trace = parent.trace if parent else Trace(random.random() < self.sample_rate)
+        span = Span(self, trace, name, parent, {key: _scalar(value) for key, value in attributes.items()})
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.set(error=repr(error))
+            raise
+        finally:
+            _current.reset(token)
+            span.duration = time.perf_counter() - span._start
+            trace.spans.append(span)
+            slow = self.slow_ms is not None and span.duration * 1000 >= self.slow_ms
+            if parent is None and (trace.sampled or slow):
+                self.emit(trace)
+
+    def emit(self, trace):
+        records = [span.to_dict() for span in trace.spans]
+        with self._lock:
+            self.spans.extend(records)
+            if self._file is not None:
+                for record in records:
+                    self._file.write(json.dumps(record, default=str) + '\n')
+                self._file.flush()
+
+    def export(self, path):
+        """Write the spans held in memory to path as JSON lines."""
+        with self._lock:
+            records = list(self.spans)
+        with open(path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record, default=str) + '\n')
+        return len(records)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def driver(self, driver):
+        """driver with every statement run through it traced."""
+        return TracedDriver(driver, self)
+
+    def run(self, runner, query, parameters=None, **kwargs):
+        """runner.run(query) inside a 'cypher' span; the records are fetched here and served from memory."""
+        params = dict(parameters or {}, **kwargs)
+        with self.span('cypher', statement=statement_name(query),
+                       **{'param.' + key: value for key, value in params.items()}) as span:
+            profiled = span is not None and self.profile and span.trace.sampled
+            result = runner.run('PROFILE ' + query if profiled else query, parameters, **kwargs)
+            keys = result.keys()
+            records = list(result)
+            summary = result.consume()
+            if span is not None:
+                span.set(rows=len(records), available_after_ms=summary.result_available_after,
+                         consumed_after_ms=summary.result_consumed_after)
+                if profiled and summary.profile:
+                    hits, plan = plan_summary(summary.profile)
+                    span.set(db_hits=hits, plan=plan)
+        return TracedResult(keys, records, summary)
+
+
+class TracedResult:
+    """Records of a statement already fetched, with the parts of neo4j.Result the repository uses."""
+
+    def __init__(self, keys, records, summary):
+        self._keys = keys
+        self._records = records
+        self._summary = summary
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def keys(self):
+        return self._keys
+
+    def values(self, *keys):
+        return [record.values(*keys) for record in self._records]
+
+    def data(self, *keys):
+        return [record.data(*keys) for record in self._records]
+
+    def value(self, key=0, default=None):
+        return [record.value(key, default) for record in self._records]
+
+    def single(self, strict=False):
+        if strict and len(self._records) != 1:
+            raise ValueError('expected one record, got %d' % len(self._records))
+        return self._records[0] if self._records else None
+
+    def consume(self):
+        return self._summary
+
+
+class TracedTransaction:
+    def __init__(self, tx, tracer):
+        self._tx = tx
+        self._tracer = tracer
+
+    def run(self, query, parameters=None, **kwargs):
+        return self._tracer.run(self._tx, query, parameters, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._tx, name)
+
+
+class TracedSession:
+    def __init__(self, session, tracer):
+        self._session = session
+        self._tracer = tracer
+
+    def __enter__(self):
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._session.__exit__(*exc)
+
+    def run(self, query, parameters=None, **kwargs):
+        return self._tracer.run(self._session, query, parameters, **kwargs)
+
+    def _transaction(self, execute, function, *args, **kwargs):
+        return execute(lambda tx, *a, **k: function(TracedTransaction(tx, self._tracer), *a, **k), *args, **kwargs)
+
+    def read_transaction(self, function, *args, **kwargs):
+        return self._transaction(self._session.read_transaction, function, *args, **kwargs)
+
+    def write_transaction(self, function, *args, **kwargs):
+        return self._transaction(self._session.write_transaction, function, *args, **kwargs)
+
+    def execute_read(self, function, *args, **kwargs):
+        return self._transaction(self._session.execute_read, function, *args, **kwargs)
+
+    def execute_write(self, function, *args, **kwargs):
+        return self._transaction(self._session.execute_write, function, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class TracedDriver:
+    def __init__(self, driver, tracer):
+        self._driver = driver
+        self.tracer = tracer
+
+    def session(self, **kwargs):
+        return TracedSession(self._driver.session(**kwargs), self.tracer)
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+
+def traced(method):
+    """Method decorator: a span named Class.method when self.tracer is set, with the arguments as arg.<name>."""
+    names = method.__code__.co_varnames[1:method.__code__.co_argcount]
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        tracer = getattr(self, 'tracer', None)
+        if tracer is None:
+            return method(self, *args, **kwargs)
+        arguments = dict(zip(names, args), **kwargs)
+        with tracer.span('%s.%s' % (type(self).__name__, method.__name__),
+                         **{'arg.' + key: value for key, value in arguments.items()}):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def load(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def slowest(spans, top=10):
+    """The top slowest traces of spans, as (root span, children by parent id)."""
+    traces = {}
+    for span in spans:
+        traces.setdefault(span['trace_id'], []).append(span)
+    result = []
+    for trace in traces.values():
+        roots = [span for span in trace if span['parent_id'] is None]
+        if not roots:
+            continue
+        children = {}
+        for span in trace:
+            children.setdefault(span['parent_id'], []).append(span)
+        result.append((roots[0], children))
+    result.sort(key=lambda item: -item[0]['duration_ms'])
+    return result[:top]
+
+
+def print_tree(span, children, depth=0):
+    attributes = span['attributes']
+    detail = attributes.get('statement', '')
+    if 'rows' in attributes:
+        detail += ' rows=%s' % attributes['rows']
+    if 'db_hits' in attributes:
+        detail += ' db_hits=%s' % attributes['db_hits']
+    if 'error' in attributes:
+        detail += ' error=%s' % attributes['error']
+    print('%s%-40s %10.2f ms  %s' % ('  ' * depth, span['name'], span['duration_ms'], detail))
+    for child in sorted(children.get(span['span_id'], []), key=lambda child: child['start']):
+        print_tree(child, children, depth + 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        parser.error('no such file: %s' % args.path)
+    for root, children in slowest(load(args.path), args.top):
+        print_tree(root, children)
+        print()
@@ -0,0 +1,329 @@
+"""Transfer patterns: precomputed change sequences for fast point-to-point queries.
+
+The optimal journeys from a stop, over all the departures of a day, change
+trips at only a few stops. For every origin stop a one-to-all Connection Scan
+is run at each of its departures and the stops where each optimal journey
+boards and alights are stored per target: its transfer pattern. Days with
+the same active services (the Service nodes VALID_IN a Day) have the same
+timetable, so patterns are computed once per day type.
+
+An online query only evaluates the few patterns of (source, target): each
+leg is looked up in the direct-connection table of the route patterns (the
+first trip leaving the board stop after the current time that also serves
+the alight stop), with WALK_TO footpaths between legs.
+
+Patterns refer to stops by their position in the Timetable, so meta.json
+keeps a digest of the stop ids of every day type: a Timetable with other
+stops, e.g. from a new GTFS edition, is refused instead of being routed on
+indices that no longer mean the same stops.
+
+    python transfer_patterns.py GTFS_DIR OUT_DIR [--speed 1] [--workers 4] [--verify 200]
+
+prints the precompute time and size of every day type and, with --verify,
+compares the arrivals with those of the Connection Scan, which answers the
+same earliest-arrival question as the Dijkstra of App.routing.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from csa import INF, ConnectionScan
+from raptor import RoutePatterns
+from timetable import WALK_RADIUS, Feed, time_to_seconds
+
+_tt = None
+
+
+def stops_digest(stop_ids):
+    """Hex digest of the stop ids in Timetable order, the stops the indices of the patterns refer to."""
+    return hashlib.blake2b('\x1f'.join(str(stop_id) for stop_id in stop_ids).encode(), digest_size=16).hexdigest()
+
+
+def day_types(gtfs_path):
+    """{frozenset of active service ids: sorted days} from new_calendar_dates.txt."""
+    services = {}
+    with open(os.path.join(gtfs_path, 'new_calendar_dates.txt'), newline='') as file:
+        for row in csv.DictReader(file):
+            services.setdefault(row['day'], set()).add(row['service_id'])
+    types = {}
+    for day, day_services in services.items():
+        types.setdefault(frozenset(day_services), []).append(day)
+    return {key: sorted(days) for key, days in types.items()}
+
+
+def origin_patterns(tt, origin, speed, max_duration=4):
+    """{target stop: set of patterns} of origin, a pattern being the (board, alight) stops of each leg."""
+    firsts = tt.trip_offsets[1:] - 1
+    departures = np.unique(tt.st_departure[(tt.st_stop == origin) & ~np.isin(np.arange(len(tt.st_stop)), firsts)])
+    patterns = {}
+    for departure in departures:
+        # One second earlier: the scan boards trips leaving after its departure
+        labels = ConnectionScan.labels(tt, speed, int(departure) - 1, {origin: 0},
+                                       int(departure) + max_duration * 3600)
+        for target in np.flatnonzero(labels.ride_arrival < INF):
+            if target == origin:
+                continue
+            legs = labels.legs(tt, (labels.ride_board[target], labels.ride_alight[target]))
+            patterns.setdefault(int(target), set()).add(
+                tuple(int(tt.st_stop[st]) for leg in legs for st in leg))
+    return patterns
+
+
+def _open(gtfs_path, date, walk_radius):
+    global _tt
+    _tt = Feed(gtfs_path, walk_radius).timetable(date)
+
+
+def _compute(origins, speed, max_duration):
+    rows = []
+    for origin in origins:
+        for target, patterns in origin_patterns(_tt, origin, speed, max_duration).items():
+            rows.extend((origin, target, pattern) for pattern in sorted(patterns))
+    return rows
+
+
+class TransferPatterns:
+    """Transfer patterns of one day type, as flat arrays sorted by (origin, target)."""
+
+    def __init__(self, n_stops, origin, target, offsets, stops):
+        self.n_stops = n_stops
+        self.origin, self.target, self.offsets, self.stops = origin, target, offsets, stops
+        self.keys = origin.astype(np.int64) * n_stops + target
+
+    @classmethod
+    def compute(cls, tt, speed=1, max_duration=4, workers=1, gtfs_path=None, walk_radius=WALK_RADIUS):
+        """Patterns of every stop of tt; with workers > 1 the origins are split over a process pool
+        whose workers load the same day from gtfs_path."""
+        origins = [int(stop) for stop in tt.active_stops]
+        if workers > 1:
+            chunks = [origins[i::workers * 4] for i in range(workers * 4)]
+            with ProcessPoolExecutor(workers, initializer=_open, initargs=(gtfs_path, tt.date, walk_radius)) as pool:
+                rows = [row for part in pool.map(_compute, chunks, [speed] * len(chunks),
+                                                 [max_duration] * len(chunks)) for row in part]
+        else:
+            global _tt
+            _tt = tt
+            rows = _compute(origins, speed, max_duration)
+        rows.sort()
+        lengths = np.array([len(pattern) for _, _, pattern in rows], dtype=np.int64)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        stops = np.fromiter((stop for _, _, pattern in rows for stop in pattern), dtype=np.int32, count=offsets[-1])
+        return cls(len(tt.stop_ids), np.array([row[0] for row in rows], dtype=np.int32),
+                   np.array([row[1] for row in rows], dtype=np.int32), offsets, stops)
+
+    def patterns(self, origin, target):
+        """Patterns from origin to target, each a tuple of (board, alight) stop pairs flattened."""
+        key = int(origin) * self.n_stops + int(target)
+        start, end = np.searchsorted(self.keys, key, side='left'), np.searchsorted(self.keys, key, side='right')
+        return [tuple(self.stops[self.offsets[i]:self.offsets[i + 1]]) for i in range(start, end)]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.origin, self.target, self.offsets, self.stops))
+
+    def save(self, path):
+        np.savez_compressed(path, n_stops=self.n_stops, origin=self.origin, target=self.target,
+                            offsets=self.offsets, stops=self.stops)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data['n_stops']), data['origin'], data['target'], data['offsets'], data['stops'])
+
+
+def precompute(gtfs_path, out_dir, speed=1, max_duration=4, workers=1, walk_radius=WALK_RADIUS):
+    """Transfer patterns of every day type of the feed, written to out_dir with a meta.json."""
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {'speed': speed, 'max_duration': max_duration, 'walk_radius': walk_radius, 'day_types': {}}
+    feed = Feed(gtfs_path, walk_radius)
+    for i, (services, days) in enumerate(sorted(day_types(gtfs_path).items(), key=lambda item: item[1][0])):
+        name = 'daytype_%02d' % i
+        start = timeit.default_timer()
+        tt = feed.timetable(days[0])
+        patterns = TransferPatterns.compute(tt, speed, max_duration, workers, gtfs_path, walk_radius)
+        seconds = timeit.default_timer() - start
+        feed.invalidate([days[0]])
+        path = os.path.join(out_dir, name + '.npz')
+        patterns.save(path)
+        meta['day_types'][name] = {'services': sorted(services), 'days': days, 'stops': stops_digest(tt.stop_ids),
+                                   'patterns': len(patterns.origin),
+                                   'nbytes': patterns.nbytes, 'file_bytes': os.path.getsize(path),
+                                   'seconds': round(seconds, 2)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=2)
+    return meta
+
+
+class TransferPatternRouter:
+    """Point-to-point routing on the transfer patterns written by precompute."""
+
+    def __init__(self, feed, path):
+        self.feed = feed
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as file:
+            self.meta = json.load(file)
+        self.day_type = {day: name for name, day_type in self.meta['day_types'].items() for day in day_type['days']}
+        self._patterns = {}
+        self._route_patterns = {}
+
+    def day_type_name(self, date):
+        """Name of the day type of date, ValueError when no patterns were computed for it."""
+        name = self.day_type.get(date)
+        if name is None:
+            raise ValueError('no transfer patterns for %s in %s, run transfer_patterns.py on the current feed'
+                             % (date, self.path))
+        return name
+
+    def invalidate(self, days):
+        """Forget the patterns of days, computed on a timetable that has changed since."""
+        for day in days:
+            self.day_type.pop(day, None)
+            self._route_patterns.pop(day, None)
+        used = set(self.day_type.values())
+        self._patterns = {name: patterns for name, patterns in self._patterns.items() if name in used}
+
+    def transfer_patterns(self, date):
+        name = self.day_type_name(date)
+        if name not in self._patterns:
+            self._patterns[name] = TransferPatterns.load(os.path.join(self.path, name + '.npz'))
+        return self._patterns[name]
+
+    def route_patterns(self, date):
+        """RoutePatterns of date with, per stop, where each pattern serves it: the direct-connection table.
+
+        Raises ValueError when the stops of the timetable are not those the
+        transfer patterns of date were computed on.
+        """
+        tt = self.feed.timetable(date)
+        if date not in self._route_patterns or self._route_patterns[date][0] is not tt:
+            name = self.day_type_name(date)
+            if self.meta['day_types'][name].get('stops') != stops_digest(tt.stop_ids):
+                raise ValueError('transfer patterns %s of %s were computed on other stops than those of the feed, '
+                                 'run transfer_patterns.py again' % (name, date))
+            patterns = RoutePatterns(tt)
+            self._route_patterns[date] = (tt, patterns, {})
+        return self._route_patterns[date][1:]
+
+    @staticmethod
+    def direct(patterns, served, a, b):
+        """(pattern, position of a, position of b) of the route patterns going from stop a to stop b."""
+        if (a, b) not in served:
+            found = []
+            for pattern, position in patterns.stop_patterns[a]:
+                after = np.flatnonzero(patterns.stops[pattern][position + 1:] == b)
+                if len(after):
+                    found.append((pattern, position, position + 1 + int(after[0])))
+            served[(a, b)] = found
+        return served[(a, b)]
+
+    def evaluate(self, tt, patterns, served, pattern, departure, speed, endtime):
+        """Earliest arrival and legs following one transfer pattern, (INF, None) if it cannot be ridden."""
+        time, legs, at = departure, [], pattern[0]
+        for i in range(0, len(pattern), 2):
+            board, alight = pattern[i], pattern[i + 1]
+            if board != at:
+                neighbours, distances = tt.footpaths(at)
+                walk = distances[neighbours == board]
+                if not len(walk):
+                    return INF, None
+                time += int(walk[0] / speed)
+            best, best_leg = INF, None
+            for route_pattern, position_a, position_b in self.direct(patterns, served, board, alight):
+                deps = patterns.departures[route_pattern]
+                trip = np.searchsorted(deps[:, position_a], time, side='right')
+                # Like the scan, the whole ride must leave before endtime
+                if trip < len(deps) and deps[trip, position_b - 1] < endtime \
+                        and patterns.arrivals[route_pattern][trip, position_b] < best:
+                    first = patterns.first_st[route_pattern][trip]
+                    best = int(patterns.arrivals[route_pattern][trip, position_b])
+                    best_leg = (first + position_a, first + position_b)
+            if best_leg is None:
+                return INF, None
+            time, at = best, alight
+            legs.append(best_leg)
+        return time, legs
+
+    def scan(self, date, speed, departure, sources, targets, endtime):
+        """Best legs from any of the source stops to any of the target stops, [] if none."""
+        tt = self.feed.timetable(date)
+        if speed != self.meta['speed']:
+            raise ValueError('transfer patterns computed for speed %s, not %s' % (self.meta['speed'], speed))
+        transfer_patterns = self.transfer_patterns(date)
+        patterns, served = self.route_patterns(date)
+        best, best_legs = INF, []
+        for source in sources:
+            for target in targets:
+                for pattern in transfer_patterns.patterns(source, target):
+                    arrival, legs = self.evaluate(tt, patterns, served, pattern, departure, speed, endtime)
+                    if arrival < best:
+                        best, best_legs = arrival, legs
+        return best_legs
+
+    def routing(self, date, speed, time, source, target, max_duration=4):
+        """Earliest arrival from the stop named source to the stop named target, as ConnectionScan.routing."""
+        tt = self.feed.timetable(date)
+        departure = time_to_seconds(time)
+        legs = self.scan(date, speed, departure, tt.stops_by_name(source), tt.stops_by_name(target),
+                         departure + max_duration * 3600)
+        return tt.itinerary(legs)
+
+
+def verify(router, date, queries=200, seed=0, max_duration=4):
+    """Compare router with the Connection Scan on random stop pairs and departures.
+
+    Returns (queries, worse, better, mean router seconds, mean scan seconds):
+    worse counts the queries where the patterns arrive later than the scan
+    (or not at all), better those where they arrive earlier, which happens
+    when the scan drops a footpath from a stop it had already reached on foot.
+    """
+    tt = router.feed.timetable(date)
+    speed = router.meta['speed']
+    rng = random.Random(seed)
+    stops = [int(stop) for stop in tt.active_stops]
+    worse, better, router_time, scan_time = 0, 0, 0.0, 0.0
+    for _ in range(queries):
+        source, target = rng.sample(stops, 2)
+        departure = rng.randrange(6 * 3600, 20 * 3600)
+        endtime = departure + max_duration * 3600
+        start = timeit.default_timer()
+        legs = router.scan(date, speed, departure, [source], [target], endtime)
+        router_time += timeit.default_timer() - start
+        start = timeit.default_timer()
+        expected = ConnectionScan.scan(tt, speed, departure, {source: 0}, {target: 0}, endtime)
+        scan_time += timeit.default_timer() - start
+        arrival = int(tt.st_arrival[legs[-1][1]]) if legs else INF
+        reference = int(tt.st_arrival[expected[-1][1]]) if expected else INF
+        worse += arrival > reference
+        better += arrival < reference
+    return queries, worse, better, router_time / queries, scan_time / queries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gtfs')
+    parser.add_argument('out')
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--max-duration', type=int, default=4, help='hours')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--verify', type=int, default=0, help='random queries checked per day type')
+    args = parser.parse_args()
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    meta = precompute(args.gtfs, args.out, speed, args.max_duration, args.workers)
+    router = TransferPatternRouter(Feed(args.gtfs), args.out)
+    for name, day_type in meta['day_types'].items():
+        print('%s (%d days): %d patterns, %.1f MB in memory, %.1f MB on disk, %.1f s' % (
+            name, len(day_type['days']), day_type['patterns'], day_type['nbytes'] / 2 ** 20,
+            day_type['file_bytes'] / 2 ** 20, day_type['seconds']))
+        if args.verify:
+            queries, worse, better, router_time, scan_time = verify(router, day_type['days'][0], args.verify,
+                                                                    max_duration=args.max_duration)
+            print('    %d queries: %d arrive later than the scan, %d earlier; %.3f ms per query (scan %.3f ms)' % (
+                queries, worse, better, router_time * 1000, scan_time * 1000))
@@ -0,0 +1,312 @@
+"""Stop-to-stop walking distances over the FootNode pedestrian network.
+
+App.get_walking_distance runs one apoc.algo.dijkstra per pair of FootNodes.
+This module exports the pedestrian graph once, runs a bounded Dijkstra from
+every Stop and keeps two sparse tables:
+
+- stop to stop: the real walking distance between stops closer than
+  max_distance on foot, which can replace the straight-line WALK_TO distances
+  (in Neo4j, or in the Timetable of the in-process engines);
+- FootNode to stop: the walking distance from every FootNode within
+  max_distance of a stop, so the first and last walking legs of an itinerary
+  are a lookup once the origin or destination is snapped to a FootNode.
+
+    python walking.py walking.npz [max_distance] [--write-walk-to]
+    python walking.py --footnode-index
+
+The second form stores FootNode.location as a WGS-84 point under a point
+index, for snapping inside Cypher (queries.NEAREST_FOOTNODE).
+"""
+import heapq
+import sys
+
+import numpy as np
+
+import queries
+from spatial import GridIndex
+from timetable import WALK_RADIUS
+
+# A Stop is joined to the FootNodes within this many meters, or to the nearest one
+SNAP_RADIUS = 50
+
+
+class FootNodeIndex:
+    """Nearest-FootNode snapping over the FootNode coordinates, loaded once.
+
+    Replaces a scan of every FootNode per query with a grid lookup that only
+    looks at the cells around the point, so snapping cost does not grow with
+    the size of the pedestrian network.
+    """
+
+    def __init__(self, footnode_ids, lat, lon):
+        located = ~(np.isnan(lat) | np.isnan(lon))
+        self.footnode_ids = np.asarray(footnode_ids, dtype=object)[located]
+        self.index = GridIndex(np.asarray(lat)[located], np.asarray(lon)[located], SNAP_RADIUS)
+
+    @classmethod
+    def from_neo4j(cls, driver):
+        with driver.session() as session:
+            rows = session.run(queries.FOOT_NODES).values()
+        lat = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=np.float64)
+        lon = np.array([np.nan if row[3] is None else row[3] for row in rows], dtype=np.float64)
+        return cls([row[1] for row in rows], lat, lon)
+
+    def nearest(self, lat, lon, max_distance=np.inf):
+        """(FootNode id, meters) of the FootNode closest to (lat, lon), (None, inf) if none."""
+        i, distance = self.index.nearest(lat, lon, max_distance)
+        return (self.footnode_ids[i], distance) if i >= 0 else (None, np.inf)
+
+    def nearest_many(self, lats, lons, max_distance=np.inf):
+        """nearest for arrays of coordinates: (FootNode ids, meters), None and inf where none is found."""
+        indices, distances = self.index.nearest_many(lats, lons, max_distance)
+        ids = np.full(len(indices), None, dtype=object)
+        ids[indices >= 0] = self.footnode_ids[indices[indices >= 0]]
+        return ids, distances
+
+
+class FootGraph:
+    """Undirected pedestrian graph in CSR form, weighted by relationship length in meters.
+
+    Nodes are every node touched by a pedestrian relationship; the FootNodes
+    among them have an id and coordinates, the others (footways reached
+    through CONTAINS) have id None and NaN coordinates.
+    """
+
+    def __init__(self, node_ids, lat, lon, indptr, indices, length):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.indptr = indptr
+        self.indices = indices
+        self.length = length
+        self.footnodes = np.flatnonzero(~np.isnan(lat))
+        self._index = None
+
+    @classmethod
+    def from_neo4j(cls, driver):
+        with driver.session() as session:
+            footnodes = session.run(queries.FOOT_NODES).values()
+            edges = session.run(queries.FOOT_EDGES).values()
+        nodes = {node: i for i, (node, _, _, _) in enumerate(footnodes)}
+        for source, target, _ in edges:
+            nodes.setdefault(source, len(nodes))
+            nodes.setdefault(target, len(nodes))
+        node_ids = np.full(len(nodes), None, dtype=object)
+        lat, lon = np.full(len(nodes), np.nan), np.full(len(nodes), np.nan)
+        for i, (_, footnode_id, footnode_lat, footnode_lon) in enumerate(footnodes):
+            node_ids[i] = footnode_id
+            if footnode_lat is not None and footnode_lon is not None:
+                lat[i], lon[i] = footnode_lat, footnode_lon
+        sources = np.array([nodes[source] for source, _, _ in edges], dtype=np.int64)
+        targets = np.array([nodes[target] for _, target, _ in edges], dtype=np.int64)
+        length = np.array([edge_length for _, _, edge_length in edges], dtype=np.float32)
+        return cls.from_edges(node_ids, lat, lon, sources, targets, length)
+
+    @classmethod
+    def from_edges(cls, node_ids, lat, lon, sources, targets, length):
+        """Build the CSR adjacency, every edge being walkable both ways."""
+        start = np.concatenate([sources, targets])
+        end = np.concatenate([targets, sources])
+        weight = np.concatenate([length, length])
+        order = np.argsort(start, kind='stable')
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(start, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids, np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), indptr,
+                   end[order].astype(np.int32), weight[order].astype(np.float32))
+
+    @property
+    def index(self):
+        """GridIndex over the FootNodes with coordinates."""
+        if self._index is None:
+            self._index = GridIndex(self.lat[self.footnodes], self.lon[self.footnodes], SNAP_RADIUS)
+        return self._index
+
+    def snap(self, lat, lon, radius=SNAP_RADIUS):
+        """Seeds {node: straight-line meters} joining (lat, lon) to the network."""
+        near, distances = self.index.query_radius(lat, lon, radius)
+        if not len(near):
+            nearest, distance = self.index.nearest(lat, lon)
+            if nearest < 0:
+                return {}
+            near, distances = [nearest], [distance]
+        return {int(self.footnodes[i]): float(distance) for i, distance in zip(near, distances)}
+
+    def dijkstra(self, seeds, max_distance):
+        """Bounded multi-source Dijkstra: {node: meters} for the nodes closer than max_distance."""
+        indptr, indices, length = self.indptr, self.indices, self.length
+        settled = {}
+        heap = [(distance, node) for node, distance in seeds.items() if distance < max_distance]
+        heapq.heapify(heap)
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = distance
+            for k in range(indptr[node], indptr[node + 1]):
+                reached = distance + float(length[k])
+                neighbour = int(indices[k])
+                if reached < max_distance and neighbour not in settled:
+                    heapq.heappush(heap, (reached, neighbour))
+        return settled
+
+
+class WalkingTable:
+    """Sparse walking distances in meters: stop to stop and FootNode to stop.
+
+    Both tables are CSR arrays indexed by position in stop_ids and in
+    footnode_ids, like the WALK_TO footpaths of a Timetable.
+    """
+
+    def __init__(self, stop_ids, footnode_ids, stop_indptr, stop_indices, stop_distance, foot_indptr,
+                 foot_indices, foot_distance, max_distance):
+        self.stop_ids = stop_ids
+        self.footnode_ids = footnode_ids
+        self.stop_indptr = stop_indptr
+        self.stop_indices = stop_indices
+        self.stop_distance = stop_distance
+        self.foot_indptr = foot_indptr
+        self.foot_indices = foot_indices
+        self.foot_distance = foot_distance
+        self.max_distance = max_distance
+        self._stop_index = {str(stop_id): i for i, stop_id in enumerate(stop_ids)}
+        self._foot_index = {str(footnode_id): i for i, footnode_id in enumerate(footnode_ids)}
+
+    @classmethod
+    def build(cls, graph, stop_ids, stop_lat, stop_lon, max_distance=WALK_RADIUS):
+        """Run one bounded Dijkstra per stop, seeded by the FootNodes around it."""
+        seeds = [graph.snap(lat, lon) for lat, lon in zip(stop_lat, stop_lon)]
+        # Stops joined to each node, with the straight-line meters of the join
+        joins = {}
+        for stop, stop_seeds in enumerate(seeds):
+            for node, distance in stop_seeds.items():
+                joins.setdefault(node, []).append((stop, distance))
+
+        is_footnode = np.zeros(len(graph.node_ids), dtype=bool)
+        is_footnode[graph.footnodes] = True
+        stop_rows, foot_rows = [], []
+        for stop, stop_seeds in enumerate(seeds):
+            reached = graph.dijkstra(stop_seeds, max_distance)
+            best = {}
+            for node, distance in reached.items():
+                if is_footnode[node]:
+                    foot_rows.append((node, stop, distance))
+                for other, join in joins.get(node, ()):
+                    if distance + join < min(best.get(other, max_distance), max_distance):
+                        best[other] = distance + join
+            best[stop] = 0.0
+            stop_rows.extend((stop, other, distance) for other, distance in best.items())
+
+        stop_indptr, stop_indices, stop_distance = _csr(stop_rows, len(stop_ids))
+        footnodes = sorted({node for node, _, _ in foot_rows})
+        position = {node: i for i, node in enumerate(footnodes)}
+        foot_indptr, foot_indices, foot_distance = _csr(
+            [(position[node], stop, distance) for node, stop, distance in foot_rows], len(footnodes))
+        return cls(np.asarray(stop_ids, dtype=str), np.array([str(graph.node_ids[node]) for node in footnodes]),
+                   stop_indptr, stop_indices, stop_distance, foot_indptr, foot_indices, foot_distance, max_distance)
+
+    def save(self, path):
+        np.savez(path, stop_ids=self.stop_ids, footnode_ids=self.footnode_ids, stop_indptr=self.stop_indptr,
+                 stop_indices=self.stop_indices, stop_distance=self.stop_distance, foot_indptr=self.foot_indptr,
+                 foot_indices=self.foot_indices, foot_distance=self.foot_distance,
+                 max_distance=np.float64(self.max_distance))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['stop_ids'], data['footnode_ids'], data['stop_indptr'], data['stop_indices'],
+                   data['stop_distance'], data['foot_indptr'], data['foot_indices'], data['foot_distance'],
+                   float(data['max_distance']))
+
+    @staticmethod
+    def _lookup(indptr, indices, distance, row, column):
+        start, end = indptr[row], indptr[row + 1]
+        k = start + np.searchsorted(indices[start:end], column)
+        return float(distance[k]) if k < end and indices[k] == column else np.inf
+
+    def between_stops(self, stop_a, stop_b):
+        """Walking meters from Stop id stop_a to Stop id stop_b, inf if further than max_distance."""
+        a, b = self._stop_index.get(str(stop_a)), self._stop_index.get(str(stop_b))
+        if a is None or b is None:
+            return np.inf
+        return self._lookup(self.stop_indptr, self.stop_indices, self.stop_distance, a, b)
+
+    def from_footnode(self, footnode_id, stop_id):
+        """Walking meters from the FootNode footnode_id to Stop id stop_id, inf if further than max_distance."""
+        node, stop = self._foot_index.get(str(footnode_id)), self._stop_index.get(str(stop_id))
+        if node is None or stop is None:
+            return np.inf
+        return self._lookup(self.foot_indptr, self.foot_indices, self.foot_distance, node, stop)
+
+    def footpaths(self, stop_ids):
+        """Stop to stop table as CSR footpaths (indptr, indices, distance) over the order of stop_ids."""
+        position = np.array([self._stop_index.get(str(stop_id), -1) for stop_id in stop_ids], dtype=np.int64)
+        to_table = {int(k): i for i, k in enumerate(position) if k >= 0}
+        indptr = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+        indices, distances = [], []
+        for i, k in enumerate(position):
+            row_indices, row_distances = [], []
+            if k >= 0:
+                for j in range(self.stop_indptr[k], self.stop_indptr[k + 1]):
+                    other = to_table.get(int(self.stop_indices[j]))
+                    if other is not None:
+                        row_indices.append(other)
+                        row_distances.append(self.stop_distance[j])
+            order = np.argsort(row_indices, kind='stable')
+            indices.append(np.asarray(row_indices, dtype=np.int32)[order])
+            distances.append(np.asarray(row_distances, dtype=np.float32)[order])
+            indptr[i + 1] = indptr[i] + len(row_indices)
+        return indptr, np.concatenate(indices), np.concatenate(distances)
+
+    def write_walk_to(self, driver, replace=False, batch_size=10000):
+        """Store the stop to stop table as WALK_TO.distance; replace drops the straight-line WALK_TO first."""
+        with driver.session() as session:
+            if replace:
+                session.run(queries.WALK_TO_DELETE).consume()
+            rows = []
+            for a in range(len(self.stop_ids)):
+                for k in range(self.stop_indptr[a], self.stop_indptr[a + 1]):
+                    rows.append({'source': str(self.stop_ids[a]), 'target': str(self.stop_ids[self.stop_indices[k]]),
+                                 'distance': float(self.stop_distance[k])})
+                    if len(rows) == batch_size:
+                        session.run(queries.WALK_TO_WRITE, rows=rows).consume()
+                        rows = []
+            if rows:
+                session.run(queries.WALK_TO_WRITE, rows=rows).consume()
+
+
+def _csr(rows, n_rows):
+    """(row, column, value) triplets to CSR arrays with sorted columns."""
+    table = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    order = np.lexsort((table[:, 1], table[:, 0]))
+    table = table[order]
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(table[:, 0].astype(np.int64), minlength=n_rows), out=indptr[1:])
+    return indptr, table[:, 1].astype(np.int32), table[:, 2].astype(np.float32)
+
+
+if __name__ == '__main__':
+    from neo4j import GraphDatabase
+
+    driver = GraphDatabase.driver('neo4j://localhost:7687', auth=('neo4j', '12345678'))
+    if sys.argv[1:] == ['--footnode-index']:
+        with driver.session() as session:
+            session.run(queries.FOOTNODE_LOCATION).consume()
+            session.run(queries.FOOTNODE_LOCATION_INDEX).consume()
+        driver.close()
+        sys.exit()
+
+    path = sys.argv[1]
+    args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+    max_distance = float(args[0]) if args else WALK_RADIUS
+    graph = FootGraph.from_neo4j(driver)
+    with driver.session() as session:
+        stops = session.run(queries.STOP_COORDINATES).values()
+    table = WalkingTable.build(graph, [row[0] for row in stops], [row[1] for row in stops], [row[2] for row in stops],
+                               max_distance)
+    table.save(path)
+    print('%d stop pairs, %d FootNode-stop pairs within %g m' % (len(table.stop_indices), len(table.foot_indices),
+                                                                 max_distance))
+    if '--write-walk-to' in sys.argv:
+        table.write_walk_to(driver, replace=True)
+        print('WALK_TO rewritten: re-project the days and re-run changes_setup.py')
+    driver.close()
@@ -0,0 +1,260 @@
+"""Rolling window of service days, for routing across midnight.
+
+A projection serves one Day, so a query late in the evening runs out of
+Stoptimes at the end of that day: the trips of the next morning are in the
+projection of the next Day. RollingWindow puts the current and the next
+service day (days=2) on one timeline. The Stoptimes of each day are copied
+out of its projection (ExpandedGraph.from_projection) with their times in
+seconds after midnight of the first day: arrival_seconds/departure_seconds,
+which go past 86400 for the trips after midnight, plus 86400 for every day
+after the first. OVERNIGHT_CHANGES joins each day to the next one.
+
+GDS can neither add nodes to a projection nor remove them, so a projection
+of the whole window would be rebuilt at every rollover. Here the days stay
+separate: each day and each set of overnight links is loaded once and kept
+until it expires, and a window is stitched from them with
+ExpandedGraph.concatenate. Moving to the next day loads one day and one set
+of links, in the background while the current window keeps answering, and
+roll(date) drops the days before date together with the projections the
+window loaded for them; projections used by other callers stay.
+
+A query early in the morning of a day starts a window on the day before,
+its times shifted by DAY, so that it can also board that day's trips after
+midnight (first_day); when the day before has no such trip, as on the first
+day of a feed or after a day without service, it stays on its own day.
+
+The window rolls on an explicit roll(), or when the service clock changes
+day if one is given (clock=today); a query about another day, later or
+earlier, only loads that day. The day before today is kept, since its trips
+still run after midnight.
+
+    python window.py 2024-01-18 --speed 1       (loads the window, prints its size)
+    python window.py --backfill                 (Stoptime seconds of a database loaded before they existed)
+"""
+import argparse
+import threading
+import timeit
+from datetime import date as ddate, timedelta
+
+import numpy as np
+from neo4j import GraphDatabase
+
+import queries
+from expanded import ExpandedGraph
+from projections import ProjectionManager, graph_name
+
+DAY = 86400
+# Longest wait of an overnight CHANGE, the default max_duration of the routing methods
+MAX_WAIT = 4 * 3600
+# How long after midnight the trips of a service day run (30:00:00), earlier queries look at the day before
+OVERNIGHT = 6 * 3600
+
+
+def next_day(date):
+    return str(ddate.fromisoformat(date) + timedelta(days=1))
+
+
+def previous_day(date):
+    return str(ddate.fromisoformat(date) - timedelta(days=1))
+
+
+def today():
+    return str(ddate.today())
+
+
+class RollingWindow:
+    """days service days from a date, per walking speed, as one ExpandedGraph on absolute times."""
+
+    def __init__(self, driver, projections, days=2, max_wait=MAX_WAIT, prefetch=True, clock=None,
+                 overnight=OVERNIGHT):
+        self.driver = driver
+        self.projections = projections
+        self.days = days
+        self.max_wait = max_wait
+        self.overnight = overnight
+        self.prefetch = prefetch
+        # Service date now ('YYYY-MM-DD'), None to roll only on explicit roll() calls
+        self.clock = clock
+        self.today = None
+        # First day kept; roll() drops the days before it
+        self.start = None
+        # (date, speed) -> (projection version, ExpandedGraph of the day)
+        self._days = {}
+        # (date, speed) -> (versions of date and of the next day, CHANGE edges from date to the next day)
+        self._links = {}
+        # (first date, speed) -> (versions of the days, stitched ExpandedGraph)
+        self._windows = {}
+        # date -> (projection version, whether trips of date run after midnight)
+        self._overnight = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def dates(self, date):
+        first = ddate.fromisoformat(date)
+        return [str(first + timedelta(days=k)) for k in range(self.days)]
+
+    def first_day(self, date, departure, endtime):
+        """First day of the window a query on date from departure to endtime (seconds) needs, None for date alone.
+
+        A horizon past midnight needs the next day, a departure before
+        overnight the day before, whose trips past 24:00:00 run then; the
+        query times are then shifted by DAY. Without such trips on the day
+        before, the query stays on date alone.
+        """
+        if endtime > DAY:
+            return date
+        if departure < self.overnight and self.runs_overnight(previous_day(date)):
+            return previous_day(date)
+        return None
+
+    def runs_overnight(self, date):
+        """Whether trips of date run after midnight; False when date has no Day or no ride."""
+        version = self.projections.version(date)
+        with self._lock:
+            cached = self._overnight.get(date)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self.driver.session() as session:
+            service = session.run(queries.OVERNIGHT_SERVICE, date=date, day_seconds=DAY).single()[0]
+        with self._lock:
+            self._overnight[date] = (version, service)
+        return service
+
+    def version(self, date):
+        """Projection versions of the days of the window starting at date, part of the cache keys."""
+        return tuple(self.projections.version(day) for day in self.dates(date))
+
+    def day(self, date, speed):
+        """The projection of (date, speed) as an ExpandedGraph, streamed once per projection version."""
+        self.tick()
+        version = self.projections.version(date)
+        with self._lock:
+            cached = self._days.get((date, speed))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        name = self.projections.get(date, speed)
+        graph = ExpandedGraph.from_projection(self.driver, name, date)
+        with self._lock:
+            # The days whose projection was evicted go with it
+            for key in [key for key in self._days if graph_name(*key) not in self.projections]:
+                del self._days[key]
+            self._days[(date, speed)] = (version, graph)
+        return graph
+
+    def links(self, date, speed):
+        """CHANGE edges from the Stoptimes of date to those of the next day: (source ids, target ids, waiting_time)."""
+        following = next_day(date)
+        version = (self.projections.version(date), self.projections.version(following))
+        with self._lock:
+            cached = self._links.get((date, speed))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self.driver.session() as session:
+            rows = session.run(queries.OVERNIGHT_CHANGES, date=date, next_date=following, speed=speed,
+                               day_seconds=DAY, max_wait=self.max_wait).values()
+        links = (np.array([row[0] for row in rows], dtype=np.int64), np.array([row[1] for row in rows], dtype=np.int64),
+                 np.array([row[2] for row in rows], dtype=np.float64))
+        with self._lock:
+            self._links[(date, speed)] = (version, links)
+        return links
+
+    def graph(self, date, speed):
+        """The window starting at date, after rolling to the service clock when its day has changed."""
+        self.tick()
+        with self._lock:
+            pending = self._pending.get((date, speed))
+        if pending is not None:
+            pending.join()
+        version = self.version(date)
+        with self._lock:
+            cached = self._windows.get((date, speed))
+        if cached is None or cached[0] != version:
+            dates = self.dates(date)
+            graphs = [self.day(day, speed) for day in dates]
+            links = [(i, i + 1) + self.links(day, speed) for i, day in enumerate(dates[:-1])]
+            cached = (version, ExpandedGraph.concatenate(graphs, [DAY * i for i in range(len(dates))], links))
+            with self._lock:
+                self._windows = {key: value for key, value in self._windows.items() if key[1] != speed}
+                self._windows[(date, speed)] = cached
+        if self.prefetch:
+            self.prefetch_window(next_day(date), speed)
+        return cached[1]
+
+    def prefetch_window(self, date, speed):
+        """Load the day and the links the window starting at date adds to the previous one, in a background thread."""
+        with self._lock:
+            if (date, speed) in self._pending or (date, speed) in self._windows:
+                return
+            thread = threading.Thread(target=self._prefetch, args=(date, speed), daemon=True)
+            self._pending[(date, speed)] = thread
+        thread.start()
+
+    def _prefetch(self, date, speed):
+        dates = self.dates(date)
+        try:
+            self.day(dates[-1], speed)
+            if len(dates) > 1:
+                self.links(dates[-2], speed)
+        finally:
+            with self._lock:
+                self._pending.pop((date, speed), None)
+
+    def tick(self):
+        """Roll to the day before the service date when the clock has moved to another day."""
+        if self.clock is None:
+            return
+        now = self.clock()
+        if now != self.today:
+            self.today = now
+            self.roll(previous_day(now))
+
+    def roll(self, date):
+        """Make date the first day of the window: the days before it, their links and projections are dropped.
+
+        Only the projections of days loaded here are dropped, not those
+        obtained from the ProjectionManager by other callers.
+        """
+        with self._lock:
+            loaded = {graph_name(*key) for key in self._days if key[0] < date}
+            self.start = date
+            self._days = {key: value for key, value in self._days.items() if key[0] >= date}
+            self._links = {key: value for key, value in self._links.items() if key[0] >= date}
+            self._windows = {key: value for key, value in self._windows.items() if key[0] >= date}
+            self._overnight = {key: value for key, value in self._overnight.items() if key >= date}
+        self.projections.expire(date, loaded)
+
+
+def backfill(driver):
+    """Set arrival_seconds/departure_seconds on the Stoptimes without them; returns (batches, trips)."""
+    with driver.session() as session:
+        return session.run(queries.STOPTIME_SECONDS).single()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('date', nargs='?')
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--backfill', action='store_true', help='set the Stoptime seconds missing in the database')
+    parser.add_argument('--uri', default='neo4j://localhost:7687')
+    parser.add_argument('--user', default='neo4j')
+    parser.add_argument('--password', default='12345678')
+    args = parser.parse_args()
+    if not args.backfill and args.date is None:
+        parser.error('a date or --backfill is needed')
+    speed = int(args.speed) if float(args.speed).is_integer() else args.speed
+    driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
+    try:
+        if args.backfill:
+            batches, total = backfill(driver)
+            print('Stoptime seconds of %d trips in %d batches' % (total, batches))
+        if args.date is not None:
+            start = timeit.default_timer()
+            window = RollingWindow(driver, ProjectionManager(driver, prefetch_next_day=False), args.days,
+                                   prefetch=False)
+            graph = window.graph(args.date, speed)
+            print('%s: %d Stoptimes, %d relationships, %.1f MiB in %.1f s'
+                  % (', '.join(window.dates(args.date)), len(graph.node_ids), len(graph.indices),
+                     graph.nbytes / 2 ** 20, timeit.default_timer() - start))
+    finally:
+        driver.close()